@@ -0,0 +1,70 @@
+"""
+Benchmark for adding ion fields to a dataset.
+
+Compares adding the fields of every ion of the first 30 elements one
+ion at a time with add_ion_mass_field, as add_ion_fields used to do,
+against add_ion_fields, which registers them all at once and defers
+reading the ion tables until the fields are used.
+
+Usage: python bench_add_ion_fields.py
+"""
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2017, Trident Development Team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+#-----------------------------------------------------------------------------
+
+import time
+
+from yt.testing import \
+    fake_random_ds
+
+from trident.ion_balance import \
+    add_ion_fields, \
+    add_ion_mass_field, \
+    atomic_number, \
+    table_store
+
+def make_ds():
+    """
+    Make a small dataset with the fields needed for ion fields.
+    """
+    return fake_random_ds(16, fields=("density", "temperature",
+                                      "metallicity"),
+                          units=("g/cm**3", "K", ""))
+
+def add_one_at_a_time(ds):
+    """
+    The old approach: one cascade of field additions per ion.
+    """
+    for atom, n_states in atomic_number.items():
+        for ion in range(1, n_states + 2):
+            add_ion_mass_field(atom, ion, ds)
+
+def add_in_bulk(ds):
+    """
+    The new approach: all fields registered in one update.
+    """
+    add_ion_fields(ds, 'all')
+
+
+if __name__ == "__main__":
+    timings = {}
+    for func in [add_one_at_a_time, add_in_bulk]:
+        ds = make_ds()
+        ds.index
+        table_store.clear()
+        t1 = time.time()
+        func(ds)
+        timings[func.__name__] = time.time() - t1
+        print("%-24s %10.4f s" % (func.__name__, timings[func.__name__]))
+    print("Speedup: %.1fx" %
+          (timings['add_one_at_a_time'] / timings['add_in_bulk']))
+
+    # the first use of a field reads the tables of its element
+    t1 = time.time()
+    ds.all_data()['gas', 'O_p5_number_density']
+    print("%-24s %10.4f s" % ("first O VI evaluation", time.time() - t1))
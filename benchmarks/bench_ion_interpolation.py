@@ -0,0 +1,96 @@
+"""
+Benchmark for interpolating ion balance tables.
+
+Compares yt's TrilinearFieldInterpolator, built and called once per ion
+as ion fraction fields used to do, against Trident's N-linear
+TableInterpolator, which finds the indices and weights once and then
+interpolates every ion from them.  Also times a 4D table to show the
+cost of an extra axis.
+
+Usage: python bench_ion_interpolation.py [n_cells] [n_ions]
+"""
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2017, Trident Development Team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+#-----------------------------------------------------------------------------
+
+import sys
+import time
+
+import numpy as np
+from yt.utilities.linear_interpolators import \
+    TrilinearFieldInterpolator
+
+from trident.ion_balance import \
+    TableInterpolator
+
+# table axes similar to those of the Haardt & Madau (2012) table
+bins = [np.linspace(-9, 4, 131),
+        np.linspace(0, 15.1, 152),
+        np.linspace(1, 9, 161)]
+field_names = ["log_nH", "redshift", "log_T"]
+
+def make_inputs(n_cells):
+    """
+    Make random table inputs, some of them off the table.
+    """
+    return dict([(name, np.random.uniform(axis_bins[0] - 0.5,
+                                           axis_bins[-1] + 0.5, n_cells))
+                 for name, axis_bins in zip(field_names, bins)])
+
+def interpolate_trilinear(tables, inputs):
+    """
+    The old approach: a yt interpolator for each ion.
+    """
+    results = []
+    for table in tables:
+        interp = TrilinearFieldInterpolator(table, bins, field_names,
+                                            truncate=True)
+        results.append(interp(inputs))
+    return results
+
+def interpolate_n_linear(tables, inputs):
+    """
+    The new approach: one set of weights for all ions.
+    """
+    interpolator = TableInterpolator(bins)
+    shape, index, weights = \
+      interpolator.weights([inputs[name] for name in field_names])
+    return [(table.ravel()[index] * weights).sum(axis=0).reshape(shape)
+            for table in tables]
+
+
+if __name__ == "__main__":
+    n_cells = int(sys.argv[1]) if len(sys.argv) > 1 else 10**6
+    n_ions = int(sys.argv[2]) if len(sys.argv) > 2 else 9
+    inputs = make_inputs(n_cells)
+    tables = [np.random.random([axis_bins.size for axis_bins in bins])
+              for i in range(n_ions)]
+    print("%d cells, %d ions." % (n_cells, n_ions))
+
+    timings = {}
+    results = {}
+    for func in [interpolate_trilinear, interpolate_n_linear]:
+        t1 = time.time()
+        results[func.__name__] = func(tables, inputs)
+        timings[func.__name__] = time.time() - t1
+        print("%-24s %10.4f s" % (func.__name__, timings[func.__name__]))
+
+    for old, new in zip(results['interpolate_trilinear'],
+                        results['interpolate_n_linear']):
+        np.testing.assert_allclose(new, old, rtol=1e-10, atol=1e-12)
+    print("Speedup: %.1fx" %
+          (timings['interpolate_trilinear'] / timings['interpolate_n_linear']))
+
+    # a fourth axis, such as metallicity
+    bins_4d = bins + [np.linspace(-3, 1, 9)]
+    inputs_4d = [inputs[name] for name in field_names] + \
+      [np.random.uniform(-3, 1, n_cells)]
+    table_4d = np.random.random([axis_bins.size for axis_bins in bins_4d])
+    t1 = time.time()
+    TableInterpolator(bins_4d)(table_4d, inputs_4d)
+    print("%-24s %10.4f s" % ("4D, one ion", time.time() - t1))
@@ -0,0 +1,104 @@
+"""
+Benchmark for accumulating light ray data across segments.
+
+Compares the old approach of extending Python lists with the values
+of each subsegment and rebuilding YTArrays from those lists against
+joining arrays with a single concatenate per field, as done in
+LightRay.make_light_ray.
+
+Usage: python bench_light_ray_accumulation.py [n_segments] [n_cells]
+"""
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2017, Trident Development Team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+#-----------------------------------------------------------------------------
+
+import sys
+import time
+
+import numpy as np
+from yt.units.yt_array import \
+    YTArray
+
+from trident.light_ray import \
+    _concatenate_arrays, \
+    _flatten_dict_list
+
+fields = {'density': 'g/cm**3', 'temperature': 'K', 'metallicity': 'Zsun',
+          'l': 'cm', 'dl': 'cm', 'x': 'cm', 'y': 'cm', 'z': 'cm',
+          'velocity_los': 'cm/s', 'redshift_dopp': ''}
+n_subsegments = 3
+
+def make_subsegments(n_segments, n_cells):
+    """
+    Make random subsegment data for a synthetic multi-segment ray.
+    """
+    segments = []
+    for i in range(n_segments):
+        segments.append(
+            [dict([(field, YTArray(np.random.random(n_cells), units))
+                   for field, units in fields.items()])
+             for j in range(n_subsegments)])
+    return segments
+
+def accumulate_lists(segments):
+    """
+    The old approach: extend lists with the arrays of each subsegment.
+    """
+    all_data = []
+    for segment in segments:
+        sub_data = dict([(field, []) for field in fields])
+        for sub_segment in segment:
+            for field in fields:
+                sub_data[field].extend(sub_segment[field])
+        for field in fields:
+            sub_data[field] = YTArray(sub_data[field]).in_cgs()
+        all_data.append(sub_data)
+    new_data = {}
+    for datum in all_data:
+        for field in datum:
+            new_data.setdefault(field, []).extend(datum[field])
+    for field in new_data:
+        new_data[field] = YTArray(new_data[field])
+    return new_data
+
+def accumulate_arrays(segments):
+    """
+    The new approach: collect arrays and concatenate once per field.
+    """
+    all_data = []
+    for segment in segments:
+        sub_data = dict([(field, []) for field in fields])
+        for sub_segment in segment:
+            for field in fields:
+                sub_data[field].append(sub_segment[field])
+        for field in fields:
+            sub_data[field] = _concatenate_arrays(sub_data[field]).in_cgs()
+        all_data.append(sub_data)
+    return _flatten_dict_list(all_data)
+
+
+if __name__ == "__main__":
+    n_segments = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    n_cells = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    segments = make_subsegments(n_segments, n_cells)
+    print("Ray with %d segments, %d cells." %
+          (n_segments, n_segments * n_subsegments * n_cells))
+
+    timings = {}
+    results = {}
+    for func in [accumulate_lists, accumulate_arrays]:
+        t1 = time.time()
+        results[func.__name__] = func(segments)
+        timings[func.__name__] = time.time() - t1
+        print("%-20s %10.4f s" % (func.__name__, timings[func.__name__]))
+
+    for field in fields:
+        assert (results['accumulate_lists'][field] ==
+                results['accumulate_arrays'][field]).all()
+    print("Speedup: %.1fx" %
+          (timings['accumulate_lists'] / timings['accumulate_arrays']))
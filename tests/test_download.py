@@ -19,3 +19,214 @@ def test_download_file():
     env = os.environ
     if int(env.get("RUN_DOWNLOAD_TEST", 0)) == 1:
         download_datasets(progress_bar=False)
+
+def test_download_and_gunzip_file_resume():
+    """
+    Test that a gzipped file is downloaded and unzipped in one pass, and
+    that an interrupted download is resumed with a range request.
+    """
+    import gzip
+    import hashlib
+    import shutil
+    import tempfile
+    import threading
+    from http.server import \
+        BaseHTTPRequestHandler, \
+        HTTPServer
+    from trident.utilities import \
+        download_and_gunzip_file
+
+    raw_data = os.urandom(2**16) * 8
+    gz_data = gzip.compress(raw_data)
+    requests_seen = []
+
+    class RangeHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            byte_range = self.headers.get("Range")
+            requests_seen.append(byte_range)
+            if byte_range is None:
+                # drop the connection halfway through the first request
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(gz_data)))
+                self.end_headers()
+                self.wfile.write(gz_data[:len(gz_data) // 2])
+                self.close_connection = True
+                return
+            start = int(byte_range.split("=")[1].split("-")[0])
+            self.send_response(206)
+            self.send_header("Content-Length", str(len(gz_data) - start))
+            self.send_header("Content-Range", "bytes %d-%d/%d" %
+                             (start, len(gz_data) - 1, len(gz_data)))
+            self.end_headers()
+            self.wfile.write(gz_data[start:])
+
+    server = HTTPServer(("127.0.0.1", 0), RangeHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    dirpath = tempfile.mkdtemp()
+    out_filename = os.path.join(dirpath, "table.h5")
+    url = "http://127.0.0.1:%d/table.h5.gz" % server.server_port
+    try:
+        digest = download_and_gunzip_file(
+            url, out_filename, checksum=hashlib.md5(gz_data).hexdigest(),
+            progress_bar=False)
+        assert digest == hashlib.md5(gz_data).hexdigest()
+        with open(out_filename, "rb") as f:
+            assert f.read() == raw_data
+        assert len(requests_seen) == 2
+        assert requests_seen[1] is not None
+        assert os.listdir(dirpath) == ["table.h5"]
+
+        # a bad checksum should leave no output file behind
+        os.remove(out_filename)
+        del requests_seen[:]
+        try:
+            download_and_gunzip_file(url, out_filename, checksum="0",
+                                     progress_bar=False)
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("Checksum mismatch was not detected.")
+        assert os.listdir(dirpath) == []
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(dirpath)
+
+def test_download_and_gunzip_file_many_interruptions():
+    """
+    Test that a download interrupted more times than max_retries still
+    completes, as long as each attempt makes progress.
+    """
+    import gzip
+    import shutil
+    import tempfile
+    import threading
+    from http.server import \
+        BaseHTTPRequestHandler, \
+        HTTPServer
+    from trident.utilities import \
+        download_and_gunzip_file
+
+    raw_data = os.urandom(2**16) * 8
+    gz_data = gzip.compress(raw_data)
+    piece = len(gz_data) // 8 + 1
+    requests_seen = []
+
+    class PieceHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            byte_range = self.headers.get("Range")
+            requests_seen.append(byte_range)
+            start = 0
+            if byte_range is None:
+                self.send_response(200)
+            else:
+                start = int(byte_range.split("=")[1].split("-")[0])
+                self.send_response(206)
+                self.send_header("Content-Range", "bytes %d-%d/%d" %
+                                 (start, len(gz_data) - 1, len(gz_data)))
+            self.send_header("Content-Length", str(len(gz_data) - start))
+            self.end_headers()
+            # drop the connection after each piece
+            self.wfile.write(gz_data[start:start + piece])
+            self.close_connection = True
+
+    server = HTTPServer(("127.0.0.1", 0), PieceHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    dirpath = tempfile.mkdtemp()
+    out_filename = os.path.join(dirpath, "table.h5")
+    url = "http://127.0.0.1:%d/table.h5.gz" % server.server_port
+    try:
+        download_and_gunzip_file(url, out_filename, progress_bar=False,
+                                 max_retries=1)
+        with open(out_filename, "rb") as f:
+            assert f.read() == raw_data
+        assert len(requests_seen) > 2
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(dirpath)
+
+def test_download_and_gunzip_file_stalled():
+    """
+    Test that a download that stalls times out and is resumed.
+    """
+    import gzip
+    import shutil
+    import tempfile
+    import threading
+    import time
+    from http.server import \
+        BaseHTTPRequestHandler, \
+        HTTPServer
+    from socketserver import \
+        ThreadingMixIn
+    from trident.utilities import \
+        download_and_gunzip_file
+
+    raw_data = os.urandom(2**16) * 8
+    gz_data = gzip.compress(raw_data)
+    requests_seen = []
+    release = threading.Event()
+
+    class StallHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            byte_range = self.headers.get("Range")
+            requests_seen.append(byte_range)
+            if byte_range is None:
+                # send half of the file, then stop sending anything
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(gz_data)))
+                self.end_headers()
+                self.wfile.write(gz_data[:len(gz_data) // 2])
+                self.wfile.flush()
+                release.wait(10)
+                self.close_connection = True
+                return
+            start = int(byte_range.split("=")[1].split("-")[0])
+            self.send_response(206)
+            self.send_header("Content-Length", str(len(gz_data) - start))
+            self.send_header("Content-Range", "bytes %d-%d/%d" %
+                             (start, len(gz_data) - 1, len(gz_data)))
+            self.end_headers()
+            self.wfile.write(gz_data[start:])
+
+    class ThreadingServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = ThreadingServer(("127.0.0.1", 0), StallHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    dirpath = tempfile.mkdtemp()
+    out_filename = os.path.join(dirpath, "table.h5")
+    url = "http://127.0.0.1:%d/table.h5.gz" % server.server_port
+    try:
+        start_time = time.time()
+        download_and_gunzip_file(url, out_filename, progress_bar=False,
+                                 timeout=(5, 0.5))
+        assert time.time() - start_time < 5
+        with open(out_filename, "rb") as f:
+            assert f.read() == raw_data
+        assert len(requests_seen) == 2
+        assert requests_seen[1] is not None
+    finally:
+        release.set()
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(dirpath)
@@ -12,17 +12,27 @@ Tests for ion balance code
 #-----------------------------------------------------------------------------
 
 from trident.ion_balance import \
+    IonBalanceTable, \
+    TableInterpolator, \
     add_ion_fraction_field, \
     add_ion_number_density_field, \
     add_ion_density_field, \
     add_ion_mass_field, \
-    add_ion_fields
+    add_ion_fields, \
+    make_flat_ion_table, \
+    table_store
+import trident.ion_balance
+from trident.memory_ray import \
+    MemoryRay
 from yt import \
     load, \
     SlicePlot
 from yt.testing import \
     fake_random_ds, \
     fake_amr_ds
+from yt.utilities.linear_interpolators import \
+    TrilinearFieldInterpolator
+import h5py
 import tempfile
 import shutil
 from trident.testing import \
@@ -37,6 +47,209 @@ ISO_GALAXY = os.path.join(answer_test_data_dir,
 FIRE_SIM = os.path.join(answer_test_data_dir,
                 'FIRE_M12i_ref11/snapshot_600.hdf5')
 
+def test_ion_balance_table_ions():
+    """
+    Test reading the tables of only some ions
+    """
+    full_table = IonBalanceTable(atom='O')
+    ion_table = IonBalanceTable(atom='O', ions=[6, 2])
+    assert ion_table.ion_fraction.shape[0] == 2
+    np.testing.assert_array_equal(ion_table.ion_fraction[0],
+                                  full_table.ion_fraction[5])
+    np.testing.assert_array_equal(ion_table.ion_fraction[1],
+                                  full_table.ion_fraction[1])
+    for par1, par2 in zip(ion_table.parameters, full_table.parameters):
+        np.testing.assert_array_equal(par1, par2)
+
+def test_flat_ion_table():
+    """
+    Test that a flat ion table is memory-mapped and gives the same values
+    """
+    dirpath = tempfile.mkdtemp()
+    filename = os.path.join(dirpath, 'flat_table.h5')
+    make_flat_ion_table(filename)
+    table = IonBalanceTable(atom='C')
+    flat_table = IonBalanceTable(filename, atom='C')
+    assert flat_table.mapped
+    np.testing.assert_array_equal(flat_table.ion_fraction,
+                                  table.ion_fraction)
+
+    ds = fake_random_ds(8, fields=("density", "velocity_x", "velocity_y",
+                                   "velocity_z", "temperature", "metallicity"),
+                           units= ('g/cm**3', 'cm/s', 'cm/s',
+                                   'cm/s', 'K', ''))
+    add_ion_fraction_field('C', 4, ds)
+    add_ion_fraction_field('C', 4, ds, ionization_table=filename,
+                           field_suffix=True)
+    ad = ds.all_data()
+    np.testing.assert_array_equal(ad['gas', 'C_p3_ion_fraction'],
+                                  ad['gas', 'C_p3_ion_fraction_flat_table'])
+    del flat_table
+    shutil.rmtree(dirpath)
+
+def test_ion_table_store():
+    """
+    Test that ion tables evicted from the table store are read again
+    """
+    ds = fake_random_ds(8, fields=("density", "velocity_x", "velocity_y",
+                                   "velocity_z", "temperature", "metallicity"),
+                           units= ('g/cm**3', 'cm/s', 'cm/s',
+                                   'cm/s', 'K', ''))
+    add_ion_fraction_field('Si', 4, ds)
+    add_ion_fraction_field('Mg', 2, ds)
+    ad = ds.all_data()
+    fraction = ad['gas', 'Si_p3_ion_fraction'].copy()
+    max_bytes = table_store.max_bytes
+    try:
+        # only the most recently used element is kept
+        table_store.max_bytes = 0
+        ad['gas', 'Mg_p1_ion_fraction']
+        misses = table_store.misses
+        ad.clear_data()
+        np.testing.assert_array_equal(ad['gas', 'Si_p3_ion_fraction'],
+                                      fraction)
+        assert table_store.misses > misses
+    finally:
+        table_store.max_bytes = max_bytes
+    table_store.clear()
+    assert table_store.nbytes == 0
+    assert 'Si_p3_ion_fraction' in table_store
+
+def test_ion_fraction_linear_tables():
+    """
+    Test ion fractions interpolated from linear, float32 tables
+    """
+    ds = fake_random_ds(8, fields=("density", "velocity_x", "velocity_y",
+                                   "velocity_z", "temperature", "metallicity"),
+                           units= ('g/cm**3', 'cm/s', 'cm/s',
+                                   'cm/s', 'K', ''))
+    add_ion_fraction_field('N', 5, ds)
+    ad = ds.all_data()
+    field = ('gas', 'N_p4_ion_fraction')
+    log_fraction = ad[field].copy()
+    try:
+        table_store.precompute(linear=True, dtype='float32')
+        assert table_store['N_p4_ion_fraction']['table'].dtype == np.float32
+        ad.clear_data()
+        fraction = ad[field]
+    finally:
+        table_store.precompute(linear=False)
+    assert (fraction >= 0).all() and (fraction <= 1).all()
+    ad.clear_data()
+    np.testing.assert_array_equal(ad[field], log_fraction)
+
+def test_ion_fields_cell_budget():
+    """
+    Test that ion fields evaluated in slices of cells match those
+    evaluated at once
+    """
+    fields = [('gas', 'O_p5_ion_fraction'), ('gas', 'O_p5_number_density'),
+              ('gas', 'O_p5_mass')]
+    values = []
+    for cell_budget in [None, 100]:
+        ds = fake_random_ds(8, fields=("density", "velocity_x", "velocity_y",
+                                       "velocity_z", "temperature",
+                                       "metallicity"),
+                            units= ('g/cm**3', 'cm/s', 'cm/s',
+                                    'cm/s', 'K', ''))
+        add_ion_mass_field('O', 6, ds)
+        trident.ion_balance.ion_field_cell_budget = cell_budget
+        try:
+            ad = ds.all_data()
+            values.append([ad[field] for field in fields])
+        finally:
+            trident.ion_balance.ion_field_cell_budget = None
+    for field, value, sliced_value in zip(fields, *values):
+        assert value.units == sliced_value.units
+        np.testing.assert_allclose(sliced_value, value, rtol=1e-12,
+                                   err_msg=str(field))
+
+    # rays held in memory are sliced in the same way
+    fields = fields[:2]
+    values = []
+    for cell_budget in [None, 100]:
+        ds, ray = _fake_ds_and_memory_ray()
+        add_ion_number_density_field('O', 6, ray)
+        trident.ion_balance.ion_field_cell_budget = cell_budget
+        try:
+            values.append([ray[field] for field in fields])
+        finally:
+            trident.ion_balance.ion_field_cell_budget = None
+    for field, value, sliced_value in zip(fields, *values):
+        np.testing.assert_allclose(sliced_value, value, rtol=1e-12,
+                                   err_msg=str(field))
+
+def test_table_interpolator():
+    """
+    Test the N-linear interpolator against yt's trilinear interpolator
+    """
+    table = IonBalanceTable(atom='O', ions=[6])
+    bds = [par.astype("=f8") for par in table.parameters]
+    inputs = dict([(name, np.random.uniform(par[0] - 1, par[-1] + 1, 1000))
+                   for name, par in zip('xyz', bds)])
+    interp = TrilinearFieldInterpolator(table.ion_fraction[0], bds, 'xyz',
+                                        truncate=True)
+    values = TableInterpolator(table.parameters)(
+        table.ion_fraction[0], [inputs[name] for name in 'xyz'])
+    np.testing.assert_allclose(values, interp(inputs), rtol=1e-10)
+
+    try:
+        TableInterpolator(table.parameters, truncate=False)(
+            table.ion_fraction[0], [inputs[name] for name in 'xyz'])
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("Values off the table were not caught.")
+
+def test_table_interpolator_find_bins():
+    """
+    Test that bins found along nearly evenly spaced axes match those
+    from a binary search, including for NaN values
+    """
+    rng = np.random.RandomState(1)
+    bins = np.cumsum(1 + rng.uniform(-5e-4, 5e-4, 3001))
+    values = rng.uniform(bins[0] - 10, bins[-1] + 10, 100000)
+    values[:10] = np.nan
+    values[10:20] = bins[rng.randint(0, bins.size, 10)]
+    interpolator = TableInterpolator([bins])
+    assert interpolator._spacing[0] is not None
+    expected = np.clip(np.digitize(values, bins) - 1, 0, bins.size - 2)
+    np.testing.assert_array_equal(interpolator._find_bins(0, values),
+                                  expected)
+
+def test_ion_fraction_field_4d_table():
+    """
+    Test ion fractions from a table with a fourth parameter
+    """
+    dirpath = tempfile.mkdtemp()
+    filename = os.path.join(dirpath, 'table_4d.h5')
+    table = IonBalanceTable(atom='O')
+    metallicity = np.array([0., 0.5, 1.])
+    with h5py.File(filename, 'w') as f:
+        # the same values for every metallicity
+        data = np.repeat(table.ion_fraction[:, :, :, np.newaxis, :],
+                         metallicity.size, axis=3)
+        dataset = f.create_dataset('O', data=data)
+        dataset.attrs['Parameter1'] = table.parameters[0]
+        dataset.attrs['Parameter2'] = table.parameters[1]
+        dataset.attrs['Parameter3'] = metallicity
+        dataset.attrs['Temperature'] = table.parameters[2]
+        dataset.attrs['Parameter1_field'] = 'log_nH'
+        dataset.attrs['Parameter2_field'] = 'redshift'
+        dataset.attrs['Parameter3_field'] = 'metallicity'
+
+    ds = fake_random_ds(8, fields=("density", "velocity_x", "velocity_y",
+                                   "velocity_z", "temperature", "metallicity"),
+                           units= ('g/cm**3', 'cm/s', 'cm/s',
+                                   'cm/s', 'K', ''))
+    add_ion_fraction_field('O', 6, ds)
+    add_ion_fraction_field('O', 6, ds, ionization_table=filename,
+                           field_suffix=True)
+    ad = ds.all_data()
+    np.testing.assert_allclose(ad['gas', 'O_p5_ion_fraction_table_4d'],
+                               ad['gas', 'O_p5_ion_fraction'], rtol=1e-12)
+    shutil.rmtree(dirpath)
+
 def test_add_ion_fraction_field_to_grid_ds():
     """
     Test to add various ion fields
@@ -55,6 +268,76 @@ def test_add_ion_fraction_field_to_grid_ds():
     SlicePlot(ds, 'x', field).save(dirpath)
     shutil.rmtree(dirpath)
 
+def test_ion_fraction_field_interpolation():
+    """
+    Test that ion fractions of several ions interpolated with shared
+    weights match those from yt's trilinear interpolator
+    """
+    ds = fake_random_ds(8, fields=("density", "velocity_x", "velocity_y",
+                                   "velocity_z", "temperature", "metallicity"),
+                           units= ('g/cm**3', 'cm/s', 'cm/s',
+                                   'cm/s', 'K', ''))
+    ad = ds.all_data()
+    for ion in [5, 6, 7]:
+        add_ion_fraction_field('O', ion, ds)
+        field = 'O_p%d_ion_fraction' % (ion-1)
+        bds = [par.astype("=f8") for par in table_store[field]['parameters']]
+        interp = TrilinearFieldInterpolator(table_store[field]['fraction'], bds,
+                                            [("gas", "log_nH"),
+                                             ("gas", "redshift"),
+                                             ("gas", "log_T")],
+                                            truncate=True)
+        fraction = np.power(10, interp(ad))
+        fraction[fraction <= 1e-9] = 0.0
+        np.testing.assert_allclose(ad['gas', field], fraction, rtol=1e-10)
+
+def test_ion_fraction_block():
+    """
+    Test that ion fractions interpolated for all ions of an element
+    together match those interpolated for one ion
+    """
+    ds = fake_random_ds(8, fields=("density", "velocity_x", "velocity_y",
+                                   "velocity_z", "temperature", "metallicity"),
+                           units= ('g/cm**3', 'cm/s', 'cm/s',
+                                   'cm/s', 'K', ''))
+    add_ion_fraction_field('Ne', 8, ds)
+    field = ('gas', 'Ne_p7_ion_fraction')
+    fraction = ds.all_data()[field]
+    ds = fake_random_ds(8, fields=("density", "velocity_x", "velocity_y",
+                                   "velocity_z", "temperature", "metallicity"),
+                           units= ('g/cm**3', 'cm/s', 'cm/s',
+                                   'cm/s', 'K', ''))
+    add_ion_fields(ds, ['Ne'])
+    ad = ds.all_data()
+    np.testing.assert_array_equal(ad[field], fraction)
+    assert (ad['gas', 'Ne_p0_ion_fraction'] != fraction).any()
+
+def test_ion_interpolation_cache():
+    """
+    Test that interpolation results stored on a data object are bounded
+    in number and released with the field arrays they were made from
+    """
+    class Data(object):
+        pass
+    data = Data()
+    cache = trident.ion_balance._get_chunk_cache(data)["blocks"]
+    inputs = [np.arange(3.)]
+    calls = []
+
+    def _double(value):
+        calls.append(value)
+        return 2 * value
+    for i in range(5):
+        trident.ion_balance._get_cached(cache, 2, i, inputs, _double, i)
+    assert list(cache.keys()) == [3, 4]
+    assert trident.ion_balance._get_cached(cache, 2, 4, inputs,
+                                           _double, 4) == 8
+    assert len(calls) == 5
+    del inputs[:]
+    assert len(cache) == 0
+    trident.ion_balance._clear_chunk_cache(data)
+    assert data._ion_interpolation_cache is None
+
 def test_add_ion_number_density_field_to_grid_ds():
     """
     Test to add various ion fields
@@ -195,6 +478,65 @@ def test_add_ion_fields_to_grid_ds():
         SlicePlot(ds, 'x', field).save(dirpath)
     shutil.rmtree(dirpath)
 
+def _fake_ds_and_memory_ray():
+    """
+    Make a fake dataset and a MemoryRay holding the same cells
+    """
+    ds = fake_random_ds(8, fields=("density", "velocity_x", "velocity_y",
+                                   "velocity_z", "temperature", "metallicity"),
+                           units= ('g/cm**3', 'cm/s', 'cm/s',
+                                   'cm/s', 'K', ''))
+    ad = ds.all_data()
+    ray = MemoryRay(dict([(field, ad['gas', field].ravel())
+                          for field in ['density', 'temperature',
+                                        'metallicity']]))
+    return ds, ray
+
+def test_add_ion_fields_to_memory_ray():
+    """
+    Test that add_ion_fields works on a MemoryRay and gives the same
+    values as on a dataset
+    """
+    ds, ray = _fake_ds_and_memory_ray()
+    add_ion_fields(ds, ['O', 'H I'])
+    add_ion_fields(ray, ['O', 'H I'])
+    ad = ds.all_data()
+    for field in ['O_p5_ion_fraction', 'O_p5_number_density', 'O_p5_density',
+                  'H_ion_fraction', 'H_p0_number_density',
+                  'H_number_density']:
+        assert ('gas', field) in ray.derived_field_list
+        np.testing.assert_allclose(ray['gas', field].d,
+                                   ad['gas', field].ravel().d, rtol=1e-10,
+                                   err_msg=field)
+
+def test_add_ion_fields_deferred_tables():
+    """
+    Test that add_ion_fields reads no ion tables until the fields are used
+    """
+    ds = fake_random_ds(8, fields=("density", "velocity_x", "velocity_y",
+                                   "velocity_z", "temperature", "metallicity"),
+                           units= ('g/cm**3', 'cm/s', 'cm/s',
+                                   'cm/s', 'K', ''))
+    table_store.clear()
+    add_ion_fields(ds, ['Fe', 'H I'])
+    assert table_store.nbytes == 0
+    for field in ['Fe_p1_ion_fraction', 'Fe_p1_number_density',
+                  'Fe_p1_density', 'Fe_p1_mass', 'H_ion_fraction',
+                  'H_number_density']:
+        assert ('gas', field) in ds.derived_field_list
+
+    ds2 = fake_random_ds(8, fields=("density", "velocity_x", "velocity_y",
+                                    "velocity_z", "temperature", "metallicity"),
+                            units= ('g/cm**3', 'cm/s', 'cm/s',
+                                    'cm/s', 'K', ''))
+    add_ion_mass_field('Fe', 2, ds2)
+    add_ion_mass_field('H', 1, ds2)
+    ad = ds.all_data()
+    ad2 = ds2.all_data()
+    for field in ['Fe_p1_mass', 'Fe_p1_density', 'H_number_density']:
+        np.testing.assert_array_equal(ad['gas', field], ad2['gas', field])
+    assert table_store.nbytes > 0
+
 def test_add_all_ion_fields_to_grid_ds():
     """
     Test to add various ion fields
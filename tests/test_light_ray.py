@@ -13,18 +13,41 @@ Unit test for the light_ray analysis module
 
 import numpy as np
 
+from numpy.testing import \
+    assert_allclose
 from yt.convenience import \
     load
 from yt.testing import \
     assert_array_equal, \
-    assert_almost_equal
+    assert_almost_equal, \
+    assert_rel_equal, \
+    fake_random_ds
+from yt.units.yt_array import \
+    YTArray
+from yt.utilities.cosmology import \
+    Cosmology
+from yt.utilities.physical_constants import \
+    speed_of_light_cgs
 from trident import \
+    DatasetCache, \
+    dataset_cache, \
     LightRay, \
+    load_light_ray_solutions, \
     make_simple_ray
+from trident.cosmology_table import \
+    get_cosmology_table
+from trident.dataset_cache import \
+    DatasetPrefetcher
+from trident.light_ray import \
+    _get_peculiar_velocity, \
+    expand_compacted_field, \
+    load_merge_map, \
+    non_periodic_ray
 from trident.testing import \
     answer_test_data_dir, \
     TempDirTest
 import os
+import threading
 
 COSMO_PLUS = os.path.join(answer_test_data_dir,
                           "enzo_cosmology_plus/AMRCosmology.enzo")
@@ -61,6 +84,24 @@ class LightRayTest(TempDirTest):
         ds = load('lightray.h5')
         compare_light_ray_solutions(lr, ds)
 
+    def test_light_ray_cosmo_batch(self):
+        """
+        This test generates several cosmological light rays at once and
+        compares them to light rays generated one at a time
+        """
+        fields = ['temperature', 'density', 'H_number_density']
+        seeds = [1234567, 7654321]
+        lr = LightRay(COSMO_PLUS, 'Enzo', 0.0, 0.03)
+        rays = lr._make_compound_rays(seeds, fields=fields[:])
+
+        for seed, ray in zip(seeds, rays):
+            lr = LightRay(COSMO_PLUS, 'Enzo', 0.0, 0.03)
+            lr.make_light_ray(seed=seed, fields=fields[:],
+                              data_filename='lightray.h5')
+            ds = load('lightray.h5')
+            for field in ['density', 'dl', 'redshift']:
+                assert_array_equal(ray[field].d, ds.r[field].d)
+
     def test_light_ray_cosmo_nested(self):
         """
         This test generates a cosmological light ray confing the ray to a subvolume
@@ -141,3 +182,296 @@ class LightRayTest(TempDirTest):
         ray = make_simple_ray(ds, start_position=ds.domain_left_edge, end_position=ds.domain_right_edge, lines=['H'])
         assert_almost_equal(ray.r['redshift'][0], 0.00489571, decimal=8)
         assert_almost_equal(ray.r['redshift'][-1], -0.00416831, decimal=8)
+
+    def test_dataset_cache(self):
+        """
+        Tests that datasets loaded through the dataset cache are reused
+        and evicted in least-recently-used order.
+        """
+        cache = DatasetCache(max_size=1)
+        ds1 = cache.load(COSMO_PLUS_SINGLE)
+        assert cache.load(COSMO_PLUS_SINGLE) is ds1
+        assert cache.hits == 1 and cache.misses == 1
+        assert COSMO_PLUS_SINGLE in cache
+
+        ds2 = cache.load(GIZMO_COSMO_SINGLE)
+        assert len(cache) == 1
+        assert COSMO_PLUS_SINGLE not in cache
+        assert cache.load(GIZMO_COSMO_SINGLE) is ds2
+
+        assert cache.evict(GIZMO_COSMO_SINGLE)
+        assert len(cache) == 0
+        assert cache.process_rss() > 0
+        cache.info()
+
+        # the shared cache is off by default
+        lr1 = LightRay(COSMO_PLUS_SINGLE)
+        lr2 = LightRay(COSMO_PLUS_SINGLE)
+        assert lr1.ds is not lr2.ds
+
+        # once enabled, rays made from the same filename share one dataset
+        dataset_cache.max_size = 2
+        try:
+            lr1 = LightRay(COSMO_PLUS_SINGLE)
+            lr2 = LightRay(COSMO_PLUS_SINGLE)
+            assert lr1.ds is lr2.ds
+        finally:
+            dataset_cache.max_size = 0
+            dataset_cache.clear()
+
+    def test_non_periodic_ray_min_level(self):
+        """
+        Tests that rays found with the grid level check only pass through
+        cells at or above the minimum level.
+        """
+        ds = load(COSMO_PLUS_SINGLE)
+        left_edge = ds.domain_left_edge.to('unitary')
+        right_edge = ds.domain_right_edge.to('unitary')
+        ray_length = ds.quan(0.05, 'unitary')
+        my_random = np.random.RandomState(1234)
+        for i in range(3):
+            start, end = non_periodic_ray(ds, left_edge, right_edge,
+                                          ray_length, min_level=1,
+                                          my_random=my_random)
+            ray = ds.ray(start, end)
+            assert (ray['grid_level'] >= 1).all()
+
+    def test_peculiar_velocity(self):
+        """
+        Tests that the line of sight velocity and doppler redshift match
+        those found from yt's velocity fields, with and without a bulk
+        velocity.
+        """
+        ds = load(COSMO_PLUS_SINGLE)
+        start = ds.arr([0.1, 0.2, 0.3], 'unitary')
+        end = ds.arr([0.8, 0.7, 0.6], 'unitary')
+        line_of_sight = (start - end).d
+        line_of_sight /= np.sqrt((line_of_sight**2).sum())
+        c = speed_of_light_cgs.d
+        for bulk_velocity in [None, ds.arr([3e7, -1e7, 2e7], 'cm/s')]:
+            ray = ds.ray(start, end)
+            if bulk_velocity is not None:
+                ray.set_field_parameter('bulk_velocity', bulk_velocity)
+            velocity = [ray['relative_velocity_%s' % ax].in_cgs()
+                        for ax in 'xyz']
+            velocity_los, redshift_dopp = \
+              _get_peculiar_velocity(line_of_sight, *velocity)
+
+            # the calculation from the velocity_magnitude field
+            velocity_magnitude = ray['velocity_magnitude'].in_cgs().d
+            old_los = line_of_sight.dot([v.d for v in velocity])
+            cos_theta = np.nan_to_num(old_los / velocity_magnitude)
+            old_redshift_dopp = \
+              (1 + velocity_magnitude * cos_theta / c) / \
+              np.sqrt(1 - velocity_magnitude**2 / c**2) - 1
+            assert_allclose(velocity_los.in_cgs().d, old_los, rtol=1e-12)
+            assert_allclose(redshift_dopp.d, old_redshift_dopp,
+                            rtol=1e-10, atol=1e-15)
+
+    def test_light_ray_cosmo_prefetch(self):
+        """
+        Tests that a compound ray made while prefetching datasets matches
+        one made without prefetching.
+        """
+        lr1 = LightRay(COSMO_PLUS, 'Enzo', 0.0, 0.03)
+        ray1 = lr1.make_light_ray(seed=1234567,
+                                  fields=['temperature', 'density'])
+        lr2 = LightRay(COSMO_PLUS, 'Enzo', 0.0, 0.03)
+        ray2 = lr2.make_light_ray(seed=1234567,
+                                  fields=['temperature', 'density'],
+                                  prefetch=2)
+        for field in ['temperature', 'density', 'dl']:
+            assert_array_equal(ray1.r[('gas', field)], ray2.r[('gas', field)])
+
+    def test_light_ray_cosmo_prefetch_error(self):
+        """
+        Tests that prefetching stops when making a compound ray fails.
+        """
+        def _fail(ds):
+            raise RuntimeError("Failing setup.")
+
+        n_threads = threading.active_count()
+        lr = LightRay(COSMO_PLUS, 'Enzo', 0.0, 0.03)
+        try:
+            lr.make_light_ray(seed=1234567, fields=['temperature'],
+                              setup_function=_fail, prefetch=2)
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("Setup function error was not raised.")
+        assert threading.active_count() == n_threads
+
+    def test_dataset_prefetcher(self):
+        """
+        Tests that the prefetcher yields datasets in order, holding them
+        itself rather than in the shared cache, and honors a memory budget.
+        """
+        filenames = [COSMO_PLUS_SINGLE, GIZMO_COSMO_SINGLE, COSMO_PLUS_SINGLE]
+        dataset_cache.max_size = 4
+        try:
+            datasets = list(DatasetPrefetcher(filenames, depth=4,
+                                              max_memory=0))
+            assert len(dataset_cache) == 0
+        finally:
+            dataset_cache.max_size = 0
+        assert [ds.basename for ds in datasets] == \
+          [os.path.basename(filename) for filename in filenames]
+        assert datasets[0] is not datasets[2]
+
+    def test_light_ray_compact(self):
+        """
+        Tests that compacting a light ray conserves path length and
+        column density and can be mapped back onto the original cells.
+        """
+        ds = load(COSMO_PLUS_SINGLE)
+        fields = ['temperature', 'density', 'H_number_density']
+        lr1 = LightRay(ds)
+        ray1 = lr1.make_light_ray(start_position=ds.domain_left_edge,
+                                  end_position=ds.domain_right_edge,
+                                  fields=fields[:])
+        lr2 = LightRay(ds)
+        ray2 = lr2.make_light_ray(start_position=ds.domain_left_edge,
+                                  end_position=ds.domain_right_edge,
+                                  fields=fields[:], compact=True)
+        dl1 = ray1.r['dl']
+        dl2 = ray2.r['dl']
+        cell_count = ray2.r['cell_count']
+        assert dl2.size <= dl1.size
+        assert cell_count.sum() == dl1.size
+        assert_almost_equal(dl2.sum() / dl1.sum(), 1, decimal=12)
+        nH1 = (ray1.r['H_number_density'] * dl1).sum()
+        nH2 = (ray2.r['H_number_density'] * dl2).sum()
+        assert_almost_equal(nH2 / nH1, 1, decimal=12)
+        assert_array_equal(
+            expand_compacted_field(ray2.r['density'], cell_count),
+            ray1.r['density'])
+        assert_almost_equal(
+            expand_compacted_field(dl2, cell_count,
+                                   weights=lr2.merge_map['dl']) / dl1,
+            np.ones(dl1.size), decimal=12)
+
+        # the merge map is kept with the returned ray and in the ray file
+        assert_array_equal(ray2.merge_map['dl'], lr2.merge_map['dl'])
+        ray3 = lr2.make_light_ray(start_position=ds.domain_left_edge,
+                                  end_position=ds.domain_right_edge,
+                                  fields=fields[:], compact=True,
+                                  data_filename='compact_ray.h5')
+        merge_map = load_merge_map('compact_ray.h5')
+        assert_array_equal(merge_map['cell_count'], cell_count)
+        assert_array_equal(merge_map['dl'], ray2.merge_map['dl'])
+        assert_array_equal(ray3.merge_map['dl'], merge_map['dl'])
+
+    def test_light_ray_no_warm_cells(self):
+        """
+        Tests that a ray held in memory with no cells of nonzero
+        temperature comes back empty rather than raising an error.
+        """
+        ds = fake_random_ds(8, fields=("density", "temperature"),
+                            units=("g/cm**3", "K"))
+        lr = LightRay(ds)
+        ray = lr._make_memory_ray({'temperature': YTArray([0., 0.], 'K'),
+                                   'dl': YTArray([1., 2.], 'cm')})
+        assert len(ray) == 0
+        assert ray.r['dl'].size == 0
+
+    def test_light_ray_compact_periodic(self):
+        """
+        Tests that compacting a light ray does not merge cells across a
+        periodic boundary.
+        """
+        ds = load(COSMO_PLUS_SINGLE)
+        start = ds.arr([0.7, 0.5, 0.5], 'unitary')
+        end = ds.arr([1.3, 0.5, 0.5], 'unitary')
+        lr1 = LightRay(ds)
+        ray1 = lr1.make_light_ray(start_position=start, end_position=end,
+                                  fields=['density'])
+        lr2 = LightRay(ds)
+        ray2 = lr2.make_light_ray(start_position=start, end_position=end,
+                                  fields=['density'], compact=True)
+        cell_count = ray2.r['cell_count'].d.astype(np.int64)
+        lixel_start = np.cumsum(cell_count) - cell_count
+        wraps = np.where(np.diff(ray1.r['l'].d) <= 0)[0] + 1
+        assert wraps.size > 0
+        assert np.in1d(wraps, lixel_start).all()
+
+    def test_light_ray_redshift_from_distance(self):
+        """
+        Tests that redshifts found from the comoving distance table are
+        close to those from the linear redshift-distance approximation.
+        """
+        ds = load(COSMO_PLUS_SINGLE)
+        lr1 = LightRay(ds)
+        ray1 = lr1.make_light_ray(start_position=ds.domain_left_edge,
+                                  end_position=ds.domain_right_edge,
+                                  fields=['density'])
+        lr2 = LightRay(ds)
+        ray2 = lr2.make_light_ray(start_position=ds.domain_left_edge,
+                                  end_position=ds.domain_right_edge,
+                                  fields=['density'],
+                                  redshift_from_distance=True)
+        assert_almost_equal(ray2.r['redshift'][0], ray1.r['redshift'][0],
+                            decimal=12)
+        assert_almost_equal(ray2.r['redshift'], ray1.r['redshift'],
+                            decimal=5)
+
+def test_cosmology_table():
+    """
+    Tests that the comoving distance table agrees with integrating the
+    cosmology directly.
+    """
+    co = Cosmology()
+    table = get_cosmology_table(co)
+    for z_i, z_f in [(0., 0.01), (0.5, 2.)]:
+        assert_rel_equal(table.comoving_radial_distance(z_i, z_f),
+                         co.comoving_radial_distance(z_i, z_f), 7)
+    assert get_cosmology_table(Cosmology()) is table
+    assert_almost_equal(table.redshift_along_segment(1., 0.5, [0., 1.]),
+                        [1., 0.5], decimal=12)
+
+    # cosmologies differing only in the Hubble constant get separate tables
+    co2 = Cosmology(hubble_constant=0.5)
+    table2 = get_cosmology_table(co2)
+    assert table2 is not table
+    assert_rel_equal(table2.comoving_radial_distance(0., 0.5),
+                     co2.comoving_radial_distance(0., 0.5), 7)
+
+class LightRaySolutionTest(TempDirTest):
+
+    def test_light_ray_solutions(self):
+        """
+        Tests that rays made from saved and reloaded light ray solutions
+        match rays made directly from the same seeds.
+        """
+        seeds = [1234567, 7654321]
+        fields = ['temperature', 'density']
+        lr = LightRay(COSMO_PLUS, 'Enzo', 0.0, 0.03)
+        lr.make_light_ray_solutions(seeds, filename='solutions.h5')
+
+        loaded_seeds, solutions = load_light_ray_solutions(
+            'solutions.h5', indices=[1])
+        assert loaded_seeds == seeds[1:]
+        ray1 = lr.make_light_ray(light_ray_solution=solutions[0],
+                                 fields=fields[:])
+
+        lr2 = LightRay(COSMO_PLUS, 'Enzo', 0.0, 0.03)
+        ray2 = lr2.make_light_ray(seed=seeds[1], fields=fields[:])
+        for field in ['temperature', 'density', 'dl', 'redshift']:
+            assert_array_equal(ray1.r[('gas', field)], ray2.r[('gas', field)])
+
+    def test_light_ray_solutions_coherent(self):
+        """
+        Tests that solutions made for many seeds at once match those made
+        for each seed by make_light_ray when using box coherence.
+        """
+        seeds = [1, 22, 333]
+        lr = LightRay(COSMO_PLUS, 'Enzo', 0.0, 0.1,
+                      minimum_coherent_box_fraction=0.5)
+        solutions = lr.make_light_ray_solutions(seeds)
+        for seed, solution in zip(seeds, solutions):
+            lr2 = LightRay(COSMO_PLUS, 'Enzo', 0.0, 0.1,
+                           minimum_coherent_box_fraction=0.5)
+            lr2.make_light_ray(seed=seed, fields=['density'])
+            for my_segment, ray_segment in \
+              zip(solution, lr2.light_ray_solution):
+                for key in ['start', 'end']:
+                    assert_array_equal(my_segment[key], ray_segment[key])
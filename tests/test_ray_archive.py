@@ -0,0 +1,116 @@
+"""
+Tests for RayArchive and MemoryRay
+
+"""
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2017, Trident Development Team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+#-----------------------------------------------------------------------------
+
+import numpy as np
+from numpy.testing import \
+    assert_array_equal
+import trident as tri
+from yt.units.yt_array import \
+    YTArray
+import tempfile
+import shutil
+import os
+
+def test_ray_archive_round_trip():
+    """
+    Test that rays added to an archive come back with the same field values
+    and that spectra can be made from the archived rays.
+    """
+    dirpath = tempfile.mkdtemp()
+    archive_filename = os.path.join(dirpath, 'rays.h5')
+    rays = []
+    for i, temperature in enumerate([1e4, 1e5]):
+        filename = os.path.join(dirpath, 'ray%d.h5' % i)
+        rays.append(tri.make_onezone_ray(temperature=temperature,
+                                         filename=filename))
+
+    with tri.RayArchive(archive_filename, mode='w') as archive:
+        for i, ray in enumerate(rays):
+            archive.add_ray(ray, seed=i)
+
+    archive = tri.RayArchive(archive_filename)
+    assert len(archive) == 2
+    for i, ray in enumerate(rays):
+        archived_ray = archive[i]
+        assert archived_ray.parameters['seed'] == i
+        for field in ['temperature', 'density', 'dl']:
+            assert_array_equal(archived_ray[('gas', field)].d,
+                               ray.r[('gas', field)].d)
+
+    sg = tri.SpectrumGenerator(lambda_min=1200, lambda_max=1230, dlambda=0.1)
+    spectra = list(sg.make_spectra(archive, lines=['H I 1216']))
+    assert len(spectra) == 2
+    assert np.all(spectra[0][2] <= 1)
+    archive.close()
+    shutil.rmtree(dirpath)
+
+def test_ray_archive_empty_ray():
+    """
+    Test that an empty ray can be archived before and among other rays.
+    """
+    dirpath = tempfile.mkdtemp()
+    archive_filename = os.path.join(dirpath, 'rays.h5')
+    ray = tri.make_onezone_ray(filename=os.path.join(dirpath, 'ray.h5'))
+    empty_ray = tri.MemoryRay(dict([(field, YTArray(np.empty(0), ""))
+                                    for field in ['temperature', 'dl']]))
+
+    with tri.RayArchive(archive_filename, mode='w') as archive:
+        archive.add_ray(empty_ray)
+        archive.add_ray(ray)
+        archive.add_ray(empty_ray)
+
+    archive = tri.RayArchive(archive_filename)
+    assert len(archive) == 3
+    assert archive[0]['gas', 'dl'].size == 0
+    assert archive[2]['gas', 'dl'].size == 0
+    assert_array_equal(archive[1]['gas', 'temperature'].d,
+                       ray.r['gas', 'temperature'].d)
+    archive.close()
+    shutil.rmtree(dirpath)
+
+def test_ray_archive_merge_map():
+    """
+    Test that the merge maps of compacted rays are kept in an archive.
+    """
+    dirpath = tempfile.mkdtemp()
+    archive_filename = os.path.join(dirpath, 'rays.h5')
+    merge_maps = [{'cell_count': np.array([2, 1, 3]),
+                   'dl': YTArray([1., 2., 3., 4., 5., 6.], 'cm')},
+                  None,
+                  {'cell_count': np.array([1, 2]),
+                   'dl': YTArray([1e-5, 2e-5, 3e-5], 'km')}]
+    rays = []
+    for merge_map in merge_maps:
+        n_lixels = 2 if merge_map is None else merge_map['cell_count'].size
+        rays.append(tri.MemoryRay(
+            {'temperature': YTArray(np.full(n_lixels, 1e4), 'K'),
+             'dl': YTArray(np.ones(n_lixels), 'cm')},
+            merge_map=merge_map))
+
+    with tri.RayArchive(archive_filename, mode='w') as archive:
+        for ray in rays[:2]:
+            archive.add_ray(ray)
+    # add the last ray after reopening the archive
+    with tri.RayArchive(archive_filename, mode='a') as archive:
+        archive.add_ray(rays[2])
+
+    archive = tri.RayArchive(archive_filename)
+    assert archive[1].merge_map is None
+    for i in [0, 2]:
+        merge_map = archive[i].merge_map
+        assert_array_equal(merge_map['cell_count'],
+                           merge_maps[i]['cell_count'])
+        assert_array_equal(merge_map['dl'].in_units('cm').d,
+                           merge_maps[i]['dl'].in_units('cm').d)
+    archive.close()
+    shutil.rmtree(dirpath)
@@ -11,11 +11,21 @@ Tests for ion balance code
 # The full license is in the file LICENSE, distributed with this software.
 #-----------------------------------------------------------------------------
 
+from numpy.testing import \
+    assert_allclose, \
+    assert_array_equal
+from yt.convenience import \
+    load
 import trident as tri
+from trident.testing import \
+    answer_test_data_dir
 import tempfile
 import shutil
 import os
 
+COSMO_PLUS_SINGLE = os.path.join(answer_test_data_dir,
+                                 "enzo_cosmology_plus/RD0009/RD0009")
+
 def test_create_simple_grid_ray_with_lines():
     """
     Test to create a simple ray from a grid dataset using the lines kwargs
@@ -33,3 +43,54 @@ def test_create_simple_grid_ray_with_lines():
     sg.make_spectrum(ray, lines=['H', 'C IV'])
     sg.plot_spectrum(os.path.join(dirpath, 'spec.png'))
     shutil.rmtree(dirpath)
+
+def test_create_simple_rays_matches_simple_ray():
+    """
+    Test that making several rays at once gives the same results as making
+    each one with make_simple_ray.
+    """
+    dirpath = tempfile.mkdtemp()
+    ds = tri.make_onezone_dataset()
+    starts = ds.arr([[0., 0., 0.], [0., 0.5, 0.2], [1., 0.3, 0.]], 'unitary')
+    ends = ds.arr([[1., 1., 1.], [1., 0.5, 0.2], [0.2, 0.9, 1.]], 'unitary')
+    archive_filename = os.path.join(dirpath, 'rays.h5')
+    archive = tri.make_simple_rays(ds, starts, ends, lines=['H'],
+                                   data_filename=archive_filename)
+    assert len(archive) == len(starts)
+    for i in range(len(starts)):
+        filename = os.path.join(dirpath, 'ray%d.h5' % i)
+        ray = tri.make_simple_ray(ds, start_position=starts[i],
+                                  end_position=ends[i],
+                                  data_filename=filename, lines=['H'])
+        for field in ['density', 'temperature', 'dl', 'redshift']:
+            assert_allclose(archive[i][field].d, ray.r[field].d)
+    archive.close()
+    shutil.rmtree(dirpath)
+
+def test_create_simple_rays_matches_simple_ray_amr():
+    """
+    Test that rays made at once through a multi-grid AMR dataset match
+    those from make_simple_ray, including periodic rays, and that the
+    field parameters of the grids are left as they were.
+    """
+    ds = load(COSMO_PLUS_SINGLE)
+    grid = ds.index.grids[0]
+    bulk_velocity = grid.get_field_parameter('bulk_velocity').copy()
+    starts = ds.arr([[0.1, 0.2, 0.3], [0.5, 0.5, 0.], [0.9, 0.1, 0.7]],
+                    'unitary')
+    ends = ds.arr([[0.8, 0.7, 0.6], [0.5, 0.5, 1.], [1.3, 0.6, 1.2]],
+                  'unitary')
+    rays = tri.make_simple_rays(
+        ds, starts, ends, fields=['density', 'temperature'],
+        field_parameters={'bulk_velocity': ds.arr([1e7, 0, 0], 'cm/s')})
+    assert_array_equal(grid.get_field_parameter('bulk_velocity'),
+                       bulk_velocity)
+    for i in range(len(starts)):
+        ray = tri.make_simple_ray(
+            ds, start_position=starts[i], end_position=ends[i],
+            fields=['density', 'temperature'], in_memory=True,
+            field_parameters={'bulk_velocity': ds.arr([1e7, 0, 0], 'cm/s')})
+        assert rays[i]['density'].size > 1
+        for field in ['density', 'temperature', 'dl', 'l', 'redshift',
+                      'velocity_los']:
+            assert_allclose(rays[i][field].d, ray[field].d, rtol=1e-10)
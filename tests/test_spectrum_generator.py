@@ -16,6 +16,11 @@ from trident.utilities import make_onezone_ray
 from trident.spectrum_generator import \
     SpectrumGenerator, \
     load_spectrum
+from trident.absorption_spectrum.line_observables import \
+    load_line_observables
+from yt.convenience import \
+    load
+import h5py
 import tempfile
 import shutil
 import os
@@ -52,6 +57,27 @@ def test_save_load_spectrum_hdf5():
     sg.plot_spectrum(filename=os.path.join(dirpath, 'spec.png'))
     shutil.rmtree(dirpath)
 
+def test_save_load_line_observables():
+    """
+    Test that we can save line observables with a spectrum and load them
+    """
+    dirpath = tempfile.mkdtemp()
+    filename = os.path.join(dirpath, 'ray.h5')
+    ray = make_onezone_ray(column_densities={'H_p0_number_density':1e21},
+                                   filename=filename)
+    sg = SpectrumGenerator(lambda_min=1200, lambda_max=1300, dlambda=0.5)
+    sg.make_spectrum(ray, lines=['Ly a'], store_observables=True)
+    spec_filename = os.path.join(dirpath, 'spec.h5')
+    sg.save_spectrum(spec_filename, observables=True)
+    obs = load_line_observables(spec_filename)
+    for label, obs_dict in sg.line_observables_dict.items():
+        assert label in obs
+        line_obs = obs[label]
+        for field in obs_dict:
+            assert (line_obs[field] == obs_dict[field]).all()
+    obs.close()
+    shutil.rmtree(dirpath)
+
 def test_save_load_spectrum_fits():
     """
     Test that we can save and load spectra in the FITS format
@@ -63,11 +89,37 @@ def test_save_load_spectrum_fits():
     sg = SpectrumGenerator(lambda_min=1200, lambda_max=1300, dlambda=0.5)
     sg.make_spectrum(ray, lines=['Ly a'])
     sg.save_spectrum(os.path.join(dirpath, 'spec.fits'))
+    flux_error = sg.error_func(sg.flux_field).astype('float32')
     del(sg)
     sg = load_spectrum(os.path.join(dirpath, 'spec.fits'))
+    # columns keep the precision they were saved in
+    assert sg.flux_field.dtype.itemsize == 4
+    assert (sg.flux_error_field == flux_error).all()
     sg.plot_spectrum(filename=os.path.join(dirpath, 'spec.png'))
     shutil.rmtree(dirpath)
 
+def test_save_load_spectrum_fits_multi():
+    """
+    Test that we can save several double precision spectra to one FITS file
+    and load each one back with its tau field
+    """
+    dirpath = tempfile.mkdtemp()
+    filename = os.path.join(dirpath, 'ray.h5')
+    ray = make_onezone_ray(column_densities={'H_p0_number_density':1e21},
+                                   filename=filename)
+    spec_filename = os.path.join(dirpath, 'spec.fits')
+    taus = []
+    for i, lines in enumerate([['Ly a'], ['Ly b']]):
+        sg = SpectrumGenerator(lambda_min=1000, lambda_max=1300, dlambda=0.5)
+        sg.make_spectrum(ray, lines=lines)
+        sg.save_spectrum(spec_filename, dtype='float64', append=True,
+                         header={'SPECNUM': i})
+        taus.append(sg.tau_field.copy())
+    for i in range(len(taus)):
+        sg = load_spectrum(spec_filename, extension=i+1)
+        assert (sg.tau_field == taus[i]).all()
+    shutil.rmtree(dirpath)
+
 def test_create_spectrum_all_lines():
     """
     Test that we can create a basic spectrum with all available lines
@@ -107,8 +159,8 @@ def test_create_spectrum_H_lines_no_continuum():
 
 def test_input_types():
     """
-    Test that spectra can be generated from ray file, dataset, or
-    data container.
+    Test that spectra can be generated from ray file, dataset,
+    data container, or in-memory ray.
     """
 
     dirpath = tempfile.mkdtemp()
@@ -132,6 +184,40 @@ def test_input_types():
     spectra.append(sg.flux_field[:])
     assert (spectra[0] == spectra[2]).all()
 
+    # from in-memory ray
+    sg.make_spectrum(make_onezone_ray(filename=None),
+                     lines=['H I'], ly_continuum=False)
+    spectra.append(sg.flux_field[:])
+    assert (spectra[0] == spectra[3]).all()
+
     plot_spectrum(sg.lambda_field, spectra,
                   filename=os.path.join(dirpath, 'spec.png'))
     shutil.rmtree(dirpath)
+
+def test_store_ion_fields():
+    """
+    Test that ion fields stored in a ray file are read back from disk
+    and give the same spectrum.
+    """
+
+    dirpath = tempfile.mkdtemp()
+    filename = os.path.join(dirpath, 'ray.h5')
+    make_onezone_ray(filename=filename)
+
+    sg = SpectrumGenerator(lambda_min=1000, lambda_max=1300, dlambda=0.5)
+    sg.make_spectrum(filename, lines=['H I', 'O VI'], ly_continuum=False,
+                     store_ion_fields=True)
+    flux = sg.flux_field[:]
+
+    with h5py.File(filename, 'r') as f:
+        for field in ['H_number_density', 'O_p5_number_density']:
+            assert field in f['grid']
+            assert f['grid'][field].attrs['units'] == 'cm**-3'
+            assert 'ionization_table' in f['grid'][field].attrs
+
+    ray = load(filename)
+    assert ('grid', 'O_p5_number_density') in ray.field_list
+    sg = SpectrumGenerator(lambda_min=1000, lambda_max=1300, dlambda=0.5)
+    sg.make_spectrum(ray, lines=['H I', 'O VI'], ly_continuum=False)
+    assert (sg.flux_field == flux).all()
+    shutil.rmtree(dirpath)
@@ -30,11 +30,14 @@ from trident.config import \
     verify
 
 from trident.ion_balance import \
+    IonTableStore, \
+    TableInterpolator, \
     add_ion_fields, \
     add_ion_fraction_field, \
     add_ion_number_density_field, \
     add_ion_density_field, \
     add_ion_mass_field, \
+    make_flat_ion_table, \
     solar_abundance, \
     atomic_mass
 
@@ -62,14 +65,30 @@ from trident.utilities import \
 
 from trident.ray_generator import \
     make_simple_ray, \
-    make_compound_ray
+    make_simple_rays, \
+    make_compound_ray, \
+    make_compound_rays
 
 from trident.roman import \
     to_roman, \
     from_roman
 
 from trident.light_ray import \
-    LightRay
+    LightRay, \
+    load_light_ray_solutions
+
+from trident.memory_ray import \
+    MemoryRay
+
+from trident.dataset_cache import \
+    DatasetCache, \
+    dataset_cache
+
+from trident.ray_archive import \
+    RayArchive
+
+from trident.absorption_spectrum.line_observables import \
+    load_line_observables
 
 # Making installation path global
 path = trident_path()
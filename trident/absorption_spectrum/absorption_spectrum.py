@@ -16,6 +16,7 @@ AbsorptionSpectrum class and member functions.
 
 from yt.utilities.on_demand_imports import _h5py as h5py
 import numpy as np
+import os
 
 from yt.data_objects.data_containers import \
     YTDataContainer
@@ -35,11 +36,21 @@ from yt.utilities.physical_constants import \
 
 from trident.absorption_spectrum.absorption_line import \
     tau_profile
+from trident.absorption_spectrum.line_observables import \
+    write_line_observables
+from trident.ion_balance import \
+    _clear_chunk_cache
+from trident.memory_ray import \
+    MemoryRay
+from trident.ray_archive import \
+    RayArchive
 
 pyfits = _astropy.pyfits
 
 _bin_space_units = {'wavelength': 'angstrom',
                     'velocity': 'km/s'}
+_fits_formats = {np.dtype('float32'): 'E',
+                 np.dtype('float64'): 'D'}
 c_kms = speed_of_light_cgs.to('km/s')
 
 class AbsorptionSpectrum(object):
@@ -165,6 +176,7 @@ class AbsorptionSpectrum(object):
               self._create_lambda_field(lambda_min, lambda_max, n_lambda)
 
         self.flux_field = None
+        self.flux_error_field = None
         self.absorbers_list = None
         # a dictionary that will store spectral quantities for each index in the light ray
         self.line_observables_dict = None
@@ -349,12 +361,14 @@ class AbsorptionSpectrum(object):
 
         **Parameters**
 
-        :input_object: string, dataset, or data container
+        :input_object: string, dataset, data container, or MemoryRay
 
            If a string, the path to the ray dataset. As a dataset,
            this is the ray dataset loaded by yt. As a data container,
            this is a data object created from a ray dataset, such as
-           a cut region.
+           a cut region.  A :class:`~trident.MemoryRay` is a ray held
+           in memory, such as one read from a
+           :class:`~trident.RayArchive`.
 
         :output_file: optional, string
 
@@ -384,7 +398,8 @@ class AbsorptionSpectrum(object):
            if True, stores observable properties of each cell along the line of
            sight for each line, such as tau, column density, and thermal b.
            These quantities will be saved to the AbsorptionSpectrum
-           attribute: 'line_observables_dict'.
+           attribute: 'line_observables_dict'.  If output_file is an
+           HDF5 file, they will also be written to it.
            Default: False
 
         :subgrid_resolution: optional, int
@@ -457,6 +472,9 @@ class AbsorptionSpectrum(object):
         if isinstance(input_object, str):
             input_ds = load(input_object)
             field_data = input_ds.all_data()
+        elif isinstance(input_object, MemoryRay):
+            input_ds = input_object
+            field_data = input_object
         elif isinstance(input_object, Dataset):
             input_ds = input_object
             field_data = input_ds.all_data()
@@ -487,16 +505,20 @@ class AbsorptionSpectrum(object):
         self._add_continua_to_spectrum(field_data, use_peculiar_velocity,
                                        observing_redshift=observing_redshift,
                                        min_tau=min_tau)
+        # the ion fractions shared between fields are no longer needed
+        _clear_chunk_cache(field_data)
 
         if self.tau_field is None:
             mylog.warning('Spectrum is totally empty!')
         else:
             self.flux_field = np.exp(-self.tau_field)
+        self.flux_error_field = None
 
         if output_file is None:
             pass
         elif output_file.endswith('.h5') or output_file.endswith('.hdf5'):
-            self._write_spectrum_hdf5(output_file)
+            self._write_spectrum_hdf5(output_file,
+                                      observables=store_observables)
         elif output_file.endswith('.fits'):
             self._write_spectrum_fits(output_file)
         else:
@@ -507,6 +529,46 @@ class AbsorptionSpectrum(object):
         del field_data
         return (self.lambda_field, self.flux_field)
 
+    def make_spectra(self, rays, fields=None, **kwargs):
+        """
+        Make a spectrum from each of a series of rays in turn.
+
+        This is a generator that makes one spectrum at a time, so a
+        large :class:`~trident.RayArchive` can be processed without
+        loading all of its rays into memory.  After each spectrum is
+        made, it yields the index of the ray along with the lambda and
+        flux fields, and the spectrum can be post-processed or saved
+        before moving on to the next ray.
+
+        **Parameters**
+
+        :rays: :class:`~trident.RayArchive` or iterable of rays
+
+           The rays from which to make spectra.  Each ray can be anything
+           accepted by make_spectrum.
+
+        :fields: optional, list of strings
+
+           When rays is a :class:`~trident.RayArchive`, only these fields
+           are read for each ray.  If None, all fields are read.
+           Default: None
+
+        All other keyword arguments are passed to make_spectrum.
+
+        **Example**
+
+        >>> import trident
+        >>> archive = trident.RayArchive('rays.h5')
+        >>> sg = trident.SpectrumGenerator('COS')
+        >>> for i, wavelength, flux in sg.make_spectra(archive, lines=['H']):
+        ...     sg.save_spectrum('spec_%04d.h5' % i)
+        """
+        if isinstance(rays, RayArchive):
+            rays = rays.iter_rays(fields=fields)
+        for i, ray in enumerate(rays):
+            self.make_spectrum(ray, **kwargs)
+            yield i, self.lambda_field, self.flux_field
+
     def error_func(self, flux):
         """
         Approximate the flux error for a spectrum.
@@ -1155,25 +1217,49 @@ class AbsorptionSpectrum(object):
         f.close()
 
     @parallel_root_only
-    def _write_spectrum_fits(self, filename):
+    def _write_spectrum_fits(self, filename, dtype='float32', append=False,
+                             header=None):
         """
         Write spectrum to a fits file.
+
+        Columns are written in single (dtype='float32') or double
+        (dtype='float64') precision.  If append is True and the file
+        exists, the spectrum is added to it as a new table extension, so
+        many spectra can be stored in one file.  Items in the header dict
+        are added to the header of the extension.
         """
         if self.tau_field is None:
             return
+        if np.dtype(dtype) not in _fits_formats:
+            raise RuntimeError(
+                "FITS dtype must be 'float32' or 'float64', not '%s'." % dtype)
+        fmt = _fits_formats[np.dtype(dtype)]
         mylog.info("Writing spectrum to fits file: %s.", filename)
-        col1 = pyfits.Column(name='wavelength', format='E', array=self.lambda_field)
-        col2 = pyfits.Column(name='tau', format='E', array=self.tau_field)
-        col3 = pyfits.Column(name='flux', format='E', array=self.flux_field)
-        col4 = pyfits.Column(name='flux_error', format='E', array=self.error_func(self.flux_field))
+        lunits = _bin_space_units[self.bin_space]
+        col1 = pyfits.Column(name='wavelength', format=fmt, unit=lunits,
+                             array=self.lambda_field)
+        col2 = pyfits.Column(name='tau', format=fmt, array=self.tau_field)
+        col3 = pyfits.Column(name='flux', format=fmt, array=self.flux_field)
+        col4 = pyfits.Column(name='flux_error', format=fmt,
+                             array=self.error_func(self.flux_field))
         cols = pyfits.ColDefs([col1, col2, col3, col4])
         tbhdu = pyfits.BinTableHDU.from_columns(cols)
-        tbhdu.writeto(filename, overwrite=True)
+        tbhdu.header['BINSPACE'] = self.bin_space
+        if getattr(self, 'bin_width', None) is not None:
+            tbhdu.header['BINWIDTH'] = (float(self.bin_width), lunits)
+        if header is not None:
+            for key, val in header.items():
+                tbhdu.header[key] = val
+        if append and os.path.exists(filename):
+            pyfits.append(filename, tbhdu.data, tbhdu.header)
+        else:
+            tbhdu.writeto(filename, overwrite=True)
 
     @parallel_root_only
-    def _write_spectrum_hdf5(self, filename):
+    def _write_spectrum_hdf5(self, filename, observables=False):
         """
-        Write spectrum to an hdf5 file.
+        Write spectrum to an hdf5 file.  If observables is True, also
+        write the line observables to the "line_observables" group.
 
         """
         if self.tau_field is None:
@@ -1185,3 +1271,18 @@ class AbsorptionSpectrum(object):
         output.create_dataset('flux', data=self.flux_field)
         output.create_dataset('flux_error', data=self.error_func(self.flux_field))
         output.close()
+        if observables:
+            self._write_line_observables(filename)
+
+    def _write_line_observables(self, filename):
+        """
+        Write line observables to an hdf5 file.
+
+        This is called from _write_spectrum_hdf5, which only runs on the
+        root process, so it is not itself root-only.
+        """
+        if not self.line_observables_dict:
+            mylog.warning("No line observables to write.  Set "
+                          "store_observables=True when making the spectrum.")
+            return
+        write_line_observables(filename, self.line_observables_dict)
@@ -0,0 +1,219 @@
+"""
+Functions for saving and loading line observables.
+
+
+
+"""
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2017, Trident Development Team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+#-----------------------------------------------------------------------------
+
+from yt.utilities.on_demand_imports import _h5py as h5py
+import numpy as np
+
+from yt.funcs import mylog
+from yt.units.yt_array import \
+    YTArray, \
+    YTQuantity
+
+def _escape_label(label):
+    """
+    Make a line label safe for use as an HDF5 group name.
+    """
+    return label.replace("/", "_")
+
+def write_line_observables(filename, observables, group_name="line_observables",
+                           compression="gzip", mode="a"):
+    """
+    Write line observables to an HDF5 file.
+
+    Observables are written with one group per line, each containing one
+    dataset per observable quantity with its units stored as an attribute.
+    Arrays are compressed; scalar quantities like the equivalent width are
+    stored as 0-d datasets.  Any existing group with the same name is
+    replaced.
+
+    **Parameters**
+
+    :filename: string
+
+        The HDF5 file to which the observables will be written.
+
+    :observables: dict
+
+        Dictionary of line observables, keyed by line label, as stored
+        in the line_observables_dict attribute of an
+        :class:`~trident.SpectrumGenerator` when making a spectrum with
+        store_observables=True.
+
+    :group_name: optional, string
+
+        Name of the group in the file under which the lines are written.
+        Default: "line_observables"
+
+    :compression: optional, string
+
+        The HDF5 compression filter used for observable arrays.
+        Default: "gzip"
+
+    :mode: optional, string
+
+        The mode with which to open the file.  Use "a" to add the
+        observables to an existing file, such as a saved spectrum.
+        Default: "a"
+    """
+    mylog.info("Writing line observables to hdf5 file: %s.", filename)
+    with h5py.File(filename, mode) as f:
+        if group_name in f:
+            del f[group_name]
+        group = f.create_group(group_name)
+        for label, obs_dict in observables.items():
+            if obs_dict is None:
+                continue
+            line_group = group.create_group(_escape_label(label))
+            line_group.attrs["label"] = label
+            for field, value in obs_dict.items():
+                units = str(getattr(value, "units", ""))
+                value = np.asarray(value)
+                if value.ndim == 0:
+                    dataset = line_group.create_dataset(field, data=value)
+                else:
+                    dataset = line_group.create_dataset(
+                        field, data=value, compression=compression)
+                dataset.attrs["units"] = units
+
+def load_line_observables(filename, group_name="line_observables"):
+    """
+    Load line observables saved with
+    :func:`~trident.absorption_spectrum.line_observables.write_line_observables`
+    or with save_spectrum(..., observables=True).
+
+    The file is not read until observables for a given line are requested,
+    so individual lines can be examined without loading all of them.
+
+    **Parameters**
+
+    :filename: string
+
+        The HDF5 file containing the observables.
+
+    :group_name: optional, string
+
+        Name of the group in the file under which the lines are written.
+        Default: "line_observables"
+
+    **Example**
+
+    >>> import trident
+    >>> ray = trident.make_onezone_ray()
+    >>> sg = trident.SpectrumGenerator('COS')
+    >>> sg.make_spectrum(ray, store_observables=True)
+    >>> sg.save_spectrum('spec.h5', observables=True)
+    >>> obs = trident.load_line_observables('spec.h5')
+    >>> print(obs['H I 1216']['column_density'])
+    """
+    return LineObservables(filename, group_name=group_name)
+
+class LineObservables(object):
+    """
+    Read-only, lazily loaded line observables from an HDF5 file.
+
+    Indexing with a line label returns a dict of observables for that line.
+    Use :meth:`read` to load only some of the observables for a line.
+    """
+    def __init__(self, filename, group_name="line_observables"):
+        self.filename = filename
+        self._handle = h5py.File(filename, "r")
+        if group_name not in self._handle:
+            self._handle.close()
+            raise RuntimeError(
+                "No line observables found in %s." % filename)
+        self._group = self._handle[group_name]
+        self._groups = {}
+        for key in self._group:
+            label = self._group[key].attrs["label"]
+            if isinstance(label, bytes):
+                label = label.decode("utf-8")
+            self._groups[label] = key
+
+    def keys(self):
+        """
+        The labels of the lines in the file.
+        """
+        return list(self._groups)
+
+    def fields(self, label):
+        """
+        The observables stored for a given line.
+        """
+        return list(self._group[self._groups[label]])
+
+    def read(self, label, fields=None):
+        """
+        Read observables for a single line.
+
+        **Parameters**
+
+        :label: string
+
+            The label of the line.
+
+        :fields: optional, list of strings
+
+            The observables to read.  If None, all are read.
+            Default: None
+        """
+        if label not in self._groups:
+            raise KeyError("No observables for line %s in %s." %
+                           (label, self.filename))
+        line_group = self._group[self._groups[label]]
+        if fields is None:
+            fields = list(line_group)
+        data = {}
+        for field in fields:
+            dataset = line_group[field]
+            units = dataset.attrs.get("units", "")
+            if isinstance(units, bytes):
+                units = units.decode("utf-8")
+            value = dataset[()]
+            if np.ndim(value) == 0:
+                data[field] = YTQuantity(value, units)
+            else:
+                data[field] = YTArray(value, units)
+        return data
+
+    def __getitem__(self, label):
+        return self.read(label)
+
+    def __contains__(self, label):
+        return label in self._groups
+
+    def __iter__(self):
+        return iter(self._groups)
+
+    def __len__(self):
+        return len(self._groups)
+
+    def items(self):
+        """
+        Iterate over (label, observables) pairs, reading one line at a time.
+        """
+        for label in self._groups:
+            yield label, self.read(label)
+
+    def close(self):
+        """
+        Close the underlying file.
+        """
+        self._handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,274 @@
+"""
+CosmologyTable class and member functions.
+
+"""
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2017, Trident Development Team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+#-----------------------------------------------------------------------------
+
+import numpy as np
+import threading
+
+from yt.funcs import \
+    mylog
+
+# cosmological parameters that determine the table and its conversion
+# to physical distances
+_cosmology_parameters = ("hubble_constant", "omega_matter", "omega_lambda",
+                         "omega_radiation", "omega_curvature", "w_0", "w_a")
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+def get_cosmology_table(cosmology, z_min=None, z_max=None):
+    """
+    Get the shared comoving distance table for a cosmology.
+
+    Tables are cached by cosmological parameters, so all
+    :class:`~trident.LightRay` objects with the same cosmology share one
+    table.  If a redshift range is given that the cached table does not
+    cover, the table is rebuilt over a wider range.
+
+    **Parameters**
+
+    :cosmology: yt Cosmology object
+
+        The cosmology for which to get the table.
+
+    :z_min: optional, float
+
+        The lowest redshift that the table must cover.
+        Default: None
+
+    :z_max: optional, float
+
+        The highest redshift that the table must cover.
+        Default: None
+    """
+    key = tuple(float(getattr(cosmology, par, 0.))
+                for par in _cosmology_parameters)
+    with _tables_lock:
+        table = _tables.get(key)
+        if table is None or not table.covers(z_min, z_max):
+            if table is not None:
+                z_min = table.z_min if z_min is None \
+                  else min(z_min, table.z_min)
+                z_max = table.z_max if z_max is None \
+                  else max(z_max, table.z_max)
+            table = CosmologyTable(cosmology, z_min=z_min, z_max=z_max)
+            _tables[key] = table
+    return table
+
+class CosmologyTable(object):
+    """
+    A table of line of sight comoving distance as a function of redshift.
+
+    Distances are integrated once on a fine grid in ln(1 + z), stored in
+    units of the Hubble distance, and interpolated with cubic Hermite
+    polynomials using the exact derivative.  Redshifts are recovered from
+    distances by interpolation followed by a Newton step.  This replaces
+    repeated numerical integration of the cosmology with array lookups.
+
+    **Parameters**
+
+    :cosmology: yt Cosmology object
+
+        The cosmology for which to make the table.
+
+    :z_min: optional, float
+
+        The lowest redshift covered.  Must be greater than -1.  If None,
+        -0.5 is used.
+        Default: None
+
+    :z_max: optional, float
+
+        The highest redshift covered.  If None, 20 is used.
+        Default: None
+
+    :bins_per_efold: optional, int
+
+        The number of table bins per unit of ln(1 + z).
+        Default: 16384
+    """
+    def __init__(self, cosmology, z_min=None, z_max=None,
+                 bins_per_efold=16384):
+        if z_min is None:
+            z_min = -0.5
+        if z_max is None:
+            z_max = 20.
+        z_min = min(z_min, -0.5)
+        z_max = max(z_max, 20.)
+        if z_min <= -1:
+            raise RuntimeError("z_min must be greater than -1.")
+        self.cosmology = cosmology
+        self.z_min = z_min
+        self.z_max = z_max
+
+        x_min = np.log1p(z_min)
+        x_max = np.log1p(z_max)
+        n_bins = int(np.ceil((x_max - x_min) * bins_per_efold))
+        self._x = np.linspace(x_min, x_max, n_bins + 1)
+        self._dx = self._x[1] - self._x[0]
+        self._slope = self._distance_derivative(self._x)
+        self._distance = np.zeros(self._x.size)
+        np.cumsum((self._slope[1:] + self._slope[:-1]) * (self._dx / 2),
+                  out=self._distance[1:])
+        mylog.debug("Made comoving distance table with %d bins for "
+                    "%.2f <= z <= %.2f." % (n_bins, z_min, z_max))
+
+    def covers(self, z_min=None, z_max=None):
+        """
+        Check whether the table covers a range of redshifts.
+        """
+        return (z_min is None or z_min >= self.z_min) and \
+          (z_max is None or z_max <= self.z_max)
+
+    def _distance_derivative(self, x):
+        """
+        The derivative of the distance, in units of the Hubble distance,
+        with respect to ln(1 + z).
+        """
+        z = np.expm1(x)
+        return (1 + z) / np.asarray(self.cosmology.expansion_factor(z))
+
+    def _check_range(self, z):
+        if np.any(z < self.z_min) or np.any(z > self.z_max):
+            raise RuntimeError(
+                "Redshift outside of comoving distance table range "
+                "(%f to %f)." % (self.z_min, self.z_max))
+
+    def _table_distance(self, z):
+        """
+        Distance from z_min in units of the Hubble distance.
+        """
+        z = np.asarray(z, dtype=np.float64)
+        self._check_range(z)
+        x = np.log1p(z)
+        i = np.clip(((x - self._x[0]) / self._dx).astype(np.int64),
+                    0, self._x.size - 2)
+        t = (x - self._x[i]) / self._dx
+        t2 = t * t
+        t3 = t2 * t
+        return (2 * t3 - 3 * t2 + 1) * self._distance[i] + \
+          (t3 - 2 * t2 + t) * self._dx * self._slope[i] + \
+          (-2 * t3 + 3 * t2) * self._distance[i + 1] + \
+          (t3 - t2) * self._dx * self._slope[i + 1]
+
+    def _table_redshift(self, distance):
+        """
+        Redshift at a distance from z_min in units of the Hubble distance.
+        """
+        distance = np.asarray(distance, dtype=np.float64)
+        if np.any(distance < self._distance[0]) or \
+          np.any(distance > self._distance[-1]):
+            raise RuntimeError(
+                "Distance outside of comoving distance table range.")
+        x = np.interp(distance, self._distance, self._x)
+        x -= (self._table_distance(np.expm1(x)) - distance) / \
+          self._distance_derivative(x)
+        return np.expm1(x)
+
+    def _to_hubble_units(self, distance):
+        """
+        Convert a comoving distance to units of the Hubble distance.
+        """
+        # as in yt's Cosmology, comoving and proper units are the same
+        # within the cosmology's unit system
+        distance = self.cosmology.quan(distance.to("Mpccm / h"))
+        return float((distance / self.cosmology.hubble_distance()).in_units(
+            "dimensionless"))
+
+    def comoving_radial_distance(self, z_i, z_f):
+        """
+        The comoving distance along the line of sight from z_i to z_f.
+
+        Equivalent to comoving_radial_distance of the yt Cosmology object.
+        """
+        distance = self._table_distance(z_f) - self._table_distance(z_i)
+        return (self.cosmology.hubble_distance() * distance).in_cgs()
+
+    def redshift_from_distance(self, z_start, distance):
+        """
+        The redshift reached by moving a comoving distance toward the
+        observer, starting from z_start.
+
+        **Parameters**
+
+        :z_start: float or array
+
+            The starting redshift.
+
+        :distance: YTQuantity or array
+
+            The comoving distance moved.  Plain arrays are taken to be in
+            units of the Hubble distance.
+        """
+        if hasattr(distance, "units"):
+            distance = self._to_hubble_units(distance)
+        return self._table_redshift(self._table_distance(z_start) - distance)
+
+    def redshift_along_segment(self, z_start, z_end, fraction):
+        """
+        The redshifts at fractions of the comoving distance from z_start
+        to z_end.
+
+        **Parameters**
+
+        :z_start: float
+
+            The redshift at the start of the segment.
+
+        :z_end: float
+
+            The redshift at the end of the segment.
+
+        :fraction: array
+
+            The fractions of the comoving distance along the segment.
+        """
+        d_start = self._table_distance(z_start)
+        d_end = self._table_distance(z_end)
+        return self._table_redshift(
+            d_start + np.asarray(fraction) * (d_end - d_start))
+
+    def deltaz_forward(self, z, target_distance):
+        """
+        The change in redshift corresponding to moving a comoving distance
+        toward the observer, starting from z.
+
+        This follows the same secant iteration and tolerance as
+        CosmologySplice in yt, with distances taken from the table, so
+        results agree with those found by integrating the cosmology.
+        """
+        d_tolerance = 1e-4
+        max_iterations = 100
+
+        target = self._to_hubble_units(target_distance)
+        d_start = self._table_distance(z)
+
+        # Use Hubble's law for initial guess
+        v = min(float(self.cosmology.expansion_factor(z)) * target, 0.9)
+        z1 = z
+        z2 = z1 - (np.sqrt((1. + v) / (1. - v)) - 1.)
+        distance1 = 0.
+        distance2 = d_start - self._table_distance(z2)
+        iteration = 1
+        while np.abs(distance2 - target) / distance2 > d_tolerance:
+            m = (distance2 - distance1) / (z2 - z1)
+            z1 = z2
+            distance1 = distance2
+            z2 = (target - distance2) / m + z2
+            distance2 = d_start - self._table_distance(z2)
+            iteration += 1
+            if iteration > max_iterations:
+                mylog.error("deltaz_forward: Warning - max iterations " +
+                            "exceeded for z = %f (delta z = %f)." %
+                            (z, np.abs(z2 - z)))
+                break
+        return float(np.abs(z2 - z))
@@ -0,0 +1,350 @@
+"""
+DatasetCache class and member functions.
+
+"""
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2017, Trident Development Team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+#-----------------------------------------------------------------------------
+
+from collections import \
+    OrderedDict
+import numpy as np
+import os
+import sys
+import threading
+
+from yt.convenience import \
+    load
+from yt.funcs import \
+    get_memory_usage, \
+    mylog
+
+def _make_key(filename, load_kwargs):
+    """
+    Make a hashable cache key from a filename and a dict of load keywords.
+    """
+    def _freeze(value):
+        if isinstance(value, dict):
+            return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+        if isinstance(value, (list, tuple)):
+            return tuple(_freeze(v) for v in value)
+        if isinstance(value, np.ndarray):
+            return (value.dtype.str, value.shape, value.tobytes())
+        return value
+    return (os.path.abspath(str(filename)), _freeze(load_kwargs))
+
+class DatasetCache(object):
+    """
+    A size-bounded, least-recently-used cache of loaded datasets.
+
+    Datasets are keyed by their absolute path and the keywords given to
+    yt's load function, so loading the same dataset again returns the
+    existing object, along with any index it has already built.  When
+    the cache is full, the least recently used dataset is dropped.
+
+    A single instance, trident.dataset_cache, is used by all
+    :class:`~trident.LightRay` objects and ray generation functions
+    in a process.  It is disabled (max_size of 0) by default, so each
+    call loads its datasets afresh.  Enable it only when repeated calls
+    can share datasets: a cached dataset keeps any changes made to it,
+    so a setup_function is applied to it again on each use, and ion
+    fields added when making one ray remain defined for later ones.
+
+    **Parameters**
+
+    :max_size: optional, int
+
+        The maximum number of datasets to hold.  Set to 0 to disable
+        caching.
+        Default: 0
+
+    **Example**
+
+    Enable the shared cache, keeping up to 8 datasets loaded, and report
+    what is held.
+
+    >>> import trident
+    >>> trident.dataset_cache.max_size = 8
+    >>> ds = trident.dataset_cache.load('enzo_cosmology_plus/RD0009/RD0009')
+    >>> trident.dataset_cache.info()
+    >>> trident.dataset_cache.clear()
+    """
+    def __init__(self, max_size=0):
+        self._max_size = max_size
+        self._datasets = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def max_size(self):
+        """
+        The maximum number of datasets held in the cache.
+        """
+        return self._max_size
+
+    @max_size.setter
+    def max_size(self, value):
+        if value < 0:
+            raise RuntimeError("max_size must be non-negative.")
+        with self._lock:
+            self._max_size = value
+            self._trim()
+
+    def load(self, filename, **load_kwargs):
+        """
+        Load a dataset, reusing a cached copy if one exists.
+
+        **Parameters**
+
+        :filename: string
+
+            The dataset filename.
+
+        :load_kwargs: optional
+
+            Keyword arguments passed to yt's load function.
+        """
+        key = _make_key(filename, load_kwargs)
+        with self._lock:
+            if key in self._datasets:
+                self.hits += 1
+                ds = self._datasets.pop(key)
+                self._datasets[key] = ds
+                return ds
+            self.misses += 1
+
+        # Load outside of the lock so other threads are not held up
+        # while the dataset is opened.
+        ds = load(filename, **load_kwargs)
+        if self._max_size == 0:
+            return ds
+        with self._lock:
+            self._datasets[key] = ds
+            self._trim()
+        return ds
+
+    def evict(self, filename, **load_kwargs):
+        """
+        Remove a dataset from the cache.
+
+        Returns True if the dataset was in the cache.
+
+        **Parameters**
+
+        :filename: string
+
+            The dataset filename.
+
+        :load_kwargs: optional
+
+            The keyword arguments with which the dataset was loaded.
+        """
+        key = _make_key(filename, load_kwargs)
+        with self._lock:
+            return self._datasets.pop(key, None) is not None
+
+    def clear(self):
+        """
+        Remove all datasets from the cache.
+        """
+        with self._lock:
+            self._datasets.clear()
+
+    def _trim(self):
+        """
+        Drop the least recently used datasets until the cache fits.
+        """
+        while len(self._datasets) > self._max_size:
+            key, ds = self._datasets.popitem(last=False)
+            mylog.info("Evicting %s from dataset cache." % key[0])
+
+    def __contains__(self, filename):
+        path = os.path.abspath(str(filename))
+        with self._lock:
+            return any(key[0] == path for key in self._datasets)
+
+    def __len__(self):
+        return len(self._datasets)
+
+    def keys(self):
+        """
+        The filenames of the cached datasets, from least to most
+        recently used.
+        """
+        with self._lock:
+            return [key[0] for key in self._datasets]
+
+    def process_rss(self):
+        """
+        The resident set size (RSS) of the whole process in MB, as
+        reported by yt.  This is not the memory used by the cache: it
+        includes the cached datasets along with everything else in the
+        process, and datasets share memory that cannot be attributed to
+        any one of them.
+        """
+        return get_memory_usage()
+
+    def info(self):
+        """
+        Log the cached datasets, cache statistics, and the resident set
+        size of the whole process.
+        """
+        filenames = self.keys()
+        mylog.info("Dataset cache holds %d of %d datasets "
+                   "(%d hits, %d misses).  Process RSS (all memory in use, "
+                   "not only cached datasets): %.1f MB." %
+                   (len(filenames), self._max_size, self.hits, self.misses,
+                    self.process_rss()))
+        for filename in filenames:
+            mylog.info("    %s" % filename)
+
+
+dataset_cache = DatasetCache()
+
+# only one prefetching thread loads a dataset or builds an index at a time
+_prefetch_lock = threading.Lock()
+
+class DatasetPrefetcher(object):
+    """
+    Load a sequence of datasets in a background thread ahead of their use.
+
+    Iterating over a DatasetPrefetcher yields the loaded datasets in
+    order.  While one dataset is in use, a background thread loads the
+    next ones and builds their indices, so reading from disk overlaps
+    with work done on the current dataset.  The prefetched datasets are
+    held by the prefetcher itself until they are used, so they are not
+    evicted by, and do not evict, the datasets in a cache.
+
+    At most depth datasets are held ahead of the one in use.  If
+    max_memory is given, no further datasets are loaded ahead while the
+    resident memory of the process exceeds it.  Loading and index
+    construction are done by one prefetching thread at a time.
+
+    **Parameters**
+
+    :filenames: list of strings
+
+        The dataset filenames, in the order they will be used.
+
+    :depth: optional, int
+
+        The maximum number of datasets to load ahead.
+        Default: 1
+
+    :load_kwargs: optional, dict
+
+        Keyword arguments passed to yt's load function.
+        Default: None
+
+    :cache: optional, :class:`~trident.DatasetCache`
+
+        A cache through which to load datasets.  If None, datasets
+        are loaded directly with yt's load function.
+        Default: None
+
+    :max_memory: optional, float
+
+        The resident memory of the process, in MB, above which no more
+        datasets are loaded ahead.  The next dataset is always loaded
+        once it is needed.  If None, only depth limits prefetching.
+        Default: None
+    """
+    def __init__(self, filenames, depth=1, load_kwargs=None, cache=None,
+                 max_memory=None):
+        if depth < 1:
+            raise RuntimeError("Prefetch depth must be at least 1.")
+        if load_kwargs is None:
+            load_kwargs = {}
+        self.filenames = list(filenames)
+        self.depth = depth
+        self.load_kwargs = load_kwargs
+        self.cache = cache
+        self.max_memory = max_memory
+        self._loaded = []
+        self._ready = threading.Condition()
+        self._slots = threading.Semaphore(depth)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _over_budget(self):
+        """
+        Whether to hold off loading because memory is over budget and a
+        dataset is already waiting to be used.
+        """
+        if self.max_memory is None:
+            return False
+        with self._ready:
+            if not self._loaded:
+                return False
+        return get_memory_usage() > self.max_memory
+
+    def _load(self, filename):
+        """
+        Load a dataset and build its index.
+        """
+        with _prefetch_lock:
+            if self.cache is None:
+                ds = load(filename, **self.load_kwargs)
+            else:
+                ds = self.cache.load(filename, **self.load_kwargs)
+            # build the index now so it is ready when needed
+            ds.index
+        return ds
+
+    def _load_all(self):
+        """
+        Load each dataset once a slot is free, stopping early if closed.
+        """
+        for filename in self.filenames:
+            while not self._slots.acquire(False):
+                if self._stop.wait(0.05):
+                    return
+            while self._over_budget():
+                if self._stop.wait(0.05):
+                    return
+            if self._stop.is_set():
+                return
+            try:
+                item = (self._load(filename), None)
+            except Exception:
+                item = (None, sys.exc_info())
+            with self._ready:
+                self._loaded.append(item)
+                self._ready.notify()
+            if item[1] is not None:
+                return
+
+    def __iter__(self):
+        self._thread = threading.Thread(target=self._load_all)
+        self._thread.daemon = True
+        self._thread.start()
+        try:
+            for i in range(len(self.filenames)):
+                with self._ready:
+                    while not self._loaded:
+                        self._ready.wait()
+                    ds, exc_info = self._loaded.pop(0)
+                if exc_info is not None:
+                    raise exc_info[1]
+                self._slots.release()
+                yield ds
+                del ds
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Stop loading datasets and wait for the background thread to finish.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._ready:
+            del self._loaded[:]
@@ -11,17 +11,21 @@ Ion fraction fields using Cloudy data.
 # The full license is in the file LICENSE, distributed with this software.
 #-----------------------------------------------------------------------------
 
+from yt.data_objects.static_output import \
+    Dataset
 from yt.fields.field_detector import \
     FieldDetector
-from yt.utilities.linear_interpolators import \
-    TrilinearFieldInterpolator, \
-    UnilinearFieldInterpolator
+from yt.units.yt_array import \
+    YTArray
 from yt.utilities.physical_constants import mh
 from yt.funcs import mylog
+from collections import \
+    OrderedDict
 import numpy as np
 import h5py
-import copy
 import os
+import threading
+import weakref
 from trident.config import \
     ion_table_filepath
 from trident.line_database import \
@@ -38,10 +42,17 @@ to_nH = H_mass_fraction / mh
 fraction_zero_point = 1.e-9
 zero_out_value = -30.
 
-table_store = {}
+# the fields giving the parameters of ion tables whose parameter fields
+# are not named in the table, by number of parameters
+default_parameter_fields = {1: ["log_T"],
+                            3: ["log_nH", "redshift", "log_T"]}
+
+# if set, ion fields are evaluated in slices of at most this many cells,
+# so the memory used for temporary arrays does not depend on chunk size
+ion_field_cell_budget = None
 
 class IonBalanceTable(object):
-    def __init__(self, filename=None, atom=None):
+    def __init__(self, filename=None, atom=None, ions=None):
         """
         Base class for building additional ion fields
 
@@ -62,29 +73,646 @@ class IonBalanceTable(object):
 
             The atomic species for which you want to create an IonBalanceTable
 
+            Default: None
+
+        :ions: list of ints, optional
+
+            The ionization states to read, where 1 is neutral.  If set,
+            only the parts of the table for these ions are read from the
+            file and the first axis of ion_fraction follows this list.
+            If None, the table for all ions is read.  Tables written by
+            :class:`~trident.make_flat_ion_table` are instead mapped into
+            memory whole, in which case this is ignored.
+
             Default: None
         """
         if filename is None:
             filename = ion_table_filepath
         self.filename = filename
         self.parameters = []
+        self.parameter_fields = []
         self.ion_fraction = []
-        self._load_hdf5_table(atom)
+        self._load_hdf5_table(atom, ions=ions)
 
-    def _load_hdf5_table(self, atom):
+    def _load_hdf5_table(self, atom, ions=None):
         """
         Read in the HDF5 ion balance table
         """
 
         input = h5py.File(self.filename, 'r')
-        self.ion_fraction = input[atom][()]
-        self.ion_fraction[self.ion_fraction < np.log10(fraction_zero_point)] = zero_out_value
-        for par in range(1, len(self.ion_fraction.shape) - 1):
+        dataset = input[atom]
+        offset = dataset.id.get_offset()
+        self.mapped = bool(input.attrs.get('flat_table', False)) and \
+          offset is not None
+        if self.mapped:
+            # flat tables are stored clamped and contiguous, so they are
+            # mapped into memory rather than read
+            self.ion_fraction = np.memmap(self.filename, mode='r',
+                                          dtype=dataset.dtype,
+                                          shape=dataset.shape,
+                                          offset=offset)
+        elif ions is None:
+            self.ion_fraction = dataset[()]
+        else:
+            # read only the hyperslab of each requested ion
+            self.ion_fraction = np.empty((len(ions),) + dataset.shape[1:],
+                                         dtype=dataset.dtype)
+            for i, ion in enumerate(ions):
+                dataset.read_direct(self.ion_fraction,
+                                    source_sel=np.s_[ion-1],
+                                    dest_sel=np.s_[i])
+        if not self.mapped:
+            np.putmask(self.ion_fraction,
+                       self.ion_fraction < np.log10(fraction_zero_point),
+                       zero_out_value)
+        n_parameters = dataset.ndim - 2
+        for par in range(1, n_parameters + 1):
             name = "Parameter%d" % par
-            self.parameters.append(input[atom].attrs[name])
-        self.parameters.append(input[atom].attrs['Temperature'])
+            self.parameters.append(dataset.attrs[name])
+            # the field for each parameter may be named in the table,
+            # otherwise it is assumed from the number of parameters
+            field = dataset.attrs.get("%s_field" % name)
+            if field is None and \
+              n_parameters + 1 in default_parameter_fields:
+                field = default_parameter_fields[n_parameters + 1][par - 1]
+            if isinstance(field, bytes):
+                field = field.decode()
+            self.parameter_fields.append(field)
+        self.parameters.append(dataset.attrs['Temperature'])
+        self.parameter_fields.append("log_T")
         input.close()
 
+class TableInterpolator(object):
+    """
+    Linear interpolation of tables with any number of axes.
+
+    For each value, the bin enclosing it is found along each axis and
+    combined, using precomputed strides, into the flattened table
+    indices of the 2**N corners of the enclosing cell of the table, along
+    with the weight of each corner.  Any number of tables with the same
+    axes can then be interpolated from one set of indices and weights.
+    Bins along evenly spaced axes are estimated arithmetically and
+    checked, and along other axes found by binary search.
+
+    **Parameters**
+
+    :bins: list of arrays
+
+        The increasing values of the table along each axis.
+
+    :truncate: optional, bool
+
+        If True, values off the table are extrapolated from the nearest
+        bins, as with yt's linear interpolators.  If False, a
+        RuntimeError is raised for values off the table.
+        Default: True
+
+    :clamp: optional, bool
+
+        If True, values off the table are given the values at its edges.
+        This takes precedence over truncate.
+        Default: False
+
+    **Example**
+
+    Interpolate a table of log O VI fractions in density, redshift and
+    temperature.
+
+    >>> from trident.ion_balance import IonBalanceTable, TableInterpolator
+    >>> table = IonBalanceTable(atom='O', ions=[6])
+    >>> interpolator = TableInterpolator(table.parameters)
+    >>> log_fraction = interpolator(table.ion_fraction[0],
+    ...                             [log_nH, redshift, log_T])
+    """
+    def __init__(self, bins, truncate=True, clamp=False):
+        self.bins = [np.asarray(axis_bins, dtype=np.float64)
+                     for axis_bins in bins]
+        self.shape = tuple(axis_bins.size for axis_bins in self.bins)
+        self.truncate = truncate
+        self.clamp = clamp
+        if min(self.shape) < 2:
+            raise RuntimeError("Each table axis must have at least 2 values.")
+        self.strides = np.cumprod((1,) + self.shape[:0:-1])[::-1]
+
+        # the first bin and bin width of evenly spaced axes
+        self._spacing = []
+        for axis_bins in self.bins:
+            widths = np.diff(axis_bins)
+            if (widths <= 0).any():
+                raise RuntimeError("Table axes must be increasing.")
+            if np.allclose(widths, widths.mean(), rtol=1e-3, atol=0):
+                self._spacing.append((axis_bins[0], widths.mean()))
+            else:
+                self._spacing.append(None)
+
+    def _find_bins(self, dim, values):
+        """
+        Find the bin along an axis below each value, such that
+        bins[i] <= value < bins[i + 1], limited to the bins of the table.
+        """
+        bins = self.bins[dim]
+        spacing = self._spacing[dim]
+        if spacing is None:
+            i = np.digitize(values, bins) - 1
+            np.clip(i, 0, bins.size - 2, out=i)
+            return i
+
+        with np.errstate(invalid='ignore'):
+            i = np.floor((values - spacing[0]) / spacing[1])
+            np.clip(i, 0, bins.size - 2, out=i)
+        # NaN values go in the last bin, as with np.digitize
+        i[np.isnan(i)] = bins.size - 2
+        i = i.astype(np.int64)
+
+        # small differences in bin width add up along the axis, so the
+        # arithmetic estimate can be off by any number of bins; search
+        # for the bins of those values it gets wrong
+        wrong = ((values < bins[i]) & (i > 0)) | \
+          ((values >= bins[i + 1]) & (i < bins.size - 2))
+        if wrong.any():
+            i[wrong] = np.clip(np.digitize(values[wrong], bins) - 1,
+                               0, bins.size - 2)
+        return i
+
+    def weights(self, inputs, index=None, weights=None):
+        """
+        Get the table indices and weights for interpolating at the given
+        values.
+
+        Returns a tuple of the shape of the inputs, the flattened table
+        index of each corner of the enclosing cell for each value, with
+        shape (2**N, n_values), and the weight of each corner.
+
+        **Parameters**
+
+        :inputs: list of arrays
+
+            The values along each axis at which to interpolate.
+
+        :index: optional, array
+
+            An int64 array of shape (2**N, n_values) filled in place.
+            Default: None
+
+        :weights: optional, array
+
+            A float64 array of shape (2**N, n_values) filled in place.
+            Default: None
+        """
+        if len(inputs) != len(self.bins):
+            raise RuntimeError("Got %d inputs for a table with %d axes." %
+                               (len(inputs), len(self.bins)))
+        shape = np.shape(inputs[0])
+        n_values = int(np.prod(shape))
+        n_dims = len(self.bins)
+
+        if index is None:
+            index = np.empty((2**n_dims, n_values), dtype=np.int64)
+            weights = np.empty((2**n_dims, n_values), dtype=np.float64)
+        index[0] = 0
+        weights[0] = 1
+
+        # each axis doubles the corners found so far, with the new axis
+        # as the lowest bit of the corner number
+        n_corners = 1
+        for dim, (values, bins) in enumerate(zip(inputs, self.bins)):
+            values = np.asarray(values, dtype=np.float64).ravel()
+            if not self.clamp and not self.truncate and \
+              ((values < bins[0]) | (values > bins[-1])).any():
+                raise RuntimeError(
+                    "Values outside of the table range (%f to %f) "
+                    "for axis %d." % (bins[0], bins[-1], dim))
+            i = self._find_bins(dim, values)
+            x_p = (values - bins[i]) / (bins[i + 1] - bins[i])
+            if self.clamp:
+                np.clip(x_p, 0, 1, out=x_p)
+            x_m = 1 - x_p
+            lower = i * self.strides[dim]
+            upper = lower + self.strides[dim]
+
+            # go backward so no corner is overwritten before it is used
+            for corner in range(n_corners - 1, -1, -1):
+                np.add(index[corner], upper, out=index[2 * corner + 1])
+                np.add(index[corner], lower, out=index[2 * corner])
+                np.multiply(weights[corner], x_p,
+                            out=weights[2 * corner + 1])
+                np.multiply(weights[corner], x_m, out=weights[2 * corner])
+            n_corners *= 2
+        return shape, index, weights
+
+    def __call__(self, table, inputs):
+        """
+        Interpolate a table at the given values.
+
+        **Parameters**
+
+        :table: array
+
+            The table, with a shape matching the bins.
+
+        :inputs: list of arrays
+
+            The values along each axis at which to interpolate.
+        """
+        if np.shape(table) != self.shape:
+            raise RuntimeError("Table shape %s does not match bins %s." %
+                               (np.shape(table), self.shape))
+        shape, index, weights = self.weights(inputs)
+        values = (np.ravel(table)[index] * weights).sum(axis=0)
+        return values.reshape(shape)
+
+
+_interpolators = {}
+
+class IonTableStore(object):
+    """
+    A cache of ion balance tables, optionally bounded in memory.
+
+    Ion fraction fields look up their tables here by field name.  Tables
+    are held per element and read from the ion balance table file only
+    for the ions whose fields have been added.  If a byte budget is set,
+    the least recently used elements are dropped once the tables held
+    exceed it, and are read again the next time they are used.  Tables
+    memory-mapped from files made with
+    :class:`~trident.make_flat_ion_table` are not counted against the
+    budget.
+
+    A single instance, trident.ion_balance.table_store, is used by all
+    ion fields.
+
+    **Parameters**
+
+    :max_bytes: optional, int
+
+        The maximum number of bytes of tables to hold.  If None, there
+        is no limit.
+        Default: None
+
+    **Example**
+
+    Hold at most 500 MB of ion tables and report what is held.
+
+    >>> from trident.ion_balance import table_store
+    >>> table_store.max_bytes = 500 * 1024**2
+    >>> table_store.info()
+    >>> table_store.clear()
+    """
+    def __init__(self, max_bytes=None):
+        self._max_bytes = max_bytes
+        self._fields = {}
+        self._ions = {}
+        self._elements = OrderedDict()
+        self._lock = threading.RLock()
+        self.linear = False
+        self.dtype = None
+        self.hits = 0
+        self.misses = 0
+
+    def precompute(self, linear=True, dtype=None):
+        """
+        Build companion tables from which ion fractions are interpolated.
+
+        By default, log ion fractions are interpolated and then raised to
+        the power of 10, with fractions at or below 1e-9 set to zero and
+        fractions above 1 capped with a warning.  With linear set, ion
+        fractions are instead interpolated from tables of fractions that
+        are already zeroed and capped.  Values off the table are then
+        taken from its edges rather than extrapolated, so every result
+        lies between 0 and 1 and the exponentiation and checks are
+        skipped.
+
+        Linear interpolation gives fractions at least as large as the log
+        interpolation.  Where the log fraction changes by D dex between
+        neighboring table points, the two differ by at most a factor of
+        cosh(ln(10) * D / 2) along that axis: under 0.3% for D = 0.1 and
+        74% for D = 1.  The factors for each axis multiply, and the two
+        agree exactly at the table points.  Fractions
+        interpolated between a zeroed and a nonzero point are no longer
+        zeroed.  Storing tables as float32 changes fractions by about 1
+        part in 10^7.
+
+        Companion tables are built for the tables held and for any read
+        later, and count against max_bytes.
+
+        **Parameters**
+
+        :linear: optional, bool
+
+            If True, interpolate ion fractions rather than log ion
+            fractions.  If False, with dtype None, companion tables are
+            removed and the default behavior is restored.
+            Default: True
+
+        :dtype: optional, string or numpy dtype
+
+            The data type of the companion tables, such as "float32".
+            If None, the data type of the ion table is used.
+            Default: None
+
+        **Example**
+
+        Interpolate ion fractions in linear space from float32 tables.
+
+        >>> from trident.ion_balance import table_store
+        >>> table_store.precompute(linear=True, dtype='float32')
+        """
+        with self._lock:
+            self.linear = linear
+            self.dtype = dtype
+            for element in self._elements.values():
+                element['tables'] = element['fraction']
+                element['nbytes'] -= element.pop('companion_nbytes', 0)
+                self._build_companions(element, list(element['fraction']))
+            self._trim()
+
+    def _build_companions(self, element, indices):
+        """
+        Build the companion tables of the given ions of an element.
+        """
+        if not self.linear and self.dtype is None:
+            element['tables'] = element['fraction']
+            return
+        if element.get('tables') is element['fraction']:
+            element['tables'] = {}
+            element['companion_nbytes'] = 0
+        for index in indices:
+            table = element['fraction'][index]
+            if self.linear:
+                table = np.power(10., table, dtype=np.float64)
+                table[table <= fraction_zero_point] = 0.0
+                np.clip(table, 0.0, 1.0, out=table)
+            if self.dtype is not None:
+                table = table.astype(self.dtype)
+            elif table is element['fraction'][index]:
+                table = table.copy()
+            table.setflags(write=False)
+            element['tables'][index] = table
+            element['nbytes'] += table.nbytes
+            element['companion_nbytes'] += table.nbytes
+
+    @property
+    def max_bytes(self):
+        """
+        The maximum number of bytes of tables held, or None for no limit.
+        """
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, value):
+        if value is not None and value < 0:
+            raise RuntimeError("max_bytes must be non-negative.")
+        with self._lock:
+            self._max_bytes = value
+            self._trim()
+
+    @property
+    def nbytes(self):
+        """
+        The number of bytes of tables held in memory.
+        """
+        with self._lock:
+            return sum(element['nbytes']
+                       for element in self._elements.values())
+
+    def add(self, field, ionization_table, atom, ion, read=True):
+        """
+        Register the table for an ion fraction field and read it if
+        needed.
+
+        If the field is already registered, its existing table is kept.
+
+        **Parameters**
+
+        :field: string
+
+            The name of the ion fraction field.
+
+        :ionization_table: string
+
+            The ion balance table file.
+
+        :atom: string
+
+            The element.
+
+        :ion: int
+
+            The ionization state, where 1 is neutral.
+
+        :read: optional, bool
+
+            If False, the table is not read until the field is first
+            used, when the tables of all registered ions of the element
+            are read together.
+            Default: True
+        """
+        with self._lock:
+            if field not in self._fields:
+                self._fields[field] = ((ionization_table, atom), ion-1)
+            element_key, index = self._fields[field]
+            self._ions.setdefault(element_key, set()).add(index)
+            if read:
+                self.get_element(element_key)
+
+    def load(self, ionization_table, atom, ions):
+        """
+        Read the tables for several ions of an element in one pass over
+        the file, skipping any already held.
+
+        **Parameters**
+
+        :ionization_table: string
+
+            The ion balance table file.
+
+        :atom: string
+
+            The element.
+
+        :ions: list of ints
+
+            The ionization states, where 1 is neutral.
+        """
+        with self._lock:
+            return self._load((ionization_table, atom), ions)
+
+    def _load(self, element_key, ions):
+        """
+        Read the tables for any of the given ions of an element that are
+        not held.
+
+        Only the parts of the file for the missing ions are read.  The
+        tables are made read-only, as they are shared by all fields
+        using them.
+        """
+        element = self._elements.pop(element_key, None)
+        if element is None:
+            element = {'fraction': {}, 'parameters': None, 'nbytes': 0}
+            element['tables'] = element['fraction']
+        self._elements[element_key] = element
+
+        missing = sorted(set(ion for ion in ions
+                             if ion-1 not in element['fraction']))
+        if missing:
+            ionization_table, atom = element_key
+            ionTable = IonBalanceTable(ionization_table, atom, ions=missing)
+            if element['parameters'] is None:
+                for par in ionTable.parameters:
+                    par.setflags(write=False)
+                element['parameters'] = ionTable.parameters
+                element['parameter_fields'] = ionTable.parameter_fields
+            ionTable.ion_fraction.setflags(write=False)
+            for i, ion in enumerate(missing):
+                if ionTable.mapped:
+                    fraction = ionTable.ion_fraction[ion-1]
+                else:
+                    fraction = ionTable.ion_fraction[i]
+                    element['nbytes'] += fraction.nbytes
+                element['fraction'][ion-1] = fraction
+            del ionTable
+            self._build_companions(element, [ion-1 for ion in missing])
+            self._trim()
+        return element
+
+    def get_element(self, element_key):
+        """
+        Get the tables of an element, reading those of any registered
+        ions that are not held.
+
+        Returns a dict with the log ion fraction table of each ion, keyed
+        by ionization state minus one, the tables from which to
+        interpolate, which are the companion tables if built, the list
+        of table parameters, and the names of the fields giving them.
+        """
+        with self._lock:
+            ions = [index+1 for index in self._ions.get(element_key, ())]
+            element = self._elements.get(element_key)
+            if element is not None and \
+              all(ion-1 in element['fraction'] for ion in ions):
+                self.hits += 1
+                self._elements[element_key] = \
+                  self._elements.pop(element_key)
+                return element
+            self.misses += 1
+            return self._load(element_key, ions)
+
+    def get_ions(self, element_key):
+        """
+        Get the sorted list of ionization states, minus one, of the
+        registered fields of an element.
+        """
+        with self._lock:
+            return sorted(self._ions.get(element_key, ()))
+
+    def __getitem__(self, field):
+        with self._lock:
+            element_key, index = self._fields[field]
+            element = self.get_element(element_key)
+            return {'fraction': element['fraction'][index],
+                    'table': element['tables'][index],
+                    'parameters': element['parameters'],
+                    'parameter_fields': element['parameter_fields'],
+                    'element': element_key,
+                    'ion': index}
+
+    def __contains__(self, field):
+        return field in self._fields
+
+    def __len__(self):
+        return len(self._fields)
+
+    def clear(self):
+        """
+        Drop all tables held.  Registered fields remain valid and read
+        their tables again when next used.
+        """
+        with self._lock:
+            self._elements.clear()
+
+    def _trim(self):
+        """
+        Drop the least recently used elements until the tables fit
+        within the budget, always keeping the most recent one.
+        """
+        if self._max_bytes is None:
+            return
+        while len(self._elements) > 1 and self.nbytes > self._max_bytes:
+            element_key, element = self._elements.popitem(last=False)
+            mylog.info("Evicting %s table of %s from ion table store." %
+                       (element_key[1], element_key[0]))
+
+    def info(self):
+        """
+        Log the elements held and cache statistics.
+        """
+        with self._lock:
+            mylog.info("Ion table store holds %d elements in %.1f MB "
+                       "(%d hits, %d misses)." %
+                       (len(self._elements), self.nbytes / 1024.**2,
+                        self.hits, self.misses))
+            for (ionization_table, atom), element in self._elements.items():
+                mylog.info("    %s from %s: %d ions, %.1f MB" %
+                           (atom, ionization_table, len(element['fraction']),
+                            element['nbytes'] / 1024.**2))
+
+
+table_store = IonTableStore()
+
+def make_flat_ion_table(filename, ionization_table=None):
+    """
+    Write a copy of an ion balance table that can be mapped into memory.
+
+    The copy is a valid ion balance table HDF5 file, but each element's
+    table is stored uncompressed and contiguous, with values below the
+    zero point already clamped.  When it is used as the ionization_table
+    for ion fields, the tables are memory-mapped rather than read, so all
+    processes on a node, such as MPI ranks or workers, share one
+    read-only copy in the page cache.  Writing the copy to a shared
+    memory filesystem, such as /dev/shm, keeps that copy in memory.
+
+    **Parameters**
+
+    :filename: string
+
+        The filename of the table to write.
+
+    :ionization_table: string, optional
+
+        The ion balance table to convert.  When set to None, it uses the
+        table specified in ~/.trident/config
+        Default: None
+
+    **Example**
+
+    Make a memory-mappable copy of the default ion table in shared memory
+    and add ion fields from it.
+
+    >>> import trident
+    >>> trident.make_flat_ion_table('/dev/shm/hm2012_hr_flat.h5')
+    >>> trident.add_ion_fields(ds, ions=['O VI'],
+    ...     ionization_table='/dev/shm/hm2012_hr_flat.h5')
+    """
+    if ionization_table is None:
+        ionization_table = ion_table_filepath
+
+    input = h5py.File(ionization_table, 'r')
+    output = h5py.File(filename, 'w')
+    for key, value in input.attrs.items():
+        output.attrs[key] = value
+    for name in input:
+        if not isinstance(input[name], h5py.Dataset):
+            input.copy(name, output)
+            continue
+        ionTable = IonBalanceTable(ionization_table, name)
+        dataset = output.create_dataset(name, data=ionTable.ion_fraction)
+        for key, value in input[name].attrs.items():
+            dataset.attrs[key] = value
+        del ionTable
+    output.attrs['flat_table'] = 1
+    output.close()
+    input.close()
+    mylog.info("Wrote flat ion table to %s." % filename)
+
 def _log_nH(field, data):
     """
     One index of ion balance table is in log of density, so this translates
@@ -170,6 +798,14 @@ def add_ion_fields(ds, ions, ftype='gas',
     photoionization in the optically thin limit from a redshift-dependent
     metagalactic ionizing background using the ionization_table specified.
 
+    The fields of all ions are added together, and the ion tables are not
+    read until a field is first used, so adding many ions is quick.  Unlike
+    yt's add_field, this skips yt's check of each new field's dependencies
+    when it is added.  The ion fields are listed in the dataset's
+    derived_field_list even if the dataset lacks a field they need, such
+    as metallicity, and the error is raised when they are used rather than
+    when they are added.
+
     **Parameters**
 
     :ds: yt dataset object
@@ -201,7 +837,8 @@ def add_ion_fields(ds, ions, ftype='gas',
 
         Determines whether or not to append a suffix to the field name that
         indicates what ionization table was used.  Useful when using generating
-        ion_fields that already exist in a dataset.
+        ion_fields that already exist in a dataset.  The suffix is added to
+        all four fields of each ion.
 
     :line_database: string, optional
 
@@ -269,13 +906,16 @@ def add_ion_fields(ds, ions, ftype='gas',
     # make sure ion list is unique
     ion_list = uniquify(ion_list)
 
-    # adding X_p#_ion_mass field triggers the addition of:
-    # - X_P#_ion_fraction
-    # - X_P#_number_density
-    # - X_P#_density
-    for (atom, ion) in ion_list:
-        add_ion_mass_field(atom, ion, ds, ftype, ionization_table,
-            field_suffix=field_suffix, sampling_type=sampling_type)
+    if not os.path.isfile(ionization_table):
+        raise RuntimeError("ionization_table %s is not found." %
+                           ionization_table)
+
+    # register the X_p#_ion_fraction, X_p#_number_density, X_p#_density,
+    # and X_p#_mass fields of all ions at once, reading the ion tables
+    # only when the fields are used
+    _add_ion_fields_bulk(ds, ion_list, ionization_table,
+                         field_suffix=field_suffix,
+                         sampling_type=sampling_type)
 
 def add_ion_fraction_field(atom, ion, ds, ftype="gas",
                            ionization_table=None,
@@ -374,11 +1014,9 @@ def add_ion_fraction_field(atom, ion, ds, ftype="gas",
         if ion == 1:
             alias_field += "_%s" % ionization_table.split(os.sep)[-1].split(".h5")[0]
 
-    if field not in table_store:
-        ionTable = IonBalanceTable(ionization_table, atom)
-        table_store[field] = {'fraction': copy.deepcopy(ionTable.ion_fraction[ion-1]),
-                              'parameters': copy.deepcopy(ionTable.parameters)}
-        del ionTable
+    # ion tables are held per element, so that all ions of an element
+    # can be interpolated at once
+    table_store.add(field, ionization_table, atom, ion)
 
     # if on-disk fields exist for calculation ion_fraction, use them
     if (("gas", "%s_p%d_number_density" % (atom, ion-1)) in ds.derived_field_list) and \
@@ -724,29 +1362,29 @@ def _ion_mass(field, data):
     # try the atom-specific density field first
     nuclei_field = "%s_nuclei_mass" % atom
     if (ftype, nuclei_field) in data.ds.field_info:
-        return data[ftype,fraction_field_name] * \
-          data[ftype, nuclei_field]
+        return _field_product([data[ftype,fraction_field_name],
+                               data[ftype, nuclei_field]])
 
     # try the species metallicity
     metallicity_field = "%s_metallicity" % atom
     if (ftype, metallicity_field) in data.ds.field_info:
-        return data[ftype,fraction_field_name] * \
-          data[ftype, "mass"] * \
-          data[ftype, metallicity_field]
+        return _field_product([data[ftype,fraction_field_name],
+                               data[ftype, "mass"],
+                               data[ftype, metallicity_field]])
     
     if atom == 'H' or atom == 'He':
-        mass_fraction = solar_abundance[atom] * data[ftype,fraction_field_name]
+        factors = [solar_abundance[atom], data[ftype,fraction_field_name]]
     else:
-        mass_fraction = data.ds.quan(solar_abundance[atom], "1.0/Zsun") * \
-          data[ftype, fraction_field_name] * \
-          data[ftype, "metallicity"]
+        factors = [data.ds.quan(solar_abundance[atom], "1.0/Zsun"),
+                   data[ftype, fraction_field_name],
+                   data[ftype, "metallicity"]]
     # convert to total mass
     # use the on disk hydrogen mass if possible
     if (ftype, "H_nuclei_mass") in data.ds.derived_field_list:
-        mass = mass_fraction * data[ftype, "H_nuclei_mass"]
+        factors.append(data[ftype, "H_nuclei_mass"])
     else:
-        mass = mass_fraction * data[ftype, "mass"] * H_mass_fraction
-    return mass
+        factors.extend([data[ftype, "mass"], H_mass_fraction])
+    return _field_product(factors)
 
 def _ion_density(field, data):
     """
@@ -787,30 +1425,296 @@ def _ion_number_density(field, data):
     # try the atom-specific density field first
     nuclei_field = "%s_nuclei_mass_density" % atom
     if (ftype, nuclei_field) in data.ds.field_info:
-        return data[ftype, fraction_field_name] * \
-          data[(ftype, nuclei_field)] / (atomic_mass[atom] * mh)
+        return _field_product([data[ftype, fraction_field_name],
+                               data[(ftype, nuclei_field)]],
+                              divisors=[atomic_mass[atom] * mh])
 
     # try the species metallicity
     metallicity_field = "%s_metallicity" % atom
     if (ftype, metallicity_field) in data.ds.field_info:
-        return data[ftype, fraction_field_name] * \
-          data[ftype, "density"] * \
-          data[ftype, metallicity_field] / \
-          atomic_mass[atom] / mh
+        return _field_product([data[ftype, fraction_field_name],
+                               data[ftype, "density"],
+                               data[ftype, metallicity_field]],
+                              divisors=[atomic_mass[atom], mh])
 
     if atom == 'H' or atom == 'He':
-        number_density = solar_abundance[atom] * data[ftype, fraction_field_name]
+        factors = [solar_abundance[atom], data[ftype, fraction_field_name]]
     else:
-        number_density = data.ds.quan(solar_abundance[atom], "1.0/Zsun") * \
-          data[ftype, fraction_field_name] * \
-          data[ftype, "metallicity"]
+        factors = [data.ds.quan(solar_abundance[atom], "1.0/Zsun"),
+                   data[ftype, fraction_field_name],
+                   data[ftype, "metallicity"]]
     # convert to number density
     # use the on disk hydrogen number density if possible
     if (ftype, "H_nuclei_density") in data.ds.derived_field_list:
-        number_density = number_density * data[ftype, "H_nuclei_density"]
+        factors.append(data[ftype, "H_nuclei_density"])
     else:
-        number_density = number_density * data[ftype, "density"] * to_nH
-    return number_density
+        factors.extend([data[ftype, "density"], to_nH])
+    return _field_product(factors)
+
+
+# the most results of each kind kept on a data object at once
+_chunk_cache_sizes = {"weights": 2, "blocks": 8}
+
+def _get_chunk_cache(data):
+    """
+    Get the dict of interpolation results stored on a data object for its
+    current chunk, emptying it if the chunk has changed.
+    """
+    chunk = getattr(data, "_current_chunk", None)
+    cache = getattr(data, "_ion_interpolation_cache", None)
+    if cache is None or cache["chunk"] is not chunk:
+        cache = {"chunk": chunk, "weights": OrderedDict(),
+                 "blocks": OrderedDict()}
+        data._ion_interpolation_cache = cache
+    return cache
+
+def _clear_chunk_cache(data):
+    """
+    Release the interpolation results stored on a data object.
+    """
+    if getattr(data, "_ion_interpolation_cache", None) is not None:
+        data._ion_interpolation_cache = None
+
+def _get_cached(cache, max_entries, key, inputs, function, *args):
+    """
+    Get a value from a chunk cache, making it with function if it is
+    missing or was made from different field arrays.
+
+    Entries only hold weak references to the field arrays, and are
+    dropped once any of them is freed, such as when the data object's
+    field data is cleared.  At most max_entries of the most recently
+    used entries are kept.
+    """
+    entry = cache.pop(key, None)
+    if entry is None or \
+      any(ref() is not new for ref, new in zip(entry[0], inputs)):
+        def _release(dead_ref):
+            current = cache.get(key)
+            if current is not None and \
+              any(ref is dead_ref for ref in current[0]):
+                del cache[key]
+        entry = (tuple(weakref.ref(value, _release) for value in inputs),
+                 function(*args))
+    cache[key] = entry
+    while len(cache) > max_entries:
+        cache.popitem(last=False)
+    return entry[1]
+
+def _get_interpolation_weights(data, field_names, parameters, clamp=False):
+    """
+    Get the table indices and interpolation weights for the cells of a
+    data object.
+
+    The bin search and weights depend only on the input fields and the
+    parameter grids of the table, not on the ion, so they are computed
+    once per chunk and stored on the data object.  All ion fraction
+    fields using tables with the same parameter grids then only gather
+    and blend table values.  As with yt's linear interpolators with
+    truncate=True, values outside of the table are extrapolated from
+    the nearest bins, unless clamp is set, in which case they take the
+    values at the table edges.
+
+    Returns a tuple of the shape of the input fields, the flattened table
+    index of each corner of the enclosing bin for each cell, and the
+    weight of each corner.
+    """
+    inputs = [data[name] for name in field_names]
+
+    # weights are not kept for FieldDetector objects, as their values
+    # are placeholders
+    if isinstance(data, FieldDetector):
+        return _compute_interpolation_weights(inputs, parameters, clamp)
+
+    key = (tuple(field_names),
+           tuple((par.dtype.str, par.size, par.tobytes())
+                 for par in parameters), clamp)
+    return _get_cached(_get_chunk_cache(data)["weights"],
+                       _chunk_cache_sizes["weights"], key, inputs,
+                       _compute_interpolation_weights, inputs, parameters,
+                       clamp)
+
+def _compute_interpolation_weights(inputs, parameters, clamp=False,
+                                   index=None, weights=None):
+    """
+    Compute the table indices and weights for linear interpolation over
+    each parameter of a table.
+
+    If index and weights are given, they are filled in place.
+    """
+    key = (tuple((par.dtype.str, par.size, par.tobytes())
+                 for par in parameters), clamp)
+    interpolator = _interpolators.get(key)
+    if interpolator is None:
+        interpolator = TableInterpolator(parameters, clamp=clamp)
+        _interpolators[key] = interpolator
+    return interpolator.weights(inputs, index=index, weights=weights)
+
+def _interpolate_ion_fractions(tables, ions, index, weights, linear=False):
+    """
+    Interpolate the log ion fractions of one or more ions and convert
+    them to ion fractions, with fractions below fraction_zero_point set
+    to zero.  If linear is set, the tables hold ion fractions, which are
+    interpolated directly.
+
+    tables holds the table of each ion, indexed by ion.  Returns an
+    array of shape (n_ions, n_cells), ordered as ions.
+    """
+    fractions = np.empty((len(ions), index.shape[1]))
+    for i, ion in enumerate(ions):
+        fractions[i] = (np.ravel(tables[ion])[index] * weights).sum(axis=0)
+    if not linear:
+        np.power(10, fractions, out=fractions)
+        fractions[fractions <= fraction_zero_point] = 0.0
+    return fractions
+
+def _get_ion_fraction_block(data, field_names, element_key, ions):
+    """
+    Get the ion fractions of several ions of an element for the cells
+    of a data object.
+
+    All ions are interpolated together and the result is stored on the
+    data object, so the ion fraction fields of every ion of the element,
+    and the fields derived from them, are served from one block.
+    Returns an array of shape (n_ions, n_cells), ordered as ions.
+    """
+    element_table = table_store.get_element(element_key)
+    parameters = element_table['parameters']
+    linear = table_store.linear
+    shape, index, weights = \
+      _get_interpolation_weights(data, field_names, parameters, clamp=linear)
+    tables = element_table['tables']
+    if isinstance(data, FieldDetector):
+        return _interpolate_ion_fractions(tables, ions, index, weights,
+                                          linear=linear)
+
+    inputs = [data[name] for name in field_names]
+    key = (tuple(field_names), element_key, tuple(ions),
+           linear, str(table_store.dtype))
+    return _get_cached(_get_chunk_cache(data)["blocks"],
+                       _chunk_cache_sizes["blocks"], key, inputs,
+                       _interpolate_ion_fractions, tables, ions, index,
+                       weights, linear)
+
+def _get_table_input(data, name, cells):
+    """
+    Get the values of an input field of the ion balance table for a
+    slice of the flattened cells of a data object.
+
+    Inputs defined by Trident's own log_nH, redshift and log_T functions
+    are computed from their source fields for the slice alone, so no
+    array of them is made for the whole data object.
+    """
+    # fields stored on a MemoryRay have no entry in its field info
+    try:
+        field = data.ds.field_info[name]
+    except KeyError:
+        field = None
+    # yt's DerivedField keeps its function as _function, and
+    # MemoryRayField as function
+    function = getattr(field, "_function", getattr(field, "function", None))
+    if function is _log_nH:
+        if ("gas", "H_nuclei_density") in data.ds.derived_field_list:
+            return np.log10(data["gas", "H_nuclei_density"].d.ravel()[cells])
+        return np.log10(data["gas", "density"].d.ravel()[cells] * to_nH.d)
+    if function is _log_T:
+        return np.log10(data["gas", "temperature"].d.ravel()[cells])
+    if function is _redshift:
+        try:
+            current_redshift = data.ds.current_redshift
+        except AttributeError:
+            current_redshift = 0.
+        return np.full(cells.stop - cells.start, current_redshift)
+    return data[name].d.ravel()[cells]
+
+def _sub_chunked_ion_fraction(data, field_names, ion_table, linear,
+                              cell_budget):
+    """
+    Interpolate the ion fraction of one ion in slices of at most
+    cell_budget cells.
+
+    The table inputs, indices, weights and table values of each slice
+    are held in scratch buffers reused from slice to slice, so beyond
+    the returned array, the memory used does not grow with the number
+    of cells.
+    """
+    shape = data["gas", "density"].shape
+    n_cells = int(np.prod(shape))
+    n_corners = 2**len(field_names)
+    table = np.ravel(ion_table['table'])
+    index_buffer = np.empty(n_corners * cell_budget, dtype=np.int64)
+    weights_buffer = np.empty(n_corners * cell_budget, dtype=np.float64)
+    values_buffer = np.empty(n_corners * cell_budget, dtype=table.dtype)
+
+    fraction = np.empty(n_cells)
+    for start in range(0, n_cells, cell_budget):
+        cells = slice(start, min(start + cell_budget, n_cells))
+        size = n_corners * (cells.stop - cells.start)
+        index = index_buffer[:size].reshape(n_corners, -1)
+        weights = weights_buffer[:size].reshape(n_corners, -1)
+        values = values_buffer[:size].reshape(n_corners, -1)
+        inputs = [_get_table_input(data, name, cells)
+                  for name in field_names]
+        _compute_interpolation_weights(inputs, ion_table['parameters'],
+                                       clamp=linear, index=index,
+                                       weights=weights)
+        np.take(table, index, out=values)
+        np.multiply(values, weights, out=weights)
+        weights.sum(axis=0, out=fraction[cells])
+    if not linear:
+        np.power(10, fraction, out=fraction)
+        fraction[fraction <= fraction_zero_point] = 0.0
+    return fraction.reshape(shape)
+
+def _field_product(factors, divisors=()):
+    """
+    Multiply field arrays and constants, in order, then divide by
+    constants.
+
+    If ion_field_cell_budget is set, the product is made in a single
+    output array, at most that many cells at a time, rather than with a
+    temporary array for each operation.
+    """
+    arrays = [factor for factor in factors
+              if isinstance(factor, np.ndarray) and factor.ndim > 0]
+    cell_budget = ion_field_cell_budget
+    if cell_budget is None or arrays[0].size <= cell_budget:
+        product = factors[0]
+        for factor in factors[1:]:
+            product = product * factor
+        for divisor in divisors:
+            product = product / divisor
+        return product
+
+    units = None
+    for factor in factors:
+        if hasattr(factor, "units"):
+            units = factor.units if units is None else units * factor.units
+    for divisor in divisors:
+        if hasattr(divisor, "units"):
+            units = units / divisor.units
+
+    def _values(factor):
+        if isinstance(factor, np.ndarray) and factor.ndim > 0:
+            return np.asarray(factor).ravel()
+        return float(factor)
+    values = [_values(factor) for factor in factors]
+    divisor_values = [float(divisor) for divisor in divisors]
+
+    product = np.empty(arrays[0].shape)
+    flat_product = product.reshape(-1)
+    for start in range(0, flat_product.size, cell_budget):
+        cells = slice(start, start + cell_budget)
+        out = flat_product[cells]
+        for i, value in enumerate(values):
+            if isinstance(value, np.ndarray):
+                value = value[cells]
+            if i == 0:
+                out[...] = value
+            else:
+                np.multiply(out, value, out=out)
+        for value in divisor_values:
+            np.divide(out, value, out=out)
+    return YTArray(product, units)
 
 def _ion_fraction_field(field, data):
     """
@@ -824,34 +1728,49 @@ def _ion_fraction_field(field, data):
     else:
         ftype = "gas"
         field_name = field.name
-    n_parameters = len(table_store[field_name]['parameters'])
-
-    if n_parameters == 1:
-        ionFraction = table_store[field_name]['fraction']
-        t_param = table_store[field_name]['parameters'][0]
-        bds = t_param.astype("=f8")
-
-        interp = UnilinearFieldInterpolator(ionFraction, bds, 'log_T', truncate=True)
-
-    elif n_parameters == 3:
-        ionFraction = table_store[field_name]['fraction']
-        n_param = table_store[field_name]['parameters'][0]
-        z_param = table_store[field_name]['parameters'][1]
-        t_param = table_store[field_name]['parameters'][2]
-        bds = [n_param.astype("=f8"), z_param.astype("=f8"), t_param.astype("=f8")]
-
-        interp = TrilinearFieldInterpolator(ionFraction, bds,
-                                            [(ftype, "log_nH"),
-                                             (ftype, "redshift"),
-                                             (ftype, "log_T")],
-                                            truncate=True)
-
+    ion_table = table_store[field_name]
+    parameters = ion_table['parameters']
+
+    if None in ion_table['parameter_fields']:
+        raise RuntimeError("This data file format is not supported.  "
+                           "Tables with %d parameters must give the field "
+                           "for each parameter." % len(parameters))
+    field_names = [(ftype, parameter_field)
+                   for parameter_field in ion_table['parameter_fields']]
+
+    # linear tables are already zeroed and capped, and clamping to the
+    # table edges keeps the results between 0 and 1
+    linear = table_store.linear
+    cell_budget = ion_field_cell_budget
+    if cell_budget is not None and not isinstance(data, FieldDetector) and \
+      data["gas", "density"].size > cell_budget:
+        fraction = _sub_chunked_ion_fraction(data, field_names, ion_table,
+                                             linear, cell_budget)
+        return _check_ion_fraction(fraction, field_name, linear)
+
+    shape, index, weights = \
+      _get_interpolation_weights(data, field_names, parameters, clamp=linear)
+
+    # if other ions of this element are in use, interpolate them together
+    ions = table_store.get_ions(ion_table['element'])
+    if len(ions) > 1:
+        fractions = _get_ion_fraction_block(data, field_names,
+                                            ion_table['element'], ions)
+        fraction = fractions[ions.index(ion_table['ion'])].copy()
     else:
-        raise RuntimeError("This data file format is not supported.")
-
-    fraction = np.power(10, interp(data))
-    fraction[fraction <= fraction_zero_point] = 0.0
-    if not isinstance(data, FieldDetector) and (fraction > 1.0).any():
+        fraction = _interpolate_ion_fractions(
+            [ion_table['table']], [0], index, weights, linear=linear)[0]
+    fraction = fraction.reshape(shape)
+    if isinstance(data, FieldDetector):
+        return fraction
+    return _check_ion_fraction(fraction, field_name, linear)
+
+def _check_ion_fraction(fraction, field_name, linear):
+    """
+    Cap ion fractions above 1, with a warning.  Fractions from linear
+    tables are always between 0 and 1, so they are not checked.
+    """
+    if not linear and (fraction > 1.0).any():
         greater_than = fraction > 1.0
         mylog.warning("%s > 1 was calculated. Capping values at 1." % field_name)
         mylog.warning("%d offenders: median = %f; maximum = %f" % (len(fraction[greater_than]), np.median(fraction[greater_than]), np.max(fraction[greater_than])))
@@ -883,6 +1802,126 @@ def _internal_ion_fraction_field(field, data):
     return data[(ftype, "%s_number_density" % ion)] / data[(ftype, "%s_nuclei_density" % atom)]
 
 
+def _add_ion_fields_bulk(ds, ion_list, ionization_table, field_suffix=False,
+                         sampling_type='local'):
+    """
+    Add the ion fraction, number density, density, and mass fields for a
+    list of (atom, ion) pairs in one update of the dataset's fields.
+
+    The fields added, and the existing fields they are aliased to, are
+    the same as those from calling add_ion_mass_field for each ion, but
+    all names are worked out first and the ion tables are not read.
+    yt's check_derived_fields is also skipped, as it would read every
+    table, so the tables are read and the field dependencies found when
+    each field is first used.  Fields are registered by keyword, as
+    FieldInfoContainer.add_field orders its arguments differently across
+    yt versions.
+    """
+    # make sure the field info exists, as in yt's add_field
+    is_dataset = isinstance(ds, Dataset)
+    if is_dataset:
+        ds.index
+    existing = set(ds.derived_field_list)
+    fields = []
+    aliases = []
+
+    def _plan_field(name, function, units):
+        if name in existing:
+            mylog.warning("Field %s already exists. Not clobbering." %
+                          str(name))
+            return
+        existing.add(name)
+        fields.append((name, function, units))
+
+    def _plan_alias(alias_name, name):
+        if alias_name in existing:
+            mylog.warning("Field %s already exists. Not clobbering." %
+                          str(alias_name))
+            return
+        existing.add(alias_name)
+        aliases.append((alias_name, name))
+
+    def _plan_ion_field(field, alias_field, function, units):
+        # temporary fix until p0 fields are fixed in yt
+        if alias_field is not None and alias_field in existing:
+            mylog.info('("gas", "%s") already exists, aliasing ("gas", "%s") '
+                       'to that.' % (alias_field[1], field[1]))
+            _plan_alias(field, alias_field)
+        else:
+            _plan_field(field, function, units)
+            if alias_field is not None:
+                _plan_alias(alias_field, field)
+
+    for name, function in [("log_nH", _log_nH), ("redshift", _redshift),
+                           ("log_T", _log_T)]:
+        if ("gas", name) not in existing:
+            _plan_field(("gas", name), function, "")
+
+    suffix = ""
+    if field_suffix:
+        suffix = "_%s" % ionization_table.split(os.sep)[-1].split(".h5")[0]
+
+    kinds = ["ion_fraction", "number_density", "density", "mass"]
+    for atom, ion in ion_list:
+        atom = atom.capitalize()
+        names = dict([(kind, ("gas", "%s_p%d_%s%s" %
+                              (atom, ion-1, kind, suffix)))
+                      for kind in kinds])
+        # if neutral ion field, alias X_<kind> to X_p0_<kind> field
+        if ion == 1:
+            alias_names = dict([(kind, ("gas", "%s_%s%s" %
+                                        (atom, kind, suffix)))
+                                for kind in kinds])
+        else:
+            alias_names = dict([(kind, None) for kind in kinds])
+
+        # an existing neutral number density field is aliased before the
+        # ion fraction field is added, so it can be used for the fraction
+        number_density_aliased = ion == 1 and \
+          alias_names["number_density"] in existing
+        if number_density_aliased:
+            _plan_ion_field(names["number_density"],
+                            alias_names["number_density"],
+                            _ion_number_density, "cm**-3")
+
+        table_store.add(names["ion_fraction"][1], ionization_table, atom, ion,
+                        read=False)
+        # if on-disk fields exist for calculation ion_fraction, use them
+        if ("gas", "%s_p%d_number_density" % (atom, ion-1)) in existing and \
+          ("gas", "%s_nuclei_density" % atom) in existing:
+            function = _internal_ion_fraction_field
+        else:
+            function = _ion_fraction_field
+        _plan_field(names["ion_fraction"], function, "")
+        if ion == 1:
+            _plan_alias(alias_names["ion_fraction"], names["ion_fraction"])
+
+        if not number_density_aliased:
+            _plan_ion_field(names["number_density"],
+                            alias_names["number_density"],
+                            _ion_number_density, "cm**-3")
+        _plan_ion_field(names["density"], alias_names["density"],
+                        _ion_density, "g/cm**3")
+        _plan_ion_field(names["mass"], alias_names["mass"], _ion_mass, "g")
+
+    # other objects, such as MemoryRays, take fields through their own
+    # add_field and alias
+    if not is_dataset:
+        for name, function, units in fields:
+            _add_field(ds, name, function, units, sampling_type)
+        for alias_name, name in aliases:
+            _alias_field(ds, alias_name, name)
+        return
+
+    for name, function, units in fields:
+        ds.field_info.add_field(name, function=function,
+                                sampling_type=sampling_type, units=units)
+    for alias_name, name in aliases:
+        ds.field_info.alias(alias_name, name)
+    ds.derived_field_list.extend([field[0] for field in fields] +
+                                 [alias[0] for alias in aliases])
+
+
 def _add_field(ds, name, function, units, sampling_type):
     """
     Private function for adding fields that wraps the yt add_field function.
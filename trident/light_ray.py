@@ -15,6 +15,7 @@ LightRay class and member functions.
 #-----------------------------------------------------------------------------
 
 import numpy as np
+import os
 
 from yt_astro_analysis.cosmological_observation.cosmology_splice import \
     CosmologySplice
@@ -24,15 +25,38 @@ from yt.frontends.ytdata.utilities import \
     save_as_dataset
 from yt.units.yt_array import \
     YTArray
+from yt.utilities.on_demand_imports import \
+    _h5py as h5py
 from yt.utilities.cosmology import \
     Cosmology
 from yt.utilities.logger import \
     ytLogger as mylog
 from yt.utilities.parallel_tools.parallel_analysis_interface import \
+    _get_comm, \
     parallel_objects, \
     parallel_root_only
 from yt.utilities.physical_constants import speed_of_light_cgs
 from yt.data_objects.static_output import Dataset
+from yt.geometry.grid_geometry_handler import \
+    GridIndex
+
+from trident.cosmology_table import \
+    get_cosmology_table
+from trident.dataset_cache import \
+    DatasetPrefetcher, \
+    dataset_cache
+from trident.memory_ray import \
+    MemoryRay
+from trident.ray_casting import \
+    cast_rays, \
+    _intersect_box
+
+# number of candidate rays drawn at a time in non_periodic_ray
+_non_periodic_batch_size = 256
+
+# fields that are not compared when compacting a light ray
+_compact_path_fields = ('l', 'dl')
+_compact_weighted_fields = ('x', 'y', 'z', 'redshift', 'redshift_eff')
 
 class LightRay(CosmologySplice):
     """
@@ -165,6 +189,8 @@ class LightRay(CosmologySplice):
             self.load_kwargs = load_kwargs
         self.light_ray_solution = []
         self._data = {}
+        self.merge_map = None
+        self._traversal_box_fractions = None
 
         # The options here are:
         # 1) User passed us a dataset: use it to make a simple ray
@@ -178,7 +204,8 @@ class LightRay(CosmologySplice):
                 self.ds = self.parameter_filename
                 self.parameter_filename = self.ds.basename
             elif isinstance(self.parameter_filename, str):
-                self.ds = load(self.parameter_filename, **self.load_kwargs)
+                self.ds = dataset_cache.load(self.parameter_filename,
+                                             **self.load_kwargs)
             if self.ds.cosmological_simulation:
                 redshift = self.ds.current_redshift
                 self.cosmology = Cosmology(
@@ -206,6 +233,50 @@ class LightRay(CosmologySplice):
                   time_data=time_data,
                   redshift_data=redshift_data)
 
+    def _deltaz_forward(self, z, target_distance):
+        """
+        _deltaz_forward(z, target_distance)
+
+        Calculate deltaz corresponding to moving a comoving distance
+        starting from some redshift.  This uses a comoving distance table
+        shared by all LightRays with the same cosmology instead of
+        integrating the cosmology each time.
+        """
+
+        cosmology_table = get_cosmology_table(self.cosmology, z_max=z)
+        return cosmology_table.deltaz_forward(z, target_distance)
+
+    def _get_traversal_box_fractions(self):
+        """
+        _get_traversal_box_fractions()
+
+        Get the fraction of the box traversed by each segment of a light
+        ray made from multiple datasets.  These do not depend on the
+        random seed, so they are only calculated once.
+        """
+
+        if self._traversal_box_fractions is not None:
+            return self._traversal_box_fractions
+
+        cosmology_table = get_cosmology_table(
+            self.cosmology,
+            z_max=max([my_segment['redshift']
+                       for my_segment in self.light_ray_solution]))
+        box_fractions = []
+        for q in range(len(self.light_ray_solution)):
+            if (q == len(self.light_ray_solution) - 1):
+                z_next = self.near_redshift
+            else:
+                z_next = self.light_ray_solution[q+1]['redshift']
+
+            # Calculate fraction of box required for a depth of delta z
+            box_fractions.append(
+                cosmology_table.comoving_radial_distance(z_next, \
+                    self.light_ray_solution[q]['redshift']).in_units("Mpccm / h") / \
+                    self.simulation.box_size)
+        self._traversal_box_fractions = box_fractions
+        return box_fractions
+
     def _calculate_light_ray_solution(self, seed=None,
                                       left_edge=None, right_edge=None,
                                       min_level=None, periodic=True,
@@ -245,18 +316,11 @@ class LightRay(CosmologySplice):
 
             # For box coherence, keep track of effective depth travelled.
             box_fraction_used = 0.0
+            box_fractions = self._get_traversal_box_fractions()
 
             for q in range(len(self.light_ray_solution)):
-                if (q == len(self.light_ray_solution) - 1):
-                    z_next = self.near_redshift
-                else:
-                    z_next = self.light_ray_solution[q+1]['redshift']
-
-                # Calculate fraction of box required for a depth of delta z
                 self.light_ray_solution[q]['traversal_box_fraction'] = \
-                    self.cosmology.comoving_radial_distance(z_next, \
-                        self.light_ray_solution[q]['redshift']).in_units("Mpccm / h") / \
-                        self.simulation.box_size
+                  box_fractions[q]
 
                 # Get dataset axis and center.
                 # If using box coherence, only get start point and vector if
@@ -270,7 +334,9 @@ class LightRay(CosmologySplice):
                         phi = 2 * np.pi * my_random.random_sample()
                         box_fraction_used = 0.0
                     else:
-                        ds = load(self.light_ray_solution[q]["filename"])
+                        ds = dataset_cache.load(
+                            self.light_ray_solution[q]["filename"],
+                            **self.load_kwargs)
                         ray_length = \
                           ds.quan(self.light_ray_solution[q]['traversal_box_fraction'],
                                   "unitary")
@@ -304,6 +370,248 @@ class LightRay(CosmologySplice):
                             'far_redshift':self.far_redshift,
                             'near_redshift':self.near_redshift})
 
+    def make_light_ray_solutions(self, seeds, periodic=True,
+                                 left_edge=None, right_edge=None,
+                                 min_level=None, filename=None):
+        """
+        Calculate the trajectories of many light rays, one for each seed,
+        without getting any data from the datasets.
+
+        The segment redshifts and lengths are calculated once and shared
+        by all solutions, so only the random start points and directions
+        are made for each seed.  The solution for a given seed is the
+        same as that made by :meth:`make_light_ray` with that seed.  The
+        solutions can be saved to a file and reloaded with
+        :func:`~trident.load_light_ray_solutions`, so that rays can be
+        made from them later or split among many jobs.
+
+        **Parameters**
+
+        :seeds: list of ints
+
+            The seed for the random number generator for each ray.
+
+        :periodic: optional, bool
+
+            If True, ray trajectories will make use of periodic
+            boundaries.
+            Default: True.
+
+        :left_edge: optional, iterable of floats or YTArray
+
+            The left corner of the region in which rays are to be
+            generated.  See :meth:`make_light_ray`.
+            Default: None.
+
+        :right_edge: optional, iterable of floats or YTArray
+
+            The right corner of the region in which rays are to be
+            generated.  See :meth:`make_light_ray`.
+            Default: None.
+
+        :min_level: optional, int
+
+            The minimum refinement level of the spatial region in which
+            the ray passes.  See :meth:`make_light_ray`.
+            Default: None.
+
+        :filename: optional, string
+
+            If given, the solutions are saved to this hdf5 file.
+            Default: None.
+
+        **Returns**
+
+            A list with the light ray solution for each seed.
+
+        **Example**
+
+        >>> import trident
+        >>> lr = trident.LightRay("enzo_cosmology_plus/AMRCosmology.enzo",
+        ...                       "Enzo", 0.0, 0.1)
+        >>> lr.make_light_ray_solutions(range(1000), filename="solutions.h5")
+        ...
+        >>> # later, possibly on another machine
+        >>> seeds, solutions = trident.load_light_ray_solutions("solutions.h5")
+        >>> for seed, solution in zip(seeds[::10], solutions[::10]):
+        ...     lr.make_light_ray(light_ray_solution=solution,
+        ...                       data_filename="ray_%d.h5" % seed)
+        """
+
+        if self.simulation_type is None:
+            raise RuntimeError(
+                "Light ray solutions can only be made for a simulation.")
+
+        left_edge, right_edge = self._get_region_edges(left_edge, right_edge)
+        seeds = list(seeds)
+        if periodic:
+            solutions = self._calculate_periodic_light_ray_solutions(
+                seeds, left_edge, right_edge)
+        else:
+            # non-periodic rays are placed by testing each dataset's
+            # grids, so they are made one seed at a time
+            base_solution = self.light_ray_solution
+            solutions = []
+            for seed in seeds:
+                self.light_ray_solution = \
+                  [dict([(key, val) for key, val in my_segment.items()
+                         if key not in ["start", "end"]])
+                   for my_segment in base_solution]
+                self._calculate_light_ray_solution(seed=seed,
+                                                   left_edge=left_edge,
+                                                   right_edge=right_edge,
+                                                   min_level=min_level,
+                                                   periodic=periodic)
+                solutions.append(self.light_ray_solution)
+            self.light_ray_solution = base_solution
+
+        if filename is not None:
+            self._write_light_ray_solutions(filename, seeds, solutions)
+        return solutions
+
+    def _calculate_periodic_light_ray_solutions(self, seeds,
+                                                left_edge, right_edge):
+        """
+        _calculate_periodic_light_ray_solutions(seeds, left_edge, right_edge)
+
+        Make the periodic light ray solution for every seed at once.
+        Which segments start a new trajectory does not depend on the
+        seed, so the random numbers for each seed are drawn in a single
+        call and the start and end points of each segment are computed
+        for all seeds together.  The results are the same as those of
+        _calculate_light_ray_solution.
+        """
+
+        box_fractions = self._get_traversal_box_fractions()
+        n_segments = len(self.light_ray_solution)
+
+        # Find the segments that start a new trajectory when using box
+        # coherence.
+        restart = []
+        box_fraction_used = 0.0
+        for q in range(n_segments):
+            restart.append((q == 0) or (box_fraction_used >=
+                                        self.minimum_coherent_box_fraction))
+            if restart[-1]:
+                box_fraction_used = 0.0
+            box_fraction_used += box_fractions[q]
+
+        # Each new trajectory uses 3 random numbers for its start point
+        # and 2 for its direction, drawn in that order.
+        n_draws = 5 * sum(restart)
+        draws = np.array([np.random.RandomState(seed).random_sample(n_draws)
+                          for seed in seeds]).reshape(len(seeds), -1, 5)
+
+        starts = []
+        ends = []
+        i_draw = 0
+        for q in range(n_segments):
+            if restart[q]:
+                start = left_edge + \
+                  (right_edge - left_edge) * draws[:, i_draw, :3]
+                theta = np.pi * draws[:, i_draw, 3]
+                phi = 2 * np.pi * draws[:, i_draw, 4]
+                i_draw += 1
+            else:
+                start = periodic_adjust(ends[-1][:],
+                                        left=left_edge, right=right_edge)
+            end = start + box_fractions[q] * self.simulation.box_size * \
+              np.array([np.cos(phi) * np.sin(theta),
+                        np.sin(phi) * np.sin(theta),
+                        np.cos(theta)]).T
+            starts.append(start)
+            ends.append(end)
+
+        solutions = []
+        for i in range(len(seeds)):
+            solution = []
+            for q, my_segment in enumerate(self.light_ray_solution):
+                my_segment = dict([(key, val) for key, val in my_segment.items()
+                                   if key not in ["start", "end"]])
+                my_segment['traversal_box_fraction'] = box_fractions[q]
+                my_segment['start'] = starts[q][i].copy()
+                my_segment['end'] = ends[q][i].copy()
+                solution.append(my_segment)
+            solutions.append(solution)
+        return solutions
+
+    def _set_light_ray_solution(self, light_ray_solution):
+        """
+        _set_light_ray_solution(light_ray_solution)
+
+        Use the trajectory of a precomputed light ray solution, such as
+        one from :func:`~trident.load_light_ray_solutions`.
+        """
+
+        if len(light_ray_solution) != len(self.light_ray_solution):
+            raise RuntimeError(
+                "Light ray solution has %d segments, but this LightRay "
+                "has %d." % (len(light_ray_solution),
+                             len(self.light_ray_solution)))
+        if self.simulation_type is None:
+            domain = self.ds
+        else:
+            domain = self.simulation
+        for my_segment, new_segment in \
+          zip(self.light_ray_solution, light_ray_solution):
+            if self.simulation_type is not None and \
+              os.path.basename(str(my_segment['filename'])) != \
+              os.path.basename(str(new_segment['filename'])):
+                raise RuntimeError(
+                    "Light ray solution uses dataset %s where this "
+                    "LightRay uses %s." % (new_segment['filename'],
+                                           my_segment['filename']))
+            for key in ['start', 'end']:
+                value = new_segment[key]
+                if hasattr(value, 'units'):
+                    value = domain.arr(value.d, str(value.units))
+                else:
+                    value = domain.arr(value, 'unitary')
+                my_segment[key] = value.to('unitary')
+            my_segment['traversal_box_fraction'] = \
+              new_segment['traversal_box_fraction']
+
+    @parallel_root_only
+    def _write_light_ray_solutions(self, filename, seeds, solutions):
+        """
+        _write_light_ray_solutions(filename, seeds, solutions)
+
+        Write a set of light ray solutions to an hdf5 file.  Segment
+        datasets and redshifts are stored once, and the start and end
+        points of every solution are stored as (seed, segment, axis)
+        arrays in unitary units.
+        """
+
+        mylog.info("Writing %d light ray solutions to %s." %
+                   (len(solutions), filename))
+        base_solution = solutions[0]
+        with h5py.File(filename, "w") as f:
+            f.attrs["data_type"] = "light_ray_solutions"
+            f.attrs["parameter_filename"] = str(self.parameter_filename)
+            for attr in ["near_redshift", "far_redshift"]:
+                value = getattr(self, attr)
+                if value is not None:
+                    f.attrs[attr] = value
+            f.create_dataset("seed", data=np.array(
+                [-1 if seed is None else seed for seed in seeds],
+                dtype=np.int64))
+            f.create_dataset("filename", data=np.array(
+                [str(my_segment['filename']) for my_segment in base_solution]
+            ).astype("|S"))
+            f.create_dataset("redshift", data=np.array(
+                [my_segment['redshift'] for my_segment in base_solution],
+                dtype=np.float64))
+            f.create_dataset("traversal_box_fraction", data=np.array(
+                [float(my_segment['traversal_box_fraction'])
+                 for my_segment in base_solution], dtype=np.float64))
+            for key in ["start", "end"]:
+                values = np.array(
+                    [[my_segment[key].to('unitary').d
+                      for my_segment in solution]
+                     for solution in solutions], dtype=np.float64)
+                dataset = f.create_dataset(key, data=values)
+                dataset.attrs["units"] = "unitary"
+
     def make_light_ray(self, seed=None, periodic=True,
                        left_edge=None, right_edge=None, min_level=None,
                        start_position=None, end_position=None,
@@ -311,13 +619,19 @@ class LightRay(CosmologySplice):
                        fields=None, setup_function=None,
                        solution_filename=None, data_filename=None,
                        get_los_velocity=None, use_peculiar_velocity=True,
-                       redshift=None, field_parameters=None, njobs=-1):
+                       redshift=None, field_parameters=None, njobs=-1,
+                       prefetch=0, compact=False,
+                       redshift_from_distance=False,
+                       light_ray_solution=None):
         """
         Actually generate the LightRay by traversing the desired dataset.
 
         A light ray consists of a list of field values for cells
         intersected by the ray and the path length of the ray through
-        those cells. Light ray data must be written out to an hdf5 file.
+        those cells.  If data_filename is given, the light ray data is
+        written to an hdf5 file and the ray is returned as a loaded yt
+        dataset.  Otherwise, the ray is returned as a
+        :class:`~trident.MemoryRay` without touching the disk.
 
         **Parameters**
 
@@ -398,7 +712,8 @@ class LightRay(CosmologySplice):
 
         :data_filename: optional, string
 
-            Path to output file for ray data.
+            Path to output file for ray data.  If None, the ray is not
+            written to disk and is returned as a :class:`~trident.MemoryRay`.
             Default: None.
 
         :use_peculiar_velocity: optional, bool
@@ -429,6 +744,60 @@ class LightRay(CosmologySplice):
             be split.  Choose -1 for one processor per segment.
             Default: -1.
 
+        :prefetch: optional, int
+
+            Used only for light rays made from multiple datasets and run
+            in serial.  The number of datasets to load in a background
+            thread ahead of the segment being processed, so that loading
+            the next dataset overlaps with getting data for the current
+            one.  Each prefetched dataset is held in memory until used,
+            separately from trident.dataset_cache.
+            Set to 0 to load each dataset only when it is needed.
+            Default: 0.
+
+        :compact: optional, bool
+
+            If True, consecutive cells along the ray with identical
+            values for all fields other than position, path length, and
+            redshift are merged into a single lixel.  The path lengths of
+            merged cells are summed and their positions and redshifts are
+            averaged, weighted by path length.  The number of cells in
+            each lixel is stored in the "cell_count" field, and the
+            path lengths of the original cells are kept in the merge_map
+            attribute of both the LightRay and the returned ray, as well
+            as in the ray file, so values for each lixel can be mapped
+            back onto the original cells with
+            :func:`~trident.light_ray.expand_compacted_field`.  Cells
+            are not merged across periodic boundaries or between
+            segments.
+            Default: False.
+
+        :redshift_from_distance: optional, bool
+
+            Used only for cosmological light rays.  If True, the redshift
+            of each cell is found from its comoving distance along the
+            segment using a cached redshift-distance table.  If False,
+            redshift is assumed to change linearly with distance along
+            each segment.
+            Default: False.
+
+        :light_ray_solution: optional, list of dicts
+
+            A precomputed light ray solution, such as one made by
+            :meth:`make_light_ray_solutions` and loaded with
+            :func:`~trident.load_light_ray_solutions`.  If given, the
+            ray follows this trajectory and seed, periodic, left_edge,
+            right_edge, min_level, start_position, end_position, and
+            trajectory are ignored.
+            Default: None.
+
+        **Returns**
+
+            If data_filename is given, the ray dataset loaded from that
+            file.  Otherwise, a :class:`~trident.MemoryRay`.  If the ray
+            passes through no cells with nonzero temperature, the
+            MemoryRay is empty and a warning is logged.
+
         **Examples**
 
         Make a light ray from multiple datasets:
@@ -459,23 +828,9 @@ class LightRay(CosmologySplice):
 
         """
 
-        if self.simulation_type is None:
-            domain = self.ds
-        else:
-            domain = self.simulation
+        left_edge, right_edge = self._get_region_edges(left_edge, right_edge)
 
         assumed_units = "code_length"
-        if left_edge is None:
-            left_edge = domain.domain_left_edge
-        elif not hasattr(left_edge, 'units'):
-            left_edge = domain.arr(left_edge, assumed_units)
-        left_edge.convert_to_units('unitary')
-
-        if right_edge is None:
-            right_edge = domain.domain_right_edge
-        elif not hasattr(right_edge, 'units'):
-            right_edge = domain.arr(right_edge, assumed_units)
-        right_edge.convert_to_units('unitary')
 
         if start_position is not None:
             if hasattr(start_position, 'units'):
@@ -496,228 +851,462 @@ class LightRay(CosmologySplice):
             mylog.warn("'get_los_velocity' kwarg is deprecated. " + \
                        "Use 'use_peculiar_velocity' instead.")
 
-        # Calculate solution.
-        self._calculate_light_ray_solution(seed=seed,
-                                           left_edge=left_edge,
-                                           right_edge=right_edge,
-                                           min_level=min_level, periodic=periodic,
-                                           start_position=start_position,
-                                           end_position=end_position,
-                                           trajectory=trajectory,
-                                           filename=solution_filename)
+        # Calculate solution, or use the one given.
+        if light_ray_solution is not None:
+            self._set_light_ray_solution(light_ray_solution)
+            if solution_filename is not None:
+                self._write_light_ray_solution(solution_filename,
+                    extra_info={'parameter_filename':self.parameter_filename,
+                                'far_redshift':self.far_redshift,
+                                'near_redshift':self.near_redshift})
+        else:
+            self._calculate_light_ray_solution(seed=seed,
+                                               left_edge=left_edge,
+                                               right_edge=right_edge,
+                                               min_level=min_level, periodic=periodic,
+                                               start_position=start_position,
+                                               end_position=end_position,
+                                               trajectory=trajectory,
+                                               filename=solution_filename)
 
         if field_parameters is None:
             field_parameters = {}
 
         # Initialize data structures.
         self._data = {}
-        # temperature field is automatically added to fields
         if fields is None: fields = []
-        if (('gas', 'temperature') not in fields) and \
-           ('temperature' not in fields):
-           fields.append(('gas', 'temperature'))
-        data_fields = fields[:]
-        all_fields = fields[:]
-        all_fields.extend(['l', 'dl', 'redshift'])
-        all_fields.extend(['x', 'y', 'z'])
-        data_fields.extend(['x', 'y', 'z'])
-        if use_peculiar_velocity:
-            all_fields.extend(['relative_velocity_x', 'relative_velocity_y',
-                               'relative_velocity_z',
-                               'velocity_los', 'redshift_eff',
-                               'redshift_dopp'])
-            data_fields.extend(['relative_velocity_x', 'relative_velocity_y', 'relative_velocity_z'])
+        all_fields, data_fields = _get_ray_fields(fields, use_peculiar_velocity)
+
+        # Load upcoming datasets in the background while each segment
+        # is processed.  This relies on segments being handled in order,
+        # so it is only done in serial.
+        prefetcher = None
+        if prefetch > 0 and self.ds is None:
+            if _get_comm(()).size > 1:
+                mylog.warn("Dataset prefetching is only available in " +
+                           "serial.  Ignoring prefetch.")
+            else:
+                prefetcher = DatasetPrefetcher(
+                    [my_segment['filename']
+                     for my_segment in self.light_ray_solution],
+                    depth=prefetch, load_kwargs=self.load_kwargs)
+                prefetched = iter(prefetcher)
+
+        cosmology_table = None
+        if redshift_from_distance and \
+          getattr(self, "cosmology", None) is not None:
+            cosmology_table = get_cosmology_table(
+                self.cosmology,
+                z_max=max([my_segment['redshift']
+                           for my_segment in self.light_ray_solution]))
 
         all_ray_storage = {}
-        for my_storage, my_segment in parallel_objects(self.light_ray_solution,
-                                                       storage=all_ray_storage,
-                                                       njobs=njobs):
-
-            # In case of simple rays, use the already loaded dataset: self.ds,
-            # otherwise, load dataset for segment.
-            if self.ds is None:
-                ds = load(my_segment['filename'], **self.load_kwargs)
-            else:
-                ds = self.ds
+        # stop the prefetching thread even if a segment fails
+        try:
+            for my_storage, my_segment in parallel_objects(self.light_ray_solution,
+                                                           storage=all_ray_storage,
+                                                           njobs=njobs):
+
+                # In case of simple rays, use the already loaded dataset: self.ds,
+                # otherwise, load dataset for segment.
+                if self.ds is not None:
+                    ds = self.ds
+                elif prefetcher is not None:
+                    ds = next(prefetched)
+                else:
+                    ds = dataset_cache.load(my_segment['filename'],
+                                            **self.load_kwargs)
 
-            if redshift is not None:
-                if ds.cosmological_simulation and redshift != ds.current_redshift:
-                    mylog.warn("Generating light ray with different redshift than " +
-                               "the dataset itself.")
-                my_segment["redshift"] = redshift
+                if redshift is not None:
+                    if ds.cosmological_simulation and redshift != ds.current_redshift:
+                        mylog.warn("Generating light ray with different redshift than " +
+                                   "the dataset itself.")
+                    my_segment["redshift"] = redshift
 
-            if setup_function is not None:
-                setup_function(ds)
+                if setup_function is not None:
+                    setup_function(ds)
 
-            if not ds.cosmological_simulation:
-                next_redshift = my_segment["redshift"]
-            elif self.near_redshift == self.far_redshift:
-                if isinstance(my_segment["traversal_box_fraction"], YTArray) and \
-                  not my_segment["traversal_box_fraction"].units.is_dimensionless:
-                    segment_length = \
-                      my_segment["traversal_box_fraction"].in_units("Mpccm / h")
-                else:
-                    segment_length = my_segment["traversal_box_fraction"] * \
-                      ds.domain_width[0].in_units("Mpccm / h")
-                next_redshift = my_segment["redshift"] - \
-                  self._deltaz_forward(my_segment["redshift"],
-                                       segment_length)
-            elif my_segment.get("next", None) is None:
-                next_redshift = self.near_redshift
-            else:
-                next_redshift = my_segment['next']['redshift']
-
-            # Make sure start, end, left, right
-            # are using the dataset's unit system.
-            my_start = ds.arr(my_segment['start'])
-            my_end   = ds.arr(my_segment['end'])
-            my_left  = ds.arr(left_edge)
-            my_right = ds.arr(right_edge)
-            mylog.info("Getting segment at z = %s: %s to %s." %
-                       (my_segment['redshift'], my_start, my_end))
-
-            # Break periodic ray into non-periodic segments.
-            sub_segments = periodic_ray(my_start, my_end,
-                                        left=my_left, right=my_right)
-
-            # Prepare data structure for subsegment.
+                sub_data = self._get_segment_data(
+                    ds, my_segment, all_fields, data_fields,
+                    left_edge, right_edge, use_peculiar_velocity,
+                    field_parameters, cosmology_table=cosmology_table)
+
+                # Add to storage.
+                my_storage.result = sub_data
+
+                del ds
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+
+        # Reconstruct ray data from parallel_objects storage.
+        all_data = _join_segment_data(list(all_ray_storage.values()),
+                                      self.light_ray_solution)
+
+        self.merge_map = None
+        if compact:
+            all_data, self.merge_map = _compact_light_ray_data(
+                _mask_light_ray_data(all_data,
+                                     allow_empty=data_filename is None))
+
+        self._data = all_data
+
+        if data_filename is not None:
+            self._write_light_ray(data_filename, all_data)
+            ray_ds = load(data_filename)
+            ray_ds.merge_map = self.merge_map
+            return ray_ds
+        else:
+            return self._make_memory_ray(all_data)
+
+    def __getitem__(self, field):
+        return self._data[field]
+
+    def _make_simple_rays(self, start_positions, end_positions, fields=None,
+                          setup_function=None, use_peculiar_velocity=True,
+                          redshift=None, field_parameters=None):
+        """
+        _make_simple_rays(start_positions, end_positions, fields=None,
+                          setup_function=None, use_peculiar_velocity=True,
+                          redshift=None, field_parameters=None)
+
+        Make many simple rays through the dataset in a single pass and
+        return them as a list of MemoryRays.  See
+        :func:`~trident.make_simple_rays`.
+        """
+
+        if self.ds is None:
+            raise RuntimeError(
+                "Multiple rays can only be made from a single dataset.")
+        ds = self.ds
+
+        if len(start_positions) != len(end_positions):
+            raise RuntimeError(
+                "start_positions and end_positions must have the same length.")
+
+        if setup_function is not None:
+            setup_function(ds)
+        if field_parameters is None:
+            field_parameters = {}
+        if fields is None: fields = []
+        all_fields, data_fields = _get_ray_fields(fields, use_peculiar_velocity)
+
+        segment_redshift = self.light_ray_solution[0]['redshift']
+        if redshift is not None:
+            if ds.cosmological_simulation and redshift != ds.current_redshift:
+                mylog.warn("Generating light ray with different redshift than " +
+                           "the dataset itself.")
+            segment_redshift = redshift
+
+        my_left = ds.domain_left_edge.to('unitary')
+        my_right = ds.domain_right_edge.to('unitary')
+
+        # Build the solution for each ray and break periodic rays into
+        # non-periodic subsegments.
+        segments = []
+        sub_segments = []
+        ray_index = []
+        for i, (start, end) in enumerate(zip(start_positions, end_positions)):
+            if not hasattr(start, 'units'):
+                start = ds.arr(start, 'code_length')
+            if not hasattr(end, 'units'):
+                end = ds.arr(end, 'code_length')
+            start = ds.arr(start).to('unitary')
+            end = ds.arr(end).to('unitary')
+            segments.append({"filename": self.parameter_filename,
+                             "redshift": segment_redshift,
+                             "start": start, "end": end,
+                             "traversal_box_fraction": vector_length(start, end),
+                             "unique_identifier": ds.unique_identifier})
+            for sub_segment in periodic_ray(start, end,
+                                            left=my_left, right=my_right):
+                sub_segments.append(sub_segment)
+                ray_index.append(i)
+
+        sub_segment_data = cast_rays(ds, [sub[0] for sub in sub_segments],
+                                     [sub[1] for sub in sub_segments],
+                                     data_fields,
+                                     field_parameters=field_parameters)
+
+        rays = []
+        for i, my_segment in enumerate(segments):
             sub_data = {}
-            # Put supplementary data that we want communicated across
-            # processors in here.
-            sub_data['extra_data'] = {}
-            sub_data['extra_data']['segment_redshift'] = \
-              my_segment['redshift']
-            sub_data['extra_data']['unique_identifier'] = \
-              ds.unique_identifier
             for field in all_fields:
                 sub_data[field] = []
 
-            # Get data for all subsegments in segment.
-            for sub_segment in sub_segments:
-                mylog.info("Getting subsegment: %s to %s." %
-                           (list(sub_segment[0]), list(sub_segment[1])))
-                sub_ray = ds.ray(sub_segment[0], sub_segment[1])
-                for key, val in field_parameters.items():
-                    sub_ray.set_field_parameter(key, val)
-                asort = np.argsort(sub_ray["t"])
-                sub_data['l'].extend(sub_ray['t'][asort] *
-                                     vector_length(sub_ray.start_point,
-                                                   sub_ray.end_point))
-                sub_data['dl'].extend(sub_ray['dts'][asort] *
-                                      vector_length(sub_ray.start_point,
-                                                    sub_ray.end_point))
-
+            for sub_segment, data, my_index in \
+              zip(sub_segments, sub_segment_data, ray_index):
+                if my_index != i or data is None:
+                    continue
+                sub_length = vector_length(sub_segment[0], sub_segment[1])
+                sub_data['l'].append(data['t'] * sub_length)
+                sub_data['dl'].append(data['dts'] * sub_length)
                 for field in data_fields:
-                    sub_data[field].extend(sub_ray[field][asort])
+                    sub_data[field].append(data[field])
 
                 if use_peculiar_velocity:
                     line_of_sight = sub_segment[0] - sub_segment[1]
                     line_of_sight /= ((line_of_sight**2).sum())**0.5
-                    sub_vel = ds.arr([sub_ray['relative_velocity_x'],
-                                      sub_ray['relative_velocity_y'],
-                                      sub_ray['relative_velocity_z']])
-                    # Line of sight velocity = vel_los
-                    sub_vel_los = (np.rollaxis(sub_vel, 1) * \
-                                   line_of_sight).sum(axis=1)
-                    sub_data['velocity_los'].extend(sub_vel_los[asort])
-
-                    # doppler redshift:
-                    # See https://en.wikipedia.org/wiki/Redshift and
-                    # Peebles eqns: 5.48, 5.49
-
-                    # 1 + redshift_dopp = (1 + v*cos(theta)/c) /
-                    # sqrt(1 - v**2/c**2)
-
-                    # where v is the peculiar velocity (ie physical velocity
-                    # without the hubble flow, but no hubble flow in sim, so
-                    # just the physical velocity).
-
-                    # the bulk of the doppler redshift is from line of sight
-                    # motion, but there is a small amount from time dilation
-                    # of transverse motion, hence the inclusion of theta (the
-                    # angle between line of sight and the velocity).
-                    # theta is the angle between the ray vector (i.e. line of
-                    # sight) and the velocity vectors: a dot b = ab cos(theta)
-
-                    sub_vel_mag = sub_ray['velocity_magnitude']
-                    cos_theta = line_of_sight.dot(sub_vel) / sub_vel_mag
-                    # Protect against stituations where velocity mag is exactly
-                    # zero, in which case zero / zero = NaN.
-                    cos_theta = np.nan_to_num(cos_theta)
-                    redshift_dopp = \
-                        (1 + sub_vel_mag * cos_theta / speed_of_light_cgs) / \
-                         np.sqrt(1 - sub_vel_mag**2 / speed_of_light_cgs**2) - 1
-                    sub_data['redshift_dopp'].extend(redshift_dopp[asort])
-                    del sub_vel, sub_vel_los, sub_vel_mag, cos_theta, \
-                        redshift_dopp
-
-                sub_ray.clear_data()
-                del sub_ray, asort
-
-            for key in sub_data:
-                if key == "extra_data":
-                    continue
-                sub_data[key] = ds.arr(sub_data[key]).in_cgs()
+                    sub_vel_los, redshift_dopp = \
+                      _get_peculiar_velocity(line_of_sight,
+                                             data['relative_velocity_x'],
+                                             data['relative_velocity_y'],
+                                             data['relative_velocity_z'])
+                    sub_data['velocity_los'].append(sub_vel_los)
+                    sub_data['redshift_dopp'].append(redshift_dopp)
+
+            # a ray missing the dataset gives an empty ray, rather than
+            # stopping the others from being made
+            if not sub_data['dl']:
+                mylog.warning("Ray %d passes through no cells.  Returning "
+                              "an empty ray." % i)
+                for field in all_fields:
+                    sub_data[field] = YTArray(np.empty(0), "")
+                rays.append(self._make_memory_ray(
+                    sub_data, light_ray_solution=[my_segment]))
+                continue
+
+            next_redshift = self._get_next_redshift(ds, my_segment)
+            _finish_segment_data(sub_data, all_fields,
+                                 my_segment['redshift'], next_redshift,
+                                 vector_length(my_segment['start'],
+                                               my_segment['end']).in_cgs(),
+                                 use_peculiar_velocity)
+            rays.append(self._make_memory_ray(
+                sub_data, light_ray_solution=[my_segment]))
+
+        return rays
+
+    def _get_region_edges(self, left_edge, right_edge):
+        """
+        _get_region_edges(left_edge, right_edge)
 
-            # Get redshift for each lixel.  Assume linear relation between l
-            # and z.  so z = z_start - (l * (z_range / l_range))
-            sub_data['redshift'] = my_segment['redshift'] - \
-              (sub_data['l'] * \
-              (my_segment['redshift'] - next_redshift) / \
-              vector_length(my_start, my_end).in_cgs())
+        Get the edges of the region in which rays are generated in
+        unitary units, defaulting to the domain edges.
+        """
 
-            # When using the peculiar velocity, create effective redshift
-            # (redshift_eff) field combining cosmological redshift and
-            # doppler redshift.
+        if self.simulation_type is None:
+            domain = self.ds
+        else:
+            domain = self.simulation
 
-            # then to add cosmological redshift and doppler redshifts, follow
-            # eqn 3.75 in Peacock's Cosmological Physics:
-            # 1 + z_eff = (1 + z_cosmo) * (1 + z_doppler)
+        assumed_units = "code_length"
+        if left_edge is None:
+            left_edge = domain.domain_left_edge
+        elif not hasattr(left_edge, 'units'):
+            left_edge = domain.arr(left_edge, assumed_units)
+        left_edge.convert_to_units('unitary')
 
-            if use_peculiar_velocity:
-               sub_data['redshift_eff'] = ((1 + sub_data['redshift_dopp']) * \
-                                            (1 + sub_data['redshift'])) - 1
+        if right_edge is None:
+            right_edge = domain.domain_right_edge
+        elif not hasattr(right_edge, 'units'):
+            right_edge = domain.arr(right_edge, assumed_units)
+        right_edge.convert_to_units('unitary')
 
-            # Remove empty lixels.
-            sub_dl_nonzero = sub_data['dl'].nonzero()
-            for field in all_fields:
-                sub_data[field] = sub_data[field][sub_dl_nonzero]
-            del sub_dl_nonzero
+        return left_edge, right_edge
 
-            # Add to storage.
-            my_storage.result = sub_data
+    def _make_compound_rays(self, seeds, periodic=True,
+                            left_edge=None, right_edge=None, min_level=None,
+                            fields=None, setup_function=None,
+                            use_peculiar_velocity=True,
+                            field_parameters=None, njobs=-1,
+                            solutions=None, redshift_from_distance=False):
+        """
+        _make_compound_rays(seeds, periodic=True,
+                            left_edge=None, right_edge=None, min_level=None,
+                            fields=None, setup_function=None,
+                            use_peculiar_velocity=True,
+                            field_parameters=None, njobs=-1,
+                            solutions=None, redshift_from_distance=False)
+
+        Make a compound ray for each seed, loading each dataset only once,
+        and return them as a list of MemoryRays.  If precomputed solutions
+        are given, they are used instead of making solutions from the
+        seeds.  See :func:`~trident.make_compound_rays`.
+        """
+
+        if self.simulation_type is None:
+            raise RuntimeError(
+                "Multiple compound rays can only be made from a simulation.")
+
+        left_edge, right_edge = self._get_region_edges(left_edge, right_edge)
+        if field_parameters is None:
+            field_parameters = {}
+        if fields is None: fields = []
+        all_fields, data_fields = _get_ray_fields(fields, use_peculiar_velocity)
 
+        # Calculate the solution for every ray before loading any data.
+        if solutions is None:
+            solutions = self.make_light_ray_solutions(
+                seeds, periodic=periodic, left_edge=left_edge,
+                right_edge=right_edge, min_level=min_level)
+        else:
+            base_solution = self.light_ray_solution
+            given_solutions = solutions
+            solutions = []
+            for solution in given_solutions:
+                self.light_ray_solution = \
+                  [dict(my_segment) for my_segment in base_solution]
+                self._set_light_ray_solution(solution)
+                solutions.append(self.light_ray_solution)
+            self.light_ray_solution = base_solution
+
+        cosmology_table = None
+        if redshift_from_distance and \
+          getattr(self, "cosmology", None) is not None:
+            cosmology_table = get_cosmology_table(
+                self.cosmology,
+                z_max=max([my_segment['redshift']
+                           for solution in solutions
+                           for my_segment in solution]))
+
+        # Group the segments of all rays by dataset.
+        filenames = []
+        tasks = {}
+        for i, solution in enumerate(solutions):
+            for q, my_segment in enumerate(solution):
+                if my_segment['filename'] not in tasks:
+                    filenames.append(my_segment['filename'])
+                    tasks[my_segment['filename']] = []
+                tasks[my_segment['filename']].append((i, q))
+
+        # Load each dataset once and get all segments passing through it.
+        all_storage = {}
+        for my_storage, filename in parallel_objects(filenames,
+                                                     storage=all_storage,
+                                                     njobs=njobs):
+            ds = dataset_cache.load(filename, **self.load_kwargs)
+            if setup_function is not None:
+                setup_function(ds)
+            mylog.info("Getting %d segments from %s." %
+                       (len(tasks[filename]), filename))
+            results = {}
+            for i, q in tasks[filename]:
+                results[(i, q)] = self._get_segment_data(
+                    ds, solutions[i][q], all_fields, data_fields,
+                    left_edge, right_edge, use_peculiar_velocity,
+                    field_parameters, cosmology_table=cosmology_table)
+            my_storage.result = results
             del ds
 
-        # Reconstruct ray data from parallel_objects storage.
-        all_data = [my_data for my_data in all_ray_storage.values()]
-        # This is now a list of segments where each one is a dictionary
-        # with all the fields.
-        all_data.sort(key=lambda a:a['extra_data']['segment_redshift'],
-                      reverse=True)
-
-        # Gather segment data to add to the light ray solution.
-        for segment_data, my_segment in \
-          zip(all_data, self.light_ray_solution):
-            my_segment["unique_identifier"] = \
-              segment_data["extra_data"]["unique_identifier"]
-
-        # Flatten the list into a single dictionary containing fields
-        # for the whole ray.
-        all_data = _flatten_dict_list(
-            all_data, exceptions=['extra_data'])
+        segment_data = {}
+        for results in all_storage.values():
+            segment_data.update(results)
+
+        # Reassemble the segments of each ray.
+        rays = []
+        for i, solution in enumerate(solutions):
+            ray_data = _join_segment_data(
+                [segment_data[(i, q)] for q in range(len(solution))], solution)
+            rays.append(self._make_memory_ray(
+                ray_data, light_ray_solution=solution))
+        return rays
+
+    def _get_segment_data(self, ds, my_segment, all_fields, data_fields,
+                          left_edge, right_edge, use_peculiar_velocity,
+                          field_parameters, cosmology_table=None):
+        """
+        _get_segment_data(ds, my_segment, all_fields, data_fields,
+                          left_edge, right_edge, use_peculiar_velocity,
+                          field_parameters, cosmology_table=None)
 
-        self._data = all_data
+        Get the ray data for one segment of a light ray solution from
+        the loaded dataset for that segment.
+        """
 
-        if data_filename is not None:
-            self._write_light_ray(data_filename, all_data)
-            ray_ds = load(data_filename)
-            return ray_ds
-        else:
-            return None
+        next_redshift = self._get_next_redshift(ds, my_segment)
+
+        # Make sure start, end, left, right
+        # are using the dataset's unit system.
+        my_start = ds.arr(my_segment['start'])
+        my_end   = ds.arr(my_segment['end'])
+        my_left  = ds.arr(left_edge)
+        my_right = ds.arr(right_edge)
+        mylog.info("Getting segment at z = %s: %s to %s." %
+                   (my_segment['redshift'], my_start, my_end))
+
+        # Break periodic ray into non-periodic segments.
+        sub_segments = periodic_ray(my_start, my_end,
+                                    left=my_left, right=my_right)
+
+        # Prepare data structure for subsegment.  Each field holds a
+        # list of arrays, one per subsegment, to be joined at the end.
+        sub_data = {}
+        # Put supplementary data that we want communicated across
+        # processors in here.
+        sub_data['extra_data'] = {}
+        sub_data['extra_data']['segment_redshift'] = \
+          my_segment['redshift']
+        sub_data['extra_data']['unique_identifier'] = \
+          ds.unique_identifier
+        for field in all_fields:
+            sub_data[field] = []
+
+        # Get data for all subsegments in segment.
+        for sub_segment in sub_segments:
+            mylog.info("Getting subsegment: %s to %s." %
+                       (list(sub_segment[0]), list(sub_segment[1])))
+            sub_ray = ds.ray(sub_segment[0], sub_segment[1])
+            for key, val in field_parameters.items():
+                sub_ray.set_field_parameter(key, val)
+            asort = np.argsort(sub_ray["t"])
+            sub_data['l'].append(sub_ray['t'][asort] *
+                                 vector_length(sub_ray.start_point,
+                                               sub_ray.end_point))
+            sub_data['dl'].append(sub_ray['dts'][asort] *
+                                  vector_length(sub_ray.start_point,
+                                                sub_ray.end_point))
+
+            for field in data_fields:
+                sub_data[field].append(sub_ray[field][asort])
 
-    def __getitem__(self, field):
-        return self._data[field]
+            if use_peculiar_velocity:
+                line_of_sight = sub_segment[0] - sub_segment[1]
+                line_of_sight /= ((line_of_sight**2).sum())**0.5
+                sub_vel_los, redshift_dopp = \
+                  _get_peculiar_velocity(line_of_sight,
+                                         sub_ray['relative_velocity_x'][asort],
+                                         sub_ray['relative_velocity_y'][asort],
+                                         sub_ray['relative_velocity_z'][asort])
+                sub_data['velocity_los'].append(sub_vel_los)
+                sub_data['redshift_dopp'].append(redshift_dopp)
+                del sub_vel_los, redshift_dopp
+
+            sub_ray.clear_data()
+            del sub_ray, asort
+
+        _finish_segment_data(sub_data, all_fields,
+                             my_segment['redshift'], next_redshift,
+                             vector_length(my_start, my_end).in_cgs(),
+                             use_peculiar_velocity,
+                             cosmology_table=cosmology_table)
+
+        return sub_data
+
+    def _get_next_redshift(self, ds, my_segment):
+        """
+        _get_next_redshift(ds, my_segment)
+
+        Get the redshift at the end of a light ray segment.
+        """
+
+        if not ds.cosmological_simulation:
+            return my_segment["redshift"]
+        elif self.near_redshift == self.far_redshift:
+            if isinstance(my_segment["traversal_box_fraction"], YTArray) and \
+              not my_segment["traversal_box_fraction"].units.is_dimensionless:
+                segment_length = \
+                  my_segment["traversal_box_fraction"].in_units("Mpccm / h")
+            else:
+                segment_length = my_segment["traversal_box_fraction"] * \
+                  ds.domain_width[0].in_units("Mpccm / h")
+            return my_segment["redshift"] - \
+              self._deltaz_forward(my_segment["redshift"],
+                                   segment_length)
+        elif my_segment.get("next", None) is None:
+            return self.near_redshift
+        else:
+            return my_segment['next']['redshift']
 
     @parallel_root_only
     def _write_light_ray(self, filename, data):
@@ -771,20 +1360,53 @@ class LightRay(CosmologySplice):
 
         field_types = dict([(field, "grid") for field in data.keys()])
 
-        # Only return LightRay elements with non-zero density
-        if 'temperature' in data: f = 'temperature'
-        if ('gas', 'temperature') in data: f = ('gas', 'temperature')
-        if 'temperature' in data or ('gas', 'temperature') in data:
-            mask = data[f] > 0
-            if not np.any(mask):
-                raise RuntimeError(
-                    "No zones along light ray with nonzero %s. "
-                    "Please modify your light ray trajectory." % (f,))
-            for key in data.keys():
-                data[key] = data[key][mask]
+        _mask_light_ray_data(data)
         save_as_dataset(ds, filename, data, field_types=field_types,
                         extra_attrs=extra_attrs)
 
+        # keep the original cells of a compacted ray alongside its fields
+        if self.merge_map is not None:
+            with h5py.File(filename, "a") as f:
+                group = f.create_group("merge_map")
+                group.create_dataset("cell_count",
+                                     data=self.merge_map['cell_count'])
+                dataset = group.create_dataset(
+                    "dl", data=self.merge_map['dl'].d)
+                dataset.attrs["units"] = str(self.merge_map['dl'].units)
+
+    def _make_memory_ray(self, data, light_ray_solution=None):
+        """
+        _make_memory_ray(data, light_ray_solution=None)
+
+        Create a MemoryRay from light ray data without writing it to disk.
+        """
+
+        if self.simulation_type is None:
+            current_redshift = getattr(self.ds, "current_redshift", 0.)
+            cosmological_simulation = \
+              getattr(self.ds, "cosmological_simulation", False)
+        else:
+            current_redshift = self.near_redshift
+            cosmological_simulation = self.simulation.cosmological_simulation
+
+        if light_ray_solution is None:
+            light_ray_solution = self.light_ray_solution
+        solution = []
+        for my_segment in light_ray_solution:
+            solution.append(
+                dict([(key, val) for key, val in my_segment.items()
+                      if key not in ["next", "previous", "index"]]))
+
+        data = _mask_light_ray_data(dict(data), allow_empty=True)
+        if data['dl'].size == 0:
+            mylog.warning("Light ray passes through no cells with nonzero "
+                          "temperature.  Returning an empty ray.")
+        return MemoryRay(data, current_redshift=current_redshift,
+                         cosmological_simulation=bool(cosmological_simulation),
+                         light_ray_solution=solution,
+                         merge_map=self.merge_map,
+                         name="LightRay")
+
     @parallel_root_only
     def _write_light_ray_solution(self, filename, extra_info=None):
         """
@@ -808,6 +1430,238 @@ class LightRay(CosmologySplice):
                      my_segment['filename']))
         f.close()
 
+def load_light_ray_solutions(filename, indices=None):
+    """
+    Load light ray solutions saved with
+    :meth:`~trident.LightRay.make_light_ray_solutions`.
+
+    **Parameters**
+
+    :filename: string
+
+        The hdf5 file containing the solutions.
+
+    :indices: optional, list of ints or slice
+
+        The solutions to load.  Use this to split the solutions among
+        several jobs.  If None, all solutions are loaded.
+        Default: None
+
+    **Returns**
+
+        The list of seeds and the list of solutions.  The start and end
+        points of each segment are arrays in unitary units.  Each
+        solution can be given to :meth:`~trident.LightRay.make_light_ray` or
+        :func:`~trident.make_compound_rays` for a LightRay made with the
+        same simulation and redshift range.
+
+    **Example**
+
+    Make the rays for every fourth solution.
+
+    >>> import trident
+    >>> seeds, solutions = trident.load_light_ray_solutions(
+    ...     "solutions.h5", indices=slice(0, None, 4))
+    """
+
+    with h5py.File(filename, "r") as f:
+        if f.attrs.get("data_type", b"") not in \
+          ("light_ray_solutions", b"light_ray_solutions"):
+            raise RuntimeError(
+                "%s does not contain light ray solutions." % filename)
+        if indices is None:
+            indices = slice(None)
+        elif not isinstance(indices, slice):
+            indices = np.atleast_1d(indices)
+        seeds = f["seed"][()][indices]
+        filenames = [name.decode("utf-8") if isinstance(name, bytes)
+                     else str(name) for name in f["filename"][()]]
+        redshifts = f["redshift"][()]
+        box_fractions = f["traversal_box_fraction"][()]
+        # start and end points are in unitary units, which are only
+        # defined for a given dataset, so they are kept as plain arrays
+        points = dict([(key, f[key][()][indices])
+                       for key in ["start", "end"]])
+
+    solutions = []
+    for i in range(seeds.size):
+        solution = []
+        for q in range(len(filenames)):
+            my_segment = {"filename": filenames[q],
+                          "redshift": redshifts[q],
+                          "traversal_box_fraction": box_fractions[q]}
+            for key, values in points.items():
+                my_segment[key] = values[i, q]
+            solution.append(my_segment)
+        solutions.append(solution)
+    seeds = [None if seed < 0 else int(seed) for seed in seeds]
+    return seeds, solutions
+
+def _join_segment_data(all_data, light_ray_solution):
+    """
+    _join_segment_data(all_data, light_ray_solution)
+
+    Join the data for the segments of a light ray into a single dictionary
+    containing fields for the whole ray.
+    """
+
+    # This is a list of segments where each one is a dictionary
+    # with all the fields.
+    all_data.sort(key=lambda a:a['extra_data']['segment_redshift'],
+                  reverse=True)
+
+    # Gather segment data to add to the light ray solution.
+    for segment_data, my_segment in \
+      zip(all_data, light_ray_solution):
+        my_segment["unique_identifier"] = \
+          segment_data["extra_data"]["unique_identifier"]
+
+    # Flatten the list into a single dictionary containing fields
+    # for the whole ray.
+    return _flatten_dict_list(
+        all_data, exceptions=['extra_data'])
+
+def _mask_light_ray_data(data, allow_empty=False):
+    """
+    _mask_light_ray_data(data, allow_empty=False)
+
+    Only keep LightRay elements with non-zero temperature.  If no
+    elements are left, raise an error unless allow_empty is set.
+    """
+
+    if 'temperature' in data: f = 'temperature'
+    if ('gas', 'temperature') in data: f = ('gas', 'temperature')
+    if 'temperature' in data or ('gas', 'temperature') in data:
+        mask = data[f] > 0
+        if not np.any(mask) and not allow_empty:
+            raise RuntimeError(
+                "No zones along light ray with nonzero %s. "
+                "Please modify your light ray trajectory." % (f,))
+        for key in data.keys():
+            data[key] = data[key][mask]
+    return data
+
+def _compact_light_ray_data(data):
+    """
+    _compact_light_ray_data(data)
+
+    Merge consecutive lixels with identical values for all fields other
+    than position, path length, and redshift.  Lixels are not merged
+    across the start of a new segment or periodic subsegment, where the
+    distance along the ray, l, starts again from zero.  Returns the
+    compacted data and a dict with the number of cells merged into each
+    lixel and the path lengths of the original cells.
+    """
+
+    dl = data['dl']
+    n_cells = dl.size
+    if n_cells == 0:
+        return data, {'cell_count': np.zeros(0, dtype=np.int64), 'dl': dl}
+    same = np.ones(n_cells - 1, dtype=bool)
+    for key, values in data.items():
+        name = key[1] if isinstance(key, tuple) else key
+        if name == 'l':
+            values = np.asarray(values)
+            same &= values[1:] > values[:-1]
+        if name in _compact_path_fields or name in _compact_weighted_fields:
+            continue
+        values = np.asarray(values)
+        same &= values[1:] == values[:-1]
+
+    lixel_start = np.concatenate([[0], np.where(~same)[0] + 1]).astype(np.int64)
+    cell_count = np.diff(np.append(lixel_start, n_cells))
+    if lixel_start.size == n_cells:
+        mylog.info("No lixels to merge in light ray.")
+    else:
+        mylog.info("Merged %d cells into %d lixels." %
+                   (n_cells, lixel_start.size))
+
+    dl_sum = np.add.reduceat(dl.d, lixel_start)
+    compact_data = {}
+    for key, values in data.items():
+        name = key[1] if isinstance(key, tuple) else key
+        if name == 'dl':
+            compact_data[key] = YTArray(dl_sum, dl.units)
+        elif name in _compact_weighted_fields:
+            weighted = np.add.reduceat(values.d * dl.d, lixel_start)
+            compact_data[key] = YTArray(weighted / dl_sum, values.units)
+        else:
+            compact_data[key] = values[lixel_start]
+    compact_data['cell_count'] = YTArray(cell_count.astype(np.float64), "")
+
+    merge_map = {'cell_count': cell_count, 'dl': dl.copy()}
+    return compact_data, merge_map
+
+def expand_compacted_field(values, cell_count, weights=None):
+    """
+    Map values for each lixel of a compacted light ray back onto the
+    original cells.
+
+    **Parameters**
+
+    :values: array
+
+        The values for each lixel of the compacted ray.
+
+    :cell_count: array of ints
+
+        The number of original cells in each lixel, as stored in the
+        "cell_count" field of a compacted ray.
+
+    :weights: optional, array
+
+        Per-cell weights, such as the original path lengths stored in
+        the merge_map attribute of the ray, or read from a ray file with
+        :func:`~trident.light_ray.load_merge_map`.  If
+        given, each lixel value is split among its cells in proportion
+        to their weights, which is appropriate for extensive quantities
+        like column density.  If None, each cell is given the value of
+        its lixel.
+        Default: None
+
+    **Example**
+
+    >>> import trident
+    >>> lr = trident.LightRay(ds)
+    >>> ray = lr.make_light_ray(start_position=ds.domain_left_edge,
+    ...                         end_position=ds.domain_right_edge,
+    ...                         fields=['density'], compact=True)
+    >>> dl = trident.light_ray.expand_compacted_field(
+    ...     ray.r['dl'], ray.r['cell_count'], weights=ray.merge_map['dl'])
+    """
+    cell_count = np.asarray(cell_count).astype(np.int64)
+    expanded = np.repeat(values, cell_count)
+    if weights is None:
+        return expanded
+    lixel_start = np.cumsum(cell_count) - cell_count
+    weights = np.asarray(weights, dtype=np.float64)
+    total = np.repeat(np.add.reduceat(weights, lixel_start), cell_count)
+    return expanded * (weights / total)
+
+def load_merge_map(filename):
+    """
+    Read the merge map of a compacted light ray from its ray file.
+
+    Returns a dict with the number of original cells in each lixel,
+    "cell_count", and the path lengths of the original cells, "dl", or
+    None if the ray was not compacted.
+
+    **Parameters**
+
+    :filename: string
+
+        The ray file written by :meth:`~trident.LightRay.make_light_ray`.
+    """
+    with h5py.File(filename, "r") as f:
+        if "merge_map" not in f:
+            return None
+        group = f["merge_map"]
+        units = group["dl"].attrs["units"]
+        if isinstance(units, bytes):
+            units = units.decode("utf8")
+        return {'cell_count': group["cell_count"][()],
+                'dl': YTArray(group["dl"][()], units)}
+
 def _flatten_dict_list(data, exceptions=None):
     """
     _flatten_dict_list(data, exceptions=None)
@@ -822,11 +1676,169 @@ def _flatten_dict_list(data, exceptions=None):
                       if field not in exceptions]:
             if field not in new_data:
                 new_data[field] = []
-            new_data[field].extend(datum[field])
+            new_data[field].append(datum[field])
     for field in new_data:
-        new_data[field] = YTArray(new_data[field])
+        new_data[field] = _concatenate_arrays(new_data[field])
     return new_data
 
+def _get_ray_fields(fields, use_peculiar_velocity):
+    """
+    _get_ray_fields(fields, use_peculiar_velocity)
+
+    Get the list of all fields stored on a light ray and the list of fields
+    sampled from the dataset to produce them.
+    """
+
+    # temperature field is automatically added to fields
+    if (('gas', 'temperature') not in fields) and \
+       ('temperature' not in fields):
+       fields.append(('gas', 'temperature'))
+    data_fields = fields[:]
+    all_fields = fields[:]
+    all_fields.extend(['l', 'dl', 'redshift'])
+    all_fields.extend(['x', 'y', 'z'])
+    data_fields.extend(['x', 'y', 'z'])
+    if use_peculiar_velocity:
+        all_fields.extend(['relative_velocity_x', 'relative_velocity_y',
+                           'relative_velocity_z',
+                           'velocity_los', 'redshift_eff',
+                           'redshift_dopp'])
+        data_fields.extend(['relative_velocity_x', 'relative_velocity_y', 'relative_velocity_z'])
+    return all_fields, data_fields
+
+def _get_peculiar_velocity(line_of_sight, velocity_x, velocity_y,
+                           velocity_z):
+    """
+    _get_peculiar_velocity(line_of_sight, velocity_x, velocity_y,
+                           velocity_z)
+
+    Get the line of sight velocity and doppler redshift of cells with
+    the given velocity components.
+
+    The calculation is done on the unitless arrays in the units of
+    velocity_x, reusing one work array, so no velocity magnitude field
+    or unit-carrying temporaries are needed.  The velocity magnitude
+    used for the time dilation is that of the given components, i.e.,
+    of the velocity relative to any 'bulk_velocity' field parameter.
+    This is the same as yt's velocity_magnitude field, which also
+    subtracts the bulk velocity when it is set.
+    """
+
+    units = velocity_x.units
+    c = speed_of_light_cgs.in_units(units).d
+    line_of_sight = np.asarray(line_of_sight, dtype=np.float64)
+    velocity = [v.d if v.units == units else v.in_units(units).d
+                for v in (velocity_x, velocity_y, velocity_z)]
+
+    # Line of sight velocity = vel_los, and squared velocity magnitude
+    velocity_los = np.multiply(velocity[0], line_of_sight[0])
+    velocity_sq = np.square(velocity[0])
+    work = np.empty_like(velocity_los)
+    for ax in range(1, 3):
+        velocity_los += np.multiply(velocity[ax], line_of_sight[ax],
+                                    out=work)
+        velocity_sq += np.square(velocity[ax], out=work)
+
+    # doppler redshift:
+    # See https://en.wikipedia.org/wiki/Redshift and
+    # Peebles eqns: 5.48, 5.49
+
+    # 1 + redshift_dopp = (1 + v*cos(theta)/c) /
+    # sqrt(1 - v**2/c**2)
+
+    # where v is the peculiar velocity (ie physical velocity
+    # without the hubble flow, but no hubble flow in sim, so
+    # just the physical velocity).
+
+    # the bulk of the doppler redshift is from line of sight
+    # motion, but there is a small amount from time dilation
+    # of transverse motion, hence the inclusion of theta (the
+    # angle between line of sight and the velocity).
+    # Since theta is the angle between the ray vector (i.e. line of
+    # sight) and the velocity vector, v*cos(theta) is just the line
+    # of sight velocity, which also avoids dividing by zero velocity.
+
+    velocity_sq /= -c**2
+    velocity_sq += 1
+    np.sqrt(velocity_sq, out=velocity_sq)
+    redshift_dopp = np.divide(velocity_los, c)
+    redshift_dopp += 1
+    redshift_dopp /= velocity_sq
+    redshift_dopp -= 1
+    return YTArray(velocity_los, units), YTArray(redshift_dopp, "")
+
+def _finish_segment_data(sub_data, fields, segment_redshift, next_redshift,
+                         segment_length, use_peculiar_velocity,
+                         cosmology_table=None):
+    """
+    _finish_segment_data(sub_data, fields, segment_redshift, next_redshift,
+                         segment_length, use_peculiar_velocity,
+                         cosmology_table=None)
+
+    Join the subsegment arrays for each field of a light ray segment,
+    add the redshift fields, and remove empty lixels.  If a cosmology
+    table is given, redshifts are found from the comoving distance
+    along the segment rather than assuming a linear relation.
+    """
+
+    for key in sub_data:
+        if key == "extra_data":
+            continue
+        sub_data[key] = _concatenate_arrays(sub_data[key]).in_cgs()
+
+    if cosmology_table is None:
+        # Get redshift for each lixel.  Assume linear relation between l
+        # and z.  so z = z_start - (l * (z_range / l_range))
+        sub_data['redshift'] = segment_redshift - \
+          (sub_data['l'] * \
+          (segment_redshift - next_redshift) / segment_length)
+    else:
+        # Get redshift for each lixel from the fraction of the comoving
+        # distance travelled along the segment.
+        fraction = (sub_data['l'] / segment_length).in_units("").d
+        sub_data['redshift'] = YTArray(
+            cosmology_table.redshift_along_segment(
+                segment_redshift, next_redshift, fraction), "")
+
+    # When using the peculiar velocity, create effective redshift
+    # (redshift_eff) field combining cosmological redshift and
+    # doppler redshift.
+
+    # then to add cosmological redshift and doppler redshifts, follow
+    # eqn 3.75 in Peacock's Cosmological Physics:
+    # 1 + z_eff = (1 + z_cosmo) * (1 + z_doppler)
+
+    if use_peculiar_velocity:
+       sub_data['redshift_eff'] = ((1 + sub_data['redshift_dopp']) * \
+                                    (1 + sub_data['redshift'])) - 1
+
+    # Remove empty lixels.
+    sub_dl_nonzero = sub_data['dl'].nonzero()
+    for field in fields:
+        sub_data[field] = sub_data[field][sub_dl_nonzero]
+    return sub_data
+
+def _concatenate_arrays(arrays):
+    """
+    _concatenate_arrays(arrays)
+
+    Join a list of arrays into a single YTArray with the units of the
+    first array.  This is much faster than building a YTArray from a
+    list of YTQuantities.
+    """
+
+    if len(arrays) == 0:
+        return YTArray(np.empty(0), "")
+    units = getattr(arrays[0], "units", None)
+    if units is None:
+        return YTArray(np.concatenate(arrays), "")
+    values = []
+    for array in arrays:
+        if array.units != units:
+            array = array.to(units)
+        values.append(array.d)
+    return YTArray(np.concatenate(values), units)
+
 def vector_length(start, end):
     """
     vector_length(start, end)
@@ -949,26 +1961,91 @@ def non_periodic_ray(ds, left_edge, right_edge, ray_length, max_iter=5000,
 
     if my_random is None:
         my_random = np.random.RandomState()
+
+    # For grid datasets, the minimum level check is done with the grid
+    # edges instead of building a ray object for each candidate.
+    level_grids = _get_level_grids(ds, min_level)
+
+    # Draw candidates in batches, using the random numbers in the same
+    # order as drawing one candidate at a time.
     i = 0
-    while True:
-        start = my_random.random_sample(3) * \
-          (right_edge - left_edge) + left_edge
-        theta = np.pi * my_random.random_sample()
-        phi = 2 * np.pi * my_random.random_sample()
-        end = start + ray_length * \
+    while i <= max_iter:
+        n_batch = min(_non_periodic_batch_size, max_iter + 1 - i)
+        state = my_random.get_state()
+        samples = my_random.random_sample((n_batch, 5))
+        starts = samples[:, :3] * (right_edge - left_edge) + left_edge
+        theta = np.pi * samples[:, 3]
+        phi = 2 * np.pi * samples[:, 4]
+        ends = starts + ray_length * \
           np.array([np.cos(phi) * np.sin(theta),
                     np.sin(phi) * np.sin(theta),
-                    np.cos(theta)])
-        i += 1
+                    np.cos(theta)]).T
+        in_box = ((ends >= left_edge) & (ends <= right_edge)).all(axis=1)
+
+        for k in np.where(in_box)[0]:
+            if not _ray_above_level(ds, starts[k], ends[k],
+                                    min_level, level_grids):
+                continue
+            # leave the random state as if only k + 1 candidates were drawn
+            my_random.set_state(state)
+            my_random.random_sample((k + 1, 5))
+            mylog.info("Found ray after %d attempts." % (i + k + 1))
+            return starts[k], ends[k]
+        i += n_batch
+
+    raise RuntimeError(
+        ("Failed to create segment in %d attempts.  " +
+         "Decreasing ray length is recommended") % i)
+
+def _get_level_grids(ds, min_level):
+    """
+    Get the edges, in unitary units, of the grids at min_level.
+
+    Returns None if no level check is needed or if the dataset does not
+    have a grid index.
+    """
+    if min_level is None or min_level <= 0 or \
+      not isinstance(ds.index, GridIndex):
+        return None
+    on_level = ds.index.grid_levels.flatten() == min_level
+    return (ds.index.grid_left_edge[on_level].to('unitary').d,
+            ds.index.grid_right_edge[on_level].to('unitary').d)
+
+def _ray_above_level(ds, start, end, min_level, level_grids):
+    """
+    Check that a ray only passes through cells at min_level or higher.
+
+    With grid edges, this is true when the ray is entirely covered by
+    grids at min_level, since all higher level grids are nested within
+    them.  Otherwise, a ray object is made and its cell levels are read.
+    """
+    if min_level is None or min_level <= 0:
+        return True
+    if level_grids is None:
         test_ray = ds.ray(start, end)
-        if (end >= left_edge).all() and (end <= right_edge).all() and \
-          (min_level is None or min_level <= 0 or
-           (test_ray["grid_level"] >= min_level).all()):
-            mylog.info("Found ray after %d attempts." % i)
-            del test_ray
-            return start, end
+        above = (test_ray["grid_level"] >= min_level).all()
         del test_ray
-        if i > max_iter:
-            raise RuntimeError(
-                ("Failed to create segment in %d attempts.  " +
-                 "Decreasing ray length is recommended") % i)
+        return above
+
+    grid_left, grid_right = level_grids
+    if grid_left.shape[0] == 0:
+        return False
+    start = ds.arr(start).to('unitary').d
+    vector = ds.arr(end).to('unitary').d - start
+    t_enter, t_exit = _intersect_box(
+        np.tile(start, (grid_left.shape[0], 1)),
+        np.tile(vector, (grid_left.shape[0], 1)),
+        grid_left, grid_right)
+    hit = t_exit > t_enter
+    if not hit.any():
+        return False
+    t_enter = t_enter[hit]
+    t_exit = t_exit[hit]
+    asort = np.argsort(t_enter)
+    t_enter = t_enter[asort]
+    covered = np.maximum.accumulate(t_exit[asort])
+
+    # the ray is covered if there are no gaps between the grid intervals
+    tol = 1e-10
+    return t_enter[0] <= tol and covered[-1] >= 1 - tol and \
+      (t_enter[1:] <= covered[:-1] + tol).all()
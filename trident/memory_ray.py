@@ -0,0 +1,259 @@
+"""
+MemoryRay class and member functions.
+
+"""
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2017, Trident Development Team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+#-----------------------------------------------------------------------------
+
+from yt.units.yt_array import \
+    YTArray, \
+    YTQuantity
+
+def _field_key(field):
+    """
+    Return the ("gas", name) key under which a ray field is stored.
+
+    All fields on a ray are gas fields, so bare field names and fields
+    with any other field type (e.g., "grid") map onto the "gas" type.
+    """
+    if isinstance(field, tuple):
+        return ("gas", field[1])
+    return ("gas", field)
+
+class MemoryRayField(object):
+    """
+    A derived field defined on a :class:`~trident.MemoryRay`.
+
+    Field functions are called as function(field, data), where field is
+    this object and data is the ray, following the yt convention.
+    """
+    def __init__(self, name, function, units):
+        self.name = name
+        self.function = function
+        self.units = units
+
+class MemoryRayFieldInfo(object):
+    """
+    Container of the derived fields defined on a :class:`~trident.MemoryRay`.
+
+    Membership tests include the fields stored on the ray itself, so this
+    can be queried in the same way as a yt dataset's field_info.
+    """
+    def __init__(self, ray):
+        self.ray = ray
+        self.fields = {}
+
+    def __contains__(self, field):
+        key = _field_key(field)
+        return key in self.fields or key in self.ray.field_data
+
+    def __getitem__(self, field):
+        return self.fields[_field_key(field)]
+
+    def __setitem__(self, field, value):
+        self.fields[_field_key(field)] = value
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def alias(self, alias_name, original_name, units=None):
+        """
+        Make alias_name return the values of original_name.
+        """
+        original_key = _field_key(original_name)
+
+        def _alias(field, data):
+            return data[original_key]
+        self[alias_name] = MemoryRayField(_field_key(alias_name), _alias, units)
+
+class MemoryRay(object):
+    """
+    A light ray whose field data is held entirely in memory.
+
+    A MemoryRay provides the subset of the yt dataset interface used by
+    :class:`~trident.SpectrumGenerator` and the ion field functions in
+    :mod:`trident.ion_balance`, so it can be passed anywhere a loaded ray
+    dataset can be used without first writing the ray to disk.  Derived
+    fields, such as ion number densities, can be added to it with
+    :class:`~trident.add_ion_number_density_field` and friends.
+
+    **Parameters**
+
+    :data: dict
+
+        Dictionary of ray fields.  Keys may be field names or (ftype, name)
+        tuples; all fields are stored with the "gas" field type.  Values
+        should be YTArrays; anything else is treated as dimensionless.
+
+    :current_redshift: optional, float
+
+        The redshift of the ray.
+        Default: 0.
+
+    :cosmological_simulation: optional, bool
+
+        Whether the ray was made from a cosmological simulation.
+        Default: False
+
+    :light_ray_solution: optional, list of dicts
+
+        The light ray solution used to make the ray.
+        Default: None
+
+    :parameters: optional, dict
+
+        Any additional metadata to be kept with the ray.
+        Default: None
+
+    :merge_map: optional, dict
+
+        For a compacted ray, the number of original cells in each lixel
+        and their path lengths, as made by
+        :meth:`~trident.LightRay.make_light_ray`.
+        Default: None
+
+    :name: optional, string
+
+        A name used when printing the ray.
+        Default: "MemoryRay"
+
+    **Example**
+
+    >>> import trident
+    >>> from yt.units.yt_array import YTArray
+    >>> ray = trident.MemoryRay(
+    ...     {'density': YTArray([1e-26], 'g/cm**3'),
+    ...      'temperature': YTArray([1e4], 'K'),
+    ...      'metallicity': YTArray([0.3], 'Zsun'),
+    ...      'dl': YTArray([10.], 'kpc'),
+    ...      'redshift': [0.], 'redshift_eff': [0.],
+    ...      'velocity_los': YTArray([0.], 'cm/s')})
+    >>> sg = trident.SpectrumGenerator('COS')
+    >>> sg.make_spectrum(ray)
+    """
+    def __init__(self, data, current_redshift=0.,
+                 cosmological_simulation=False, light_ray_solution=None,
+                 parameters=None, merge_map=None, name="MemoryRay"):
+        self.field_data = {}
+        for field, value in data.items():
+            if not isinstance(value, YTArray):
+                value = YTArray(value, "")
+            self.field_data[_field_key(field)] = value
+        self.current_redshift = current_redshift
+        self.cosmological_simulation = cosmological_simulation
+        if light_ray_solution is None:
+            light_ray_solution = []
+        self.light_ray_solution = light_ray_solution
+        if parameters is None:
+            parameters = {}
+        self.parameters = parameters
+        self.merge_map = merge_map
+        self.basename = name
+        self.field_info = MemoryRayFieldInfo(self)
+        self._derived_data = {}
+
+    @property
+    def ds(self):
+        """
+        The ray itself, for compatibility with yt data containers.
+        """
+        return self
+
+    @property
+    def r(self):
+        """
+        The ray itself, for compatibility with yt's ds.r interface.
+        """
+        return self
+
+    def all_data(self):
+        """
+        The ray itself, for compatibility with yt's ds.all_data().
+        """
+        return self
+
+    @property
+    def field_list(self):
+        """
+        The fields stored on the ray.
+        """
+        return list(self.field_data)
+
+    @property
+    def derived_field_list(self):
+        """
+        The fields stored on the ray plus any derived fields added to it.
+        """
+        return self.field_list + \
+          [field for field in self.field_info if field not in self.field_data]
+
+    def has_field(self, field):
+        """
+        Return True if the field is stored on or can be derived for the ray.
+        """
+        return field in self.field_info
+
+    def add_field(self, name, function=None, units=None,
+                  sampling_type=None, force_override=False, **kwargs):
+        """
+        Add a derived field to the ray.  Arguments follow yt's add_field.
+        """
+        key = _field_key(name)
+        if key in self.field_info and not force_override:
+            return
+        self.field_info[key] = MemoryRayField(key, function, units)
+        self._derived_data.pop(key, None)
+
+    def __getitem__(self, field):
+        key = _field_key(field)
+        if key in self.field_data:
+            return self.field_data[key]
+        if key in self._derived_data:
+            return self._derived_data[key]
+        if key not in self.field_info:
+            raise KeyError("Field %s not found on %s." % (str(field), self))
+
+        field_def = self.field_info[key]
+        value = field_def.function(field_def, self)
+        units = field_def.units
+        if not isinstance(value, YTArray):
+            value = YTArray(value, units or "")
+        elif units:
+            value = value.in_units(units)
+        self._derived_data[key] = value
+        return value
+
+    def __contains__(self, field):
+        return self.has_field(field)
+
+    def __len__(self):
+        if not self.field_data:
+            return 0
+        return next(iter(self.field_data.values())).size
+
+    def clear_data(self):
+        """
+        Drop any cached derived field values.
+        """
+        self._derived_data.clear()
+
+    def arr(self, value, units):
+        """
+        Create a YTArray, for compatibility with yt's ds.arr.
+        """
+        return YTArray(value, units)
+
+    def quan(self, value, units):
+        """
+        Create a YTQuantity, for compatibility with yt's ds.quan.
+        """
+        return YTQuantity(value, units)
+
+    def __repr__(self):
+        return self.basename
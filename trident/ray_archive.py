@@ -0,0 +1,566 @@
+"""
+RayArchive class and member functions.
+
+"""
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2017, Trident Development Team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+#-----------------------------------------------------------------------------
+
+import numpy as np
+import os
+
+from yt.convenience import \
+    load
+from yt.data_objects.static_output import \
+    Dataset
+from yt.units.unit_registry import \
+    UnitParseError
+from yt.units.yt_array import \
+    YTArray
+from yt.utilities.exceptions import \
+    YTUnitConversionError
+from yt.utilities.on_demand_imports import \
+    _h5py as h5py
+
+from trident.light_ray import \
+    load_merge_map
+from trident.memory_ray import \
+    MemoryRay, \
+    _field_key
+
+# per-ray metadata columns and their shapes beyond the ray axis
+_ray_columns = {"start": (3,), "end": (3,), "current_redshift": (),
+                "seed": ()}
+
+class RayArchive(object):
+    """
+    A collection of many light rays stored together in one HDF5 file.
+
+    Rays are stored as concatenated field columns with an offsets array,
+    so the data for ray i occupies offsets[i]:offsets[i+1] of every
+    field.  A per-ray metadata table holds the start and end points,
+    current redshift, and random seed of each ray, and the light ray solutions
+    are stored in the same ragged layout, one row per segment.  The merge
+    maps of compacted rays are also stored this way, so the original
+    cells of an archived ray can still be recovered.
+
+    Rays are read back one at a time as :class:`~trident.MemoryRay`
+    objects, optionally loading only a subset of the fields, so an
+    archive of many thousands of rays can be streamed through
+    :class:`~trident.SpectrumGenerator.make_spectra` without loading
+    it all into memory.  The offsets of added rays are written to the
+    file when the archive is flushed or closed, so close the archive, or
+    use it in a with statement, before reading the file elsewhere.
+
+    **Parameters**
+
+    :filename: string
+
+        The archive filename.
+
+    :mode: optional, string
+
+        "r" to read an existing archive, "a" to add rays to an existing
+        archive (creating it if it does not exist), or "w" to create a
+        new archive, overwriting any existing file.
+        Default: "r"
+
+    :compression: optional, string
+
+        The HDF5 compression filter used for new field columns.
+        Default: "gzip"
+
+    **Example**
+
+    Store several simple rays in one archive and make a spectrum from
+    each of them.
+
+    >>> import trident
+    >>> ds = trident.make_onezone_dataset()
+    >>> archive = trident.RayArchive('rays.h5', mode='w')
+    >>> for i in range(10):
+    ...     ray = trident.make_simple_ray(ds,
+    ...         start_position=ds.arr([0., 0., i/10.], 'unitary'),
+    ...         end_position=ds.arr([1., 1., i/10.], 'unitary'),
+    ...         lines=['H'])
+    ...     archive.add_ray(ray)
+    >>> sg = trident.SpectrumGenerator('COS')
+    >>> for i, wavelength, flux in sg.make_spectra(archive, lines=['H']):
+    ...     sg.save_spectrum('spec_%04d.h5' % i)
+    """
+    def __init__(self, filename, mode="r", compression="gzip"):
+        if mode not in ("r", "a", "w"):
+            raise RuntimeError(
+                "RayArchive mode must be 'r', 'a', or 'w', not '%s'." % mode)
+        if mode == "a" and not os.path.exists(filename):
+            mode = "w"
+        self.filename = filename
+        self.mode = mode
+        self.compression = compression
+        self._handle = h5py.File(filename, mode)
+
+        if mode == "w":
+            self._handle.attrs["data_type"] = "trident_ray_archive"
+            self._handle.create_dataset("offsets", data=np.zeros(1, dtype="int64"),
+                                        maxshape=(None,), chunks=True)
+            self._handle.create_group("fields")
+            self._handle.create_group("rays")
+            solution = self._handle.create_group("solution")
+            solution.create_dataset("offsets", data=np.zeros(1, dtype="int64"),
+                                    maxshape=(None,), chunks=True)
+        elif self._handle.attrs.get("data_type") not in \
+          ("trident_ray_archive", b"trident_ray_archive"):
+            self._handle.close()
+            raise RuntimeError("%s is not a ray archive." % filename)
+
+        # offsets are kept as lists while rays are added and written to
+        # the file when the archive is flushed or closed
+        self._offsets = self._handle["offsets"][()].tolist()
+        self._solution_offsets = \
+          self._handle["solution"]["offsets"][()].tolist()
+
+        # merge maps hold one row per lixel of a compacted ray, indexed
+        # by offsets, and one per original cell, indexed by dl_offsets
+        if "merge_map" in self._handle:
+            merge_map = self._handle["merge_map"]
+            self._merge_map_offsets = merge_map["offsets"][()].tolist()
+            self._merge_map_dl_offsets = merge_map["dl_offsets"][()].tolist()
+        else:
+            # archives written before merge maps were stored have none
+            self._merge_map_offsets = [0] * len(self._offsets)
+            self._merge_map_dl_offsets = [0] * len(self._offsets)
+            if mode != "r":
+                merge_map = self._handle.create_group("merge_map")
+                for key in ["offsets", "dl_offsets"]:
+                    merge_map.create_dataset(
+                        key, data=np.zeros(len(self._offsets), dtype="int64"),
+                        maxshape=(None,), chunks=True)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        return self.get_ray(index)
+
+    def __iter__(self):
+        return self.iter_rays()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def flush(self):
+        """
+        Write the offsets of the rays added and flush the archive file.
+        """
+        if self.mode == "r" or not self._handle:
+            return
+        merge_map = self._handle["merge_map"]
+        for dataset, offsets in \
+          [(self._handle["offsets"], self._offsets),
+           (self._handle["solution"]["offsets"], self._solution_offsets),
+           (merge_map["offsets"], self._merge_map_offsets),
+           (merge_map["dl_offsets"], self._merge_map_dl_offsets)]:
+            if dataset.shape[0] != len(offsets):
+                old_size = dataset.shape[0]
+                dataset.resize(len(offsets), axis=0)
+                dataset[old_size:] = offsets[old_size:]
+        self._handle.flush()
+
+    def close(self):
+        """
+        Write any pending offsets and close the archive file.
+        """
+        if self._handle:
+            self.flush()
+            self._handle.close()
+
+    @property
+    def field_list(self):
+        """
+        The fields stored for every ray in the archive.
+        """
+        return [("gas", field) for field in self._handle["fields"]]
+
+    @property
+    def metadata(self):
+        """
+        Dictionary of per-ray metadata arrays: start, end,
+        current_redshift, and seed.  A seed of -1 means none was given.
+        """
+        return dict([(key, self._handle["rays"][key][()])
+                     for key in self._handle["rays"]])
+
+    def add_ray(self, ray, seed=None, fields=None):
+        """
+        Append a ray to the archive.
+
+        **Parameters**
+
+        :ray: :class:`~trident.MemoryRay`, ray dataset, or string
+
+            The ray to be added.  A string is taken to be the filename of
+            a ray saved to disk.
+
+        :seed: optional, int
+
+            The random seed used to make the ray, stored in the per-ray
+            metadata.
+            Default: None
+
+        :fields: optional, list of strings
+
+            The fields to store.  The first ray with any cells added to
+            an archive sets the fields stored for all rays.  If None, all
+            fields on that ray are stored.
+            Default: None
+        """
+        if self.mode == "r":
+            raise RuntimeError("Cannot add rays to an archive opened with mode 'r'.")
+
+        if isinstance(ray, str):
+            ray = load(ray)
+        data, solution, current_redshift, merge_map = \
+          _get_ray_contents(ray, fields)
+        n_cells = next(iter(data.values())).size
+        if any([value.size != n_cells for value in data.values()]):
+            raise RuntimeError("All ray fields must have the same size.")
+
+        field_group = self._handle["fields"]
+        if n_cells == 0:
+            # empty rays only add an offset, and do not set the units of
+            # the stored fields
+            pass
+        elif len(field_group) == 0:
+            for name, value in data.items():
+                field_group.create_dataset(
+                    name, data=value.d, maxshape=(None,), chunks=True,
+                    compression=self.compression)
+                field_group[name].attrs["units"] = str(value.units)
+            self._handle.attrs["cosmological_simulation"] = \
+              int(getattr(ray, "cosmological_simulation", 0) or 0)
+        else:
+            if set(field_group) - set(data):
+                raise RuntimeError(
+                    "Ray is missing fields stored in the archive: %s." %
+                    sorted(set(field_group) - set(data)))
+            for name in field_group:
+                units = field_group[name].attrs["units"]
+                if isinstance(units, bytes):
+                    units = units.decode("utf8")
+                _append(field_group[name], data[name].in_units(units).d)
+
+        self._offsets.append(self._offsets[-1] + n_cells)
+
+        self._add_solution(solution)
+        self._add_metadata(solution, seed, current_redshift)
+        self._add_merge_map(merge_map)
+
+    def _add_merge_map(self, merge_map):
+        """
+        Append the merge map of a compacted ray, if it has one.
+        """
+        n_lixels = n_cells = 0
+        if merge_map is not None:
+            cell_count = np.asarray(merge_map["cell_count"], dtype="int64")
+            dl = merge_map["dl"]
+            n_lixels = cell_count.size
+            n_cells = dl.size
+
+        group = self._handle["merge_map"]
+        if n_lixels == 0:
+            pass
+        elif "dl" not in group:
+            group.create_dataset("cell_count", data=cell_count,
+                                 maxshape=(None,), chunks=True,
+                                 compression=self.compression)
+            group.create_dataset("dl", data=dl.d, maxshape=(None,),
+                                 chunks=True, compression=self.compression)
+            group["dl"].attrs["units"] = str(dl.units)
+        else:
+            units = group["dl"].attrs["units"]
+            if isinstance(units, bytes):
+                units = units.decode("utf8")
+            _append(group["cell_count"], cell_count)
+            _append(group["dl"], dl.in_units(units).d)
+
+        self._merge_map_offsets.append(self._merge_map_offsets[-1] +
+                                       n_lixels)
+        self._merge_map_dl_offsets.append(self._merge_map_dl_offsets[-1] +
+                                          n_cells)
+
+    def _add_solution(self, solution):
+        """
+        Append one row per segment of a light ray solution.
+        """
+        sol_group = self._handle["solution"]
+        columns = _solution_columns(solution)
+        if len(solution) > 0 and len(sol_group) == 1:
+            for key, arr in columns.items():
+                # strings are variable length so later rays can have
+                # longer dataset filenames
+                if arr.dtype.kind == 'S':
+                    sol_group.create_dataset(
+                        key, data=arr.astype(object), maxshape=(None,),
+                        chunks=True, dtype=h5py.special_dtype(vlen=bytes))
+                else:
+                    sol_group.create_dataset(
+                        key, data=arr, maxshape=(None,) + arr.shape[1:],
+                        chunks=True)
+        elif len(solution) > 0:
+            for key in sol_group:
+                if key == "offsets":
+                    continue
+                if key not in columns:
+                    raise RuntimeError(
+                        "Light ray solution is missing %s." % key)
+                _append(sol_group[key], columns[key])
+
+        self._solution_offsets.append(self._solution_offsets[-1] +
+                                      len(solution))
+
+    def _add_metadata(self, solution, seed, current_redshift):
+        """
+        Append a row to the per-ray metadata table.
+        """
+        row = {"start": np.full(3, np.nan), "end": np.full(3, np.nan),
+               "current_redshift": current_redshift,
+               "seed": -1 if seed is None else seed}
+        if len(solution) > 0:
+            if "start" in solution[0]:
+                row["start"] = _unitary_values(solution[0]["start"])
+            if "end" in solution[-1]:
+                row["end"] = _unitary_values(solution[-1]["end"])
+
+        ray_group = self._handle["rays"]
+        for key, shape in _ray_columns.items():
+            dtype = "int64" if key == "seed" else "float64"
+            value = np.array([row[key]], dtype=dtype).reshape((1,) + shape)
+            if key in ray_group:
+                _append(ray_group[key], value)
+            else:
+                ray_group.create_dataset(key, data=value,
+                                         maxshape=(None,) + shape,
+                                         chunks=True)
+
+    def get_ray(self, index, fields=None):
+        """
+        Read a single ray from the archive.
+
+        **Parameters**
+
+        :index: int
+
+            The index of the ray in the archive.
+
+        :fields: optional, list of strings
+
+            The fields to load.  If None, all fields are loaded.
+            Default: None
+
+        **Returns**
+
+            A :class:`~trident.MemoryRay`.
+        """
+        n_rays = len(self)
+        if index < 0:
+            index += n_rays
+        if index < 0 or index >= n_rays:
+            raise IndexError("Ray index %d out of range for archive with %d rays." %
+                             (index, n_rays))
+
+        field_group = self._handle["fields"]
+        if fields is None:
+            names = list(field_group)
+        else:
+            names = _uniquify_names(fields)
+            missing = [name for name in names if name not in field_group]
+            if missing:
+                raise RuntimeError("Fields %s not found in %s." %
+                                   (missing, self.filename))
+
+        start, end = self._offsets[index], self._offsets[index+1]
+        data = {}
+        for name in names:
+            units = field_group[name].attrs["units"]
+            if isinstance(units, bytes):
+                units = units.decode("utf8")
+            data[name] = YTArray(field_group[name][start:end], units)
+
+        ray_group = self._handle["rays"]
+        seed = int(ray_group["seed"][index])
+        parameters = {"archive_index": index,
+                      "seed": None if seed < 0 else seed}
+        return MemoryRay(
+            data, current_redshift=float(ray_group["current_redshift"][index]),
+            cosmological_simulation=bool(
+                self._handle.attrs.get("cosmological_simulation", 0)),
+            light_ray_solution=self.get_light_ray_solution(index),
+            parameters=parameters, merge_map=self.get_merge_map(index),
+            name="%s[%d]" % (os.path.basename(self.filename), index))
+
+    def get_light_ray_solution(self, index):
+        """
+        Return the light ray solution of a ray as a list of dicts.
+        """
+        sol_group = self._handle["solution"]
+        start = self._solution_offsets[index]
+        end = self._solution_offsets[index+1]
+        columns = {}
+        for key in sol_group:
+            if key == "offsets":
+                continue
+            columns[key] = sol_group[key][start:end]
+        solution = []
+        for i in range(end - start):
+            segment = {}
+            for key, arr in columns.items():
+                val = arr[i]
+                if isinstance(val, bytes):
+                    val = val.decode("utf8")
+                segment[key] = val
+            solution.append(segment)
+        return solution
+
+    def get_merge_map(self, index):
+        """
+        Return the merge map of a compacted ray, or None if the ray was
+        not compacted.  See :func:`~trident.light_ray.load_merge_map`.
+        """
+        start = self._merge_map_offsets[index]
+        end = self._merge_map_offsets[index+1]
+        if end == start:
+            return None
+        dl_start = self._merge_map_dl_offsets[index]
+        dl_end = self._merge_map_dl_offsets[index+1]
+        group = self._handle["merge_map"]
+        units = group["dl"].attrs["units"]
+        if isinstance(units, bytes):
+            units = units.decode("utf8")
+        return {"cell_count": group["cell_count"][start:end],
+                "dl": YTArray(group["dl"][dl_start:dl_end], units)}
+
+    def iter_rays(self, fields=None, start=0, stop=None):
+        """
+        Iterate over the rays in the archive, reading one at a time.
+
+        **Parameters**
+
+        :fields: optional, list of strings
+
+            The fields to load.  If None, all fields are loaded.
+            Default: None
+
+        :start, stop: optional, int
+
+            The range of ray indices to iterate over.
+            Default: 0, None (all rays)
+        """
+        if stop is None:
+            stop = len(self)
+        for index in range(start, stop):
+            yield self.get_ray(index, fields=fields)
+
+    def __repr__(self):
+        return "RayArchive: %s (%d rays)" % (self.filename, len(self))
+
+def _uniquify_names(fields):
+    """
+    Reduce a list of field names or tuples to unique field names.
+    """
+    names = []
+    for field in fields:
+        name = _field_key(field)[1]
+        if name not in names:
+            names.append(name)
+    return names
+
+def _append(dataset, values):
+    """
+    Append values to a resizable HDF5 dataset along its first axis.
+    """
+    old_size = dataset.shape[0]
+    dataset.resize(old_size + values.shape[0], axis=0)
+    dataset[old_size:] = values
+
+def _unitary_values(value):
+    """
+    Return position values in unitary units as a plain array, if possible.
+    """
+    if isinstance(value, YTArray):
+        try:
+            value = value.to("unitary")
+        except (UnitParseError, YTUnitConversionError):
+            pass
+        return value.d
+    return np.asarray(value, dtype="float64")
+
+def _solution_columns(solution):
+    """
+    Convert a light ray solution into a dict of column arrays.
+    """
+    columns = {}
+    if len(solution) == 0:
+        return columns
+    for key in solution[0]:
+        if key in ["next", "previous", "index"]:
+            continue
+        values = [segment[key] for segment in solution]
+        if key in ["start", "end"]:
+            arr = np.array([_unitary_values(val) for val in values])
+        elif isinstance(values[-1], YTArray):
+            arr = np.array([val.d for val in values])
+        else:
+            arr = np.array(values)
+        # If we somehow create an object array, convert it to a string
+        # to avoid errors later
+        if arr.dtype == 'O':
+            arr = arr.astype(str)
+        if arr.dtype.kind == 'U':
+            arr = arr.astype('|S')
+        columns[key] = arr
+    return columns
+
+def _get_ray_contents(ray, fields):
+    """
+    Return the field data, light ray solution, redshift, and merge map of
+    a ray.
+    """
+    merge_map = getattr(ray, "merge_map", None)
+    if isinstance(ray, MemoryRay):
+        available = [field[1] for field in ray.field_list]
+        get_field = lambda name: ray[name]
+    elif isinstance(ray, Dataset):
+        ad = ray.all_data()
+        available = [field[1] for field in ray.field_list]
+        get_field = lambda name: ad[name]
+        # a compacted ray loaded from disk keeps its merge map in the file
+        if merge_map is None and "cell_count" in available:
+            merge_map = load_merge_map(ray.parameter_filename)
+    else:
+        raise RuntimeError("Unrecognized ray type.")
+
+    if fields is None:
+        names = available
+    else:
+        names = _uniquify_names(fields)
+
+    data = {}
+    for name in names:
+        value = get_field(name)
+        if not isinstance(value, YTArray):
+            value = YTArray(value, "")
+        data[name] = value
+    if not data:
+        raise RuntimeError("Cannot add a ray with no fields to an archive.")
+
+    solution = getattr(ray, "light_ray_solution", None) or []
+    current_redshift = getattr(ray, "current_redshift", 0.) or 0.
+    return data, solution, float(current_redshift), merge_map
@@ -0,0 +1,221 @@
+"""
+Functions for sampling many rays through a single dataset at once.
+
+
+
+"""
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2017, Trident Development Team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+#-----------------------------------------------------------------------------
+
+import numpy as np
+
+from yt.funcs import \
+    get_pbar, \
+    mylog
+from yt.geometry.grid_geometry_handler import \
+    GridIndex
+from yt.units.yt_array import \
+    YTArray
+
+def cast_rays(ds, starts, ends, fields, field_parameters=None):
+    """
+    Sample the cells intersected by a set of non-periodic rays.
+
+    For grid-based datasets, every ray is intersected with the grid
+    hierarchy in a single pass, so each grid is read only once no matter
+    how many rays pass through it.  For other index types, each ray is
+    sampled with its own yt ray object.
+
+    **Parameters**
+
+    :ds: dataset
+
+        The dataset through which the rays pass.
+
+    :starts: list of YTArrays
+
+        The start point of each ray.
+
+    :ends: list of YTArrays
+
+        The end point of each ray.
+
+    :fields: list
+
+        The fields to sample for each cell.
+
+    :field_parameters: optional, dict
+
+        Field parameters to set before fields are sampled.
+        Default: None
+
+    **Returns**
+
+        A list with, for each ray, a dict containing the parametric
+        position "t" at which the ray enters each cell, the fraction "dts"
+        of the ray within each cell, and the values of each field, all
+        ordered along the ray.  If a ray intersects no cells, its entry
+        is None.
+    """
+    if field_parameters is None:
+        field_parameters = {}
+    if isinstance(ds.index, GridIndex):
+        return _cast_rays_through_grids(ds, starts, ends, fields,
+                                        field_parameters)
+    return _cast_rays_individually(ds, starts, ends, fields,
+                                   field_parameters)
+
+def _cast_rays_individually(ds, starts, ends, fields, field_parameters):
+    """
+    Sample each ray separately with a yt ray object.
+    """
+    ray_data = []
+    for start, end in zip(starts, ends):
+        ray = ds.ray(start, end)
+        for key, val in field_parameters.items():
+            ray.set_field_parameter(key, val)
+        if ray['t'].size == 0:
+            ray_data.append(None)
+            continue
+        asort = np.argsort(ray['t'])
+        data = {'t': ray['t'][asort].d, 'dts': ray['dts'][asort].d}
+        for field in fields:
+            data[field] = ray[field][asort]
+        ray_data.append(data)
+        ray.clear_data()
+    return ray_data
+
+def _cast_rays_through_grids(ds, starts, ends, fields, field_parameters):
+    """
+    Sample all rays by iterating over the grids of the dataset once.
+    """
+    starts = np.array([ds.arr(start).to('code_length').d for start in starts])
+    ends = np.array([ds.arr(end).to('code_length').d for end in ends])
+    vectors = ends - starts
+    grid_left_edges = ds.index.grid_left_edge.to('code_length').d
+    grid_right_edges = ds.index.grid_right_edge.to('code_length').d
+
+    chunks = [[] for i in range(starts.shape[0])]
+    grids = ds.index.grids
+    pbar = get_pbar("Casting %d rays through %d grids" %
+                    (starts.shape[0], len(grids)), len(grids))
+    for i_grid, grid in enumerate(grids):
+        pbar.update(i_grid)
+        t_enter, t_exit = _intersect_box(
+            starts, vectors, grid_left_edges[i_grid], grid_right_edges[i_grid])
+        hits = np.where(t_exit > t_enter)[0]
+        if hits.size == 0:
+            continue
+
+        left_edge = grid_left_edges[i_grid]
+        dims = grid.ActiveDimensions
+        dds = (grid_right_edges[i_grid] - left_edge) / dims
+        child_mask = grid.child_mask
+        cells = []
+        for i_ray in hits:
+            t, dts, index = _traverse_grid(starts[i_ray], vectors[i_ray],
+                                           left_edge, dds, dims,
+                                           t_enter[i_ray], t_exit[i_ray])
+            # only keep the cells that are not further refined
+            valid = child_mask[index[:, 0], index[:, 1], index[:, 2]]
+            if valid.any():
+                cells.append((i_ray, t[valid], dts[valid], index[valid]))
+        if not cells:
+            continue
+
+        # read each field for this grid once and give it to every ray,
+        # restoring the field parameters of the grid afterward since the
+        # grid objects belong to the index and are shared
+        saved_parameters = grid.field_parameters.copy()
+        for key, val in field_parameters.items():
+            grid.set_field_parameter(key, val)
+        try:
+            values = dict([(field, grid[field]) for field in fields])
+        finally:
+            grid.clear_data()
+            grid.field_parameters = saved_parameters
+        for i_ray, t, dts, index in cells:
+            chunk = {'t': t, 'dts': dts}
+            for field in fields:
+                chunk[field] = \
+                  values[field][index[:, 0], index[:, 1], index[:, 2]]
+            chunks[i_ray].append(chunk)
+        del values
+    pbar.finish()
+
+    mylog.info("Sampled %d rays through %d grids." % (len(chunks), len(grids)))
+    return [_join_chunks(ray_chunks, fields) for ray_chunks in chunks]
+
+def _intersect_box(starts, vectors, left_edge, right_edge):
+    """
+    Get the parametric positions at which rays enter and exit a box.
+
+    Rays run from starts (t = 0) to starts + vectors (t = 1).  A ray
+    intersects the box when the exit position is greater than the entry
+    position.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t1 = (left_edge - starts) / vectors
+        t2 = (right_edge - starts) / vectors
+    t_low = np.minimum(t1, t2)
+    t_high = np.maximum(t1, t2)
+
+    # rays parallel to an axis only intersect if they lie within the box
+    parallel = vectors == 0
+    inside = (starts >= left_edge) & (starts < right_edge)
+    t_low[parallel] = np.where(inside[parallel], -np.inf, np.inf)
+    t_high[parallel] = np.where(inside[parallel], np.inf, -np.inf)
+
+    t_enter = np.maximum(t_low.max(axis=1), 0.)
+    t_exit = np.minimum(t_high.min(axis=1), 1.)
+    return t_enter, t_exit
+
+def _traverse_grid(start, vector, left_edge, dds, dims, t_enter, t_exit):
+    """
+    Get the cells of a grid intersected by a ray between t_enter and t_exit.
+
+    Returns the parametric position at which the ray enters each cell, the
+    fraction of the ray within each cell, and the (i, j, k) index of each
+    cell.
+    """
+    t_all = [np.array([t_enter, t_exit])]
+    for ax in range(3):
+        if vector[ax] == 0:
+            continue
+        edges = left_edge[ax] + dds[ax] * np.arange(1, dims[ax])
+        t_edge = (edges - start[ax]) / vector[ax]
+        t_all.append(t_edge[(t_edge > t_enter) & (t_edge < t_exit)])
+    t = np.unique(np.concatenate(t_all))
+    dts = np.diff(t)
+    t = t[:-1]
+    valid = dts > 0
+    t = t[valid]
+    dts = dts[valid]
+
+    # find the cell containing the midpoint of each piece of the ray
+    midpoints = start + (t + dts / 2)[:, None] * vector
+    index = ((midpoints - left_edge) / dds).astype(np.int64)
+    np.clip(index, 0, dims - 1, out=index)
+    return t, dts, index
+
+def _join_chunks(chunks, fields):
+    """
+    Join the chunks of a ray from different grids and sort them along the ray.
+    """
+    if not chunks:
+        return None
+    t = np.concatenate([chunk['t'] for chunk in chunks])
+    asort = np.argsort(t)
+    data = {'t': t[asort],
+            'dts': np.concatenate([chunk['dts'] for chunk in chunks])[asort]}
+    for field in fields:
+        units = chunks[0][field].units
+        values = np.concatenate([chunk[field].to(units).d for chunk in chunks])
+        data[field] = YTArray(values[asort], units)
+    return data
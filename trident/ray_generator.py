@@ -14,7 +14,6 @@ SpectrumGenerator class and member functions.
 from trident.light_ray import \
     LightRay
 from yt.convenience import \
-    load, \
     simulation
 from trident.config import \
     ion_table_filepath
@@ -27,13 +26,22 @@ from yt.data_objects.static_output import \
     Dataset
 from trident.ion_balance import \
     atomic_number
+from trident.dataset_cache import \
+    dataset_cache
+from trident.ray_archive import \
+    RayArchive
+from yt.utilities.parallel_tools.parallel_analysis_interface import \
+    communication_system, \
+    parallel_root_only
 
 def make_simple_ray(dataset_file, start_position, end_position,
                     lines=None, ftype="gas", fields=None,
                     solution_filename=None, data_filename=None,
                     trajectory=None, redshift=None, field_parameters=None,
                     setup_function=None, load_kwargs=None,
-                    line_database=None, ionization_table=None):
+                    line_database=None, ionization_table=None,
+                    in_memory=False, compact=False,
+                    redshift_from_distance=False):
     """
     Create a yt LightRay object for a single dataset (eg CGM).  This is a
     wrapper function around yt's LightRay interface to reduce some of the
@@ -112,9 +120,8 @@ def make_simple_ray(dataset_file, start_position, end_position,
 
     :data_filename: string, optional
     
-        Output filename for ray data stored as an HDF5 file.  Note that
-        at present, you *must* save a ray to disk in order for it to be
-        returned by this function.  If set to None, defaults to 'ray.h5'.
+        Output filename for ray data stored as an HDF5 file.  If set to
+        None, defaults to 'ray.h5', unless :in_memory: is True.
         Default: None
 
     :trajectory: list of floats, optional
@@ -170,6 +177,29 @@ def make_simple_ray(dataset_file, start_position, end_position,
         it uses the table specified in ~/.trident/config
         Default: None
 
+    :in_memory: bool, optional
+
+        If True and :data_filename: is None, the ray is not written to disk
+        and is instead returned as a :class:`~trident.MemoryRay`.  This
+        avoids writing and reloading an HDF5 file for every ray when rays
+        are only used to make spectra.
+        Default: False
+
+    :compact: bool, optional
+
+        If True, consecutive cells along the ray with identical field
+        values are merged into single lixels with summed path lengths.
+        See :meth:`~trident.LightRay.make_light_ray`.
+        Default: False
+
+    :redshift_from_distance: bool, optional
+
+        If True, the redshift of each cell in a cosmological ray is found
+        from its comoving distance using a cached redshift-distance table,
+        rather than assuming redshift changes linearly along each segment.
+        See :meth:`~trident.LightRay.make_light_ray`.
+        Default: False
+
     **Example**
 
     Generate a simple ray passing from the lower left corner to the upper
@@ -186,11 +216,11 @@ def make_simple_ray(dataset_file, start_position, end_position,
         load_kwargs = {}
     if fields is None:
         fields = []
-    if data_filename is None:
+    if data_filename is None and not in_memory:
         data_filename = 'ray.h5'
 
     if isinstance(dataset_file, str):
-        ds = load(dataset_file, **load_kwargs)
+        ds = dataset_cache.load(dataset_file, **load_kwargs)
     elif isinstance(dataset_file, Dataset):
         ds = dataset_file
 
@@ -199,30 +229,7 @@ def make_simple_ray(dataset_file, start_position, end_position,
     if ionization_table is None:
         ionization_table = ion_table_filepath
 
-    # Include some default fields in the ray to assure it's processed correctly.
-
-    fields = _add_default_fields(ds, fields)
-
-    # If 'lines' kwarg is set, we need to get all the fields required to
-    # create the desired absorption lines in the grid format, since grid-based
-    # fields are what are directly probed by the LightRay object.
-
-    # We first determine what fields are necessary for the desired lines, and
-    # inspect the dataset to see if they already exist.  If so, we add them
-    # to the field list for the ray.  If not, we have to create them.
-
-    if lines is not None:
-
-        ion_list = _determine_ions_from_lines(line_database, lines)
-        fields = _determine_fields_from_ions(ds, ion_list, fields)
-
-    # To assure there are no fields that are double specified or that collide
-    # based on being specified as "density" as well as ("gas", "density"),
-    # we will just assume that all non-tuple fields requested are ftype "gas".
-    for i in range(len(fields)):
-        if isinstance(fields[i], str):
-            fields[i] = ('gas', fields[i])
-    fields = uniquify(fields)
+    fields = _determine_ray_fields(ds, fields, lines, line_database)
 
     return lr.make_light_ray(start_position=start_position,
                              end_position=end_position,
@@ -232,7 +239,163 @@ def make_simple_ray(dataset_file, start_position, end_position,
                              solution_filename=solution_filename,
                              data_filename=data_filename,
                              field_parameters=field_parameters,
-                             redshift=redshift)
+                             redshift=redshift,
+                             compact=compact,
+                             redshift_from_distance=redshift_from_distance)
+
+def make_simple_rays(dataset_file, start_positions, end_positions,
+                     lines=None, ftype="gas", fields=None,
+                     data_filename=None, redshift=None, field_parameters=None,
+                     setup_function=None, load_kwargs=None,
+                     line_database=None, ionization_table=None):
+    """
+    Create many simple rays through a single dataset at once.
+
+    This produces the same rays as calling :func:`~trident.make_simple_ray`
+    for each pair of start and end positions, but is much faster for large
+    numbers of rays.  The dataset is loaded and its fields are set up once,
+    and for grid-based datasets all rays are intersected with the grid
+    hierarchy in a single pass, so each grid is read from disk only once and
+    its cell values are given to every ray passing through it.  For other
+    types of datasets, such as particle and octree datasets, each ray is
+    sampled in turn with its own yt ray object, so the data a ray passes
+    through is read again for every ray.  Rays that pass through no
+    cells, or only cells with zero temperature, are returned empty with
+    a warning.
+
+    The rays are returned in memory as a list of
+    :class:`~trident.MemoryRay` objects, or written to a single
+    :class:`~trident.RayArchive` file if :data_filename: is set.  Either can
+    be passed to :class:`~trident.SpectrumGenerator`.
+
+    **Parameters**
+
+    :dataset_file: string or yt Dataset object
+
+        Either a yt dataset or the filename of a dataset on disk.  If the
+        latter, you may need to specify load_kwargs, if the dataset requires
+        special parameters to be loaded.
+
+    :start_positions: list of lists, array, or YTArray of shape (N, 3)
+
+        The coordinates of the starting position of each ray.  If specified
+        without units, it is assumed to be in code units.
+
+    :end_positions: list of lists, array, or YTArray of shape (N, 3)
+
+        The coordinates of the ending position of each ray.  If specified
+        without units, it is assumed to be in code units.
+
+    :lines: list of strings, optional
+
+        List of strings that determine which fields will be added to the
+        rays to support line deposition to an absorption line spectrum.
+        See :func:`~trident.make_simple_ray` for details.
+        Default: None
+
+    :ftype: string, optional
+
+        This is the field type of the fields you wish to add to the rays.
+        Default: "gas"
+
+    :fields: list of strings, optional
+
+        The list of which fields to store in the output rays.
+        Default: None
+
+    :data_filename: string, optional
+
+        Output filename for a :class:`~trident.RayArchive` containing all
+        of the rays.  If set to None, the rays are returned as a list of
+        :class:`~trident.MemoryRay` objects instead.
+        Default: None
+
+    :redshift: float, optional
+
+        Sets the highest cosmological redshift of the rays.  By default, it
+        will use the cosmological redshift of the dataset, if set, and if not
+        set, it will use a redshift of 0.
+        Default: None
+
+    :field_parameters: optional, dict
+
+        Used to set field parameters in light rays, e.g., 'bulk_velocity'.
+        Default: None.
+
+    :setup_function: function, optional
+
+        A function that will be called on the dataset as it is loaded but
+        before the rays are generated.
+        Default: None
+
+    :load_kwargs: dict, optional
+
+        Dictionary of kwargs to be passed to the yt "load" function.
+        Default: None
+
+    :line_database: string, optional
+
+        For use with the :lines: keyword.  See
+        :func:`~trident.make_simple_ray`.
+        Default: None
+
+    :ionization_table: string, optional
+
+        For use with the :lines: keyword.  See
+        :func:`~trident.make_simple_ray`.
+        Default: None
+
+    **Returns**
+
+        A list of :class:`~trident.MemoryRay` objects, or a
+        :class:`~trident.RayArchive` if :data_filename: is set.
+
+    **Example**
+
+    Generate 100 rays parallel to the z axis through a dataset and make a
+    spectrum from each:
+
+    >>> import numpy as np
+    >>> import trident
+    >>> import yt
+    >>> ds = yt.load('path/to/dataset')
+    >>> xy = np.random.random((100, 2))
+    >>> starts = ds.arr(np.column_stack([xy, np.zeros(100)]), 'unitary')
+    >>> ends = ds.arr(np.column_stack([xy, np.ones(100)]), 'unitary')
+    >>> rays = trident.make_simple_rays(ds, starts, ends, lines=['H I'],
+    ...                                 data_filename='rays.h5')
+    >>> sg = trident.SpectrumGenerator('COS')
+    >>> for i, wavelength, flux in sg.make_spectra(rays, lines=['H I']):
+    ...     sg.save_spectrum('spec_%03d.h5' % i)
+    """
+    if load_kwargs is None:
+        load_kwargs = {}
+    if fields is None:
+        fields = []
+
+    if isinstance(dataset_file, str):
+        ds = dataset_cache.load(dataset_file, **load_kwargs)
+    elif isinstance(dataset_file, Dataset):
+        ds = dataset_file
+
+    lr = LightRay(ds, load_kwargs=load_kwargs)
+
+    fields = _determine_ray_fields(ds, fields, lines, line_database)
+
+    rays = lr._make_simple_rays(start_positions, end_positions,
+                                fields=fields,
+                                setup_function=setup_function,
+                                field_parameters=field_parameters,
+                                redshift=redshift)
+
+    if data_filename is None:
+        return rays
+
+    # every process has all of the rays, so only the root process writes
+    # them and the others wait until the archive is complete
+    _write_ray_archive(data_filename, rays)
+    communication_system.communicators[-1].barrier()
+    return RayArchive(data_filename)
 
 def make_compound_ray(parameter_filename, simulation_type,
                       near_redshift, far_redshift,
@@ -242,7 +405,9 @@ def make_compound_ray(parameter_filename, simulation_type,
                       deltaz_min=0.0, minimum_coherent_box_fraction=0.0,
                       seed=None, setup_function=None, load_kwargs=None,
                       line_database=None, ionization_table=None,
-                      field_parameters = None):
+                      field_parameters = None, in_memory=False,
+                      prefetch=0, compact=False,
+                      redshift_from_distance=False):
     """
     Create a yt LightRay object for multiple consecutive datasets (eg IGM).
     This is a wrapper function around yt's LightRay interface to reduce some
@@ -345,9 +510,8 @@ def make_compound_ray(parameter_filename, simulation_type,
 
     :data_filename: string, optional
 
-        Output filename for ray data stored as an HDF5 file.  Note that
-        at present, you *must* save a ray to disk in order for it to be
-        returned by this function.  If set to None, defaults to 'ray.h5'.
+        Output filename for ray data stored as an HDF5 file.  If set to
+        None, defaults to 'ray.h5', unless :in_memory: is True.
         Default: None
 
     :use_minimum_datasets: bool, optional
@@ -432,6 +596,36 @@ def make_compound_ray(parameter_filename, simulation_type,
         accordingly.
         Default: None.
 
+    :in_memory: bool, optional
+
+        If True and :data_filename: is None, the ray is not written to disk
+        and is instead returned as a :class:`~trident.MemoryRay`.  This
+        avoids writing and reloading an HDF5 file for every ray when rays
+        are only used to make spectra.
+        Default: False
+
+    :prefetch: int, optional
+
+        When running in serial, the number of datasets to load in a
+        background thread ahead of the one being sampled, so that reading
+        each dataset overlaps with sampling the previous one.
+        Default: 0
+
+    :compact: bool, optional
+
+        If True, consecutive cells along the ray with identical field
+        values are merged into single lixels with summed path lengths.
+        See :meth:`~trident.LightRay.make_light_ray`.
+        Default: False
+
+    :redshift_from_distance: bool, optional
+
+        If True, the redshift of each cell in a cosmological ray is found
+        from its comoving distance using a cached redshift-distance table,
+        rather than assuming redshift changes linearly along each segment.
+        See :meth:`~trident.LightRay.make_light_ray`.
+        Default: False
+
     **Example**
 
     Generate a compound ray passing from the redshift 0 to redshift 0.05
@@ -454,7 +648,7 @@ def make_compound_ray(parameter_filename, simulation_type,
         load_kwargs = {}
     if fields is None:
         fields = []
-    if data_filename is None:
+    if data_filename is None and not in_memory:
         data_filename = 'ray.h5'
 
     lr = LightRay(parameter_filename,
@@ -476,7 +670,7 @@ def make_compound_ray(parameter_filename, simulation_type,
     # because testing each dataset is going to be slow and a pain.
 
     sim = simulation(parameter_filename, simulation_type)
-    ds = load(sim.all_outputs[-1]['filename'])
+    ds = dataset_cache.load(sim.all_outputs[-1]['filename'], **load_kwargs)
 
     # Include some default fields in the ray to assure it's processed correctly.
 
@@ -510,7 +704,170 @@ def make_compound_ray(parameter_filename, simulation_type,
                              solution_filename=solution_filename,
                              data_filename=data_filename,
                              redshift=None, njobs=-1,
-                             field_parameters = field_parameters)
+                             field_parameters = field_parameters,
+                             prefetch=prefetch,
+                             compact=compact,
+                             redshift_from_distance=redshift_from_distance)
+
+def make_compound_rays(parameter_filename, simulation_type,
+                       near_redshift, far_redshift, seeds,
+                       lines=None, ftype='gas', fields=None,
+                       data_filename=None,
+                       use_minimum_datasets=True, max_box_fraction=1.0,
+                       deltaz_min=0.0, minimum_coherent_box_fraction=0.0,
+                       setup_function=None, load_kwargs=None,
+                       line_database=None, ionization_table=None,
+                       field_parameters=None, njobs=-1, solutions=None,
+                       redshift_from_distance=False):
+    """
+    Create many compound rays through the same simulation at once, one for
+    each random seed.
+
+    This produces the same rays as calling
+    :func:`~trident.make_compound_ray` once for each seed, but rather than
+    loading every dataset in the solution for every ray, the solutions for
+    all rays are calculated first and their segments are grouped by
+    dataset.  Each dataset is then loaded only once, all of the segments
+    passing through it are extracted, and the segments are reassembled into
+    rays.  When running in parallel, work is divided over datasets rather
+    than rays.
+
+    The rays are returned in memory as a list of
+    :class:`~trident.MemoryRay` objects, or written to a single
+    :class:`~trident.RayArchive` file if :data_filename: is set.
+
+    **Parameters**
+
+    :parameter_filename, simulation_type, near_redshift, far_redshift:
+
+        See :func:`~trident.make_compound_ray`.
+
+    :seeds: list of ints
+
+        The random seed for each ray.
+
+    :data_filename: string, optional
+
+        Output filename for a :class:`~trident.RayArchive` containing all
+        of the rays, with their seeds.  If set to None, the rays are returned
+        as a list of :class:`~trident.MemoryRay` objects instead.
+        Default: None
+
+    :njobs: int, optional
+
+        The number of parallel jobs over which the datasets will be split.
+        Choose -1 for one processor per dataset.
+        Default: -1
+
+    :solutions: list, optional
+
+        Precomputed light ray solutions, one for each seed, as returned by
+        :func:`~trident.load_light_ray_solutions`.  If given, the rays
+        follow these trajectories and the seeds are only used to label
+        the rays.
+        Default: None
+
+    All other keyword arguments are the same as for
+    :func:`~trident.make_compound_ray`.
+
+    **Returns**
+
+        A list of :class:`~trident.MemoryRay` objects, or a
+        :class:`~trident.RayArchive` if :data_filename: is set.
+
+    **Example**
+
+    Generate 100 compound rays from redshift 0 to 0.05 through a
+    multi-output enzo simulation.
+
+    >>> import trident
+    >>> fn = 'path/to/simulation/parameter/file'
+    >>> rays = trident.make_compound_rays(fn, simulation_type='Enzo',
+    ... near_redshift=0.0, far_redshift=0.05, seeds=range(100),
+    ... lines=['H', 'O', 'Mg II'], data_filename='rays.h5')
+    """
+    if load_kwargs is None:
+        load_kwargs = {}
+    if fields is None:
+        fields = []
+    seeds = list(seeds)
+    if solutions is not None and len(solutions) != len(seeds):
+        raise RuntimeError("There must be one solution for each seed.")
+
+    lr = LightRay(parameter_filename,
+                  simulation_type=simulation_type,
+                  near_redshift=near_redshift,
+                  far_redshift=far_redshift,
+                  use_minimum_datasets=use_minimum_datasets,
+                  max_box_fraction=max_box_fraction,
+                  deltaz_min=deltaz_min,
+                  minimum_coherent_box_fraction=minimum_coherent_box_fraction,
+                  load_kwargs=load_kwargs)
+
+    # As in make_compound_ray, use the final dataset from the simulation to
+    # determine what fields are present.
+    sim = simulation(parameter_filename, simulation_type)
+    ds = dataset_cache.load(sim.all_outputs[-1]['filename'], **load_kwargs)
+    fields = _determine_ray_fields(ds, fields, lines, line_database)
+    del ds
+
+    rays = lr._make_compound_rays(seeds, fields=fields,
+                                  setup_function=setup_function,
+                                  field_parameters=field_parameters,
+                                  njobs=njobs, solutions=solutions,
+                                  redshift_from_distance=redshift_from_distance)
+
+    if data_filename is None:
+        return rays
+
+    # the segments gathered from all processes make up the same rays on
+    # each, so only the root process writes them
+    _write_ray_archive(data_filename, rays, seeds=seeds)
+    communication_system.communicators[-1].barrier()
+    return RayArchive(data_filename)
+
+@parallel_root_only
+def _write_ray_archive(filename, rays, seeds=None):
+    """
+    Write a list of rays, and optionally the seed of each, to a new
+    RayArchive on the root process.
+    """
+    if seeds is None:
+        seeds = [None] * len(rays)
+    with RayArchive(filename, mode="w") as archive:
+        for seed, ray in zip(seeds, rays):
+            archive.add_ray(ray, seed=seed)
+
+def _determine_ray_fields(ds, fields, lines, line_database):
+    """
+    Figure out what fields to sample for a ray, including the fields
+    necessary to produce the desired lines
+    """
+    # Include some default fields in the ray to assure it's processed correctly.
+
+    fields = _add_default_fields(ds, fields)
+
+    # If 'lines' kwarg is set, we need to get all the fields required to
+    # create the desired absorption lines in the grid format, since grid-based
+    # fields are what are directly probed by the LightRay object.
+
+    # We first determine what fields are necessary for the desired lines, and
+    # inspect the dataset to see if they already exist.  If so, we add them
+    # to the field list for the ray.  If not, we have to create them.
+
+    if lines is not None:
+
+        ion_list = _determine_ions_from_lines(line_database, lines)
+        fields = _determine_fields_from_ions(ds, ion_list, fields)
+
+    # To assure there are no fields that are double specified or that collide
+    # based on being specified as "density" as well as ("gas", "density"),
+    # we will just assume that all non-tuple fields requested are ftype "gas".
+    for i in range(len(fields)):
+        if isinstance(fields[i], str):
+            fields[i] = ('gas', fields[i])
+    fields = uniquify(fields)
+    return fields
 
 def _determine_ions_from_lines(line_database, lines):
     """
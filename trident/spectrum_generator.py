@@ -36,9 +36,12 @@ from trident.ion_balance import \
     add_ion_number_density_field, \
     atomic_mass
 from trident.line_database import \
-    LineDatabase
+    LineDatabase, \
+    uniquify
 from trident.lsf import \
     LSF
+from trident.memory_ray import \
+    MemoryRay
 from trident.plotting import \
     plot_spectrum
 from trident.config import \
@@ -46,6 +49,8 @@ from trident.config import \
 from yt.utilities.on_demand_imports import \
     _h5py, \
     _astropy
+from yt.utilities.parallel_tools.parallel_analysis_interface import \
+    parallel_root_only
 
 # Valid instruments
 valid_instruments = \
@@ -247,7 +252,8 @@ class SpectrumGenerator(AbsorptionSpectrum):
                       ly_continuum=True,
                       store_observables=False,
                       min_tau=1e-3,
-                      njobs="auto"):
+                      njobs="auto",
+                      store_ion_fields=False):
         """
         Make a spectrum from ray data depositing the desired lines.  Make sure
         to pass this function a LightRay object and potentially also a list of
@@ -256,12 +262,14 @@ class SpectrumGenerator(AbsorptionSpectrum):
 
         **Parameters**
 
-        :ray: string, dataset, or data container
+        :ray: string, dataset, data container, or MemoryRay
 
             If a string, the path to the ray dataset. As a dataset,
             this is the ray dataset loaded by yt. As a data container,
             this is a data object created from a ray dataset, such as
-            a cut region.
+            a cut region.  A :class:`~trident.MemoryRay` is a ray held
+            in memory, such as one read from a
+            :class:`~trident.RayArchive`.
 
         :lines: list of strings
 
@@ -346,6 +354,17 @@ class SpectrumGenerator(AbsorptionSpectrum):
             spectrum generation.
             Default: "auto"
 
+        :store_ion_fields: optional, boolean
+
+            If True and the ray was loaded from a ray file, the ion number
+            density fields created here from the ionization table are
+            written back into the ray file, along with the name and path of
+            the table used.  Later spectra made from the same ray file read
+            these fields from disk instead of interpolating the table
+            again.  Fields are not stored for data containers or
+            in-memory rays.
+            Default: False
+
         **Example**
 
         Make a one zone ray and generate a COS spectrum for it including
@@ -356,19 +375,42 @@ class SpectrumGenerator(AbsorptionSpectrum):
         >>> sg = trident.SpectrumGenerator('COS')
         >>> sg.make_spectrum(ray, lines=['O VI', 'Mg II', 'C'])
         >>> sg.plot_spectrum('spec_raw.png')
+
+        Make spectra from the same ray file with two instruments, only
+        interpolating the ionization table for the first.
+
+        >>> sg = trident.SpectrumGenerator('COS-G130M')
+        >>> sg.make_spectrum('ray.h5', lines=['O VI'], store_ion_fields=True)
+        >>> sg = trident.SpectrumGenerator('COS-G160M')
+        >>> sg.make_spectrum('ray.h5', lines=['O VI'])
         """
         self.observing_redshift = observing_redshift
 
+        # the file to which ion fields may be written, if any
+        ray_file = None
         if isinstance(ray, str):
             ray = load(ray)
-        if isinstance(ray, Dataset):
+        if isinstance(ray, MemoryRay):
+            ad = ray
+        elif isinstance(ray, Dataset):
             ad = ray.all_data()
+            ray_file = ray.parameter_filename
         elif isinstance(ray, YTDataContainer):
             ad = ray
             ray = ad.ds
         else:
             raise RuntimeError("Unrecognized ray type.")
 
+        if self.ionization_table is None:
+            ionization_table = ion_table_filepath
+        else:
+            ionization_table = self.ionization_table
+        if isinstance(ray, Dataset):
+            stored_fields = _get_stored_ion_fields(ray.parameter_filename)
+        else:
+            stored_fields = {}
+        created_fields = []
+
         # Clear out any previous spectrum that existed first
         self.clear_spectrum()
 
@@ -377,11 +419,12 @@ class SpectrumGenerator(AbsorptionSpectrum):
         # Make sure we've produced all the necessary
         # derived fields if they aren't native to the data
         for line in active_lines:
-            # if successful, means line.field is in ds.derived_field_list
-            try:
-                ad._determine_fields(line.field)[0]
+            if line.field in stored_fields:
+                _check_stored_ion_field(line.field,
+                                        stored_fields.pop(line.field),
+                                        ionization_table)
             # otherwise we probably need to add the field to the dataset
-            except BaseException:
+            if not _has_field(ad, line.field):
                 my_ion = \
                   line.field[:line.field.find("number_density")]
                 on_ion = my_ion.split("_")
@@ -394,6 +437,7 @@ class SpectrumGenerator(AbsorptionSpectrum):
                                "temperature, metallicity." % (line.field))
                     add_ion_number_density_field(on_ion[0], my_lev, ray,
                                      ionization_table=self.ionization_table)
+                    created_fields.append(line.field)
                 # If level 1 ionization, check to see if other name for
                 # field is present in dataset
                 else:
@@ -410,6 +454,7 @@ class SpectrumGenerator(AbsorptionSpectrum):
                                    "temperature, metallicity." % (line.field))
                         add_ion_number_density_field(on_ion[0], my_lev, ray,
                                      ionization_table=self.ionization_table)
+                        created_fields.append(line.field)
 
             self.add_line(line.identifier, line.field,
                           float(line.wavelength),
@@ -438,6 +483,43 @@ class SpectrumGenerator(AbsorptionSpectrum):
                                          store_observables=store_observables,
                                          min_tau=min_tau, njobs=njobs)
 
+        if store_ion_fields and created_fields:
+            if ray_file is None:
+                mylog.warning("Ion fields can only be stored for rays "
+                              "loaded from a ray file.  Not storing %s." %
+                              ", ".join(created_fields))
+            else:
+                self._store_ion_fields(ray_file, ad, uniquify(created_fields),
+                                       ionization_table)
+
+    @parallel_root_only
+    def _store_ion_fields(self, filename, ad, fields, ionization_table):
+        """
+        Write ion number density fields into the grid group of a ray file,
+        with the ionization table used to make them.
+        """
+        with _h5py.File(filename, "a") as f:
+            if "grid" not in f:
+                mylog.warning("%s is not a ray file.  Not storing ion "
+                              "fields." % filename)
+                return
+            grid = f["grid"]
+            for field in fields:
+                values = ad["gas", field].in_units("cm**-3")
+                if values.size != grid.attrs.get("num_elements", values.size):
+                    mylog.warning("Size of %s does not match ray file %s.  "
+                                  "Not storing it." % (field, filename))
+                    continue
+                mylog.info("Storing %s in %s." % (field, filename))
+                if field in grid:
+                    del grid[field]
+                dataset = grid.create_dataset(field, data=values.d)
+                dataset.attrs["units"] = "cm**-3"
+                dataset.attrs["ionization_table"] = \
+                  os.path.basename(ionization_table)
+                dataset.attrs["ionization_table_path"] = \
+                  os.path.abspath(ionization_table)
+
     def _get_qso_spectrum(self, emitting_redshift, observing_redshift,
                           filename=None):
         """
@@ -763,7 +845,8 @@ class SpectrumGenerator(AbsorptionSpectrum):
         # Negative fluxes don't make sense, so clip
         np.clip(self.flux_field, 0, np.inf, out=self.flux_field)
 
-    def load_spectrum(self, lambda_field=None, tau_field=None, flux_field=None):
+    def load_spectrum(self, lambda_field=None, tau_field=None, flux_field=None,
+                      flux_error_field=None):
         """
         Load data arrays into an existing spectrum object.
 
@@ -784,6 +867,12 @@ class SpectrumGenerator(AbsorptionSpectrum):
             The array of flux values for the corresponding wavelengths
             Default: None
 
+        :flux_error_field: array
+
+            The array of flux errors for the corresponding wavelengths,
+            stored as the flux_error_field attribute
+            Default: None
+
         **Example**
 
         Loading a custom set of data into an existing SpectrumGenerator object:
@@ -806,6 +895,8 @@ class SpectrumGenerator(AbsorptionSpectrum):
             self.tau_field = tau_field
         if flux_field is not None:
             self.flux_field = flux_field
+        if flux_error_field is not None:
+            self.flux_error_field = flux_error_field
         if not len(self.flux_field) == len(self.lambda_field):
             raise RuntimeError("Loaded spectra must have the same dimensions"
                                "for lambda_field and flux_field.  Currently:"
@@ -827,6 +918,7 @@ class SpectrumGenerator(AbsorptionSpectrum):
         else:
             self.flux_field = None
             self.tau_field = None
+        self.flux_error_field = None
 
         # Clear out the line list that is stored in AbsorptionSpectrum
         self.line_list = []
@@ -905,7 +997,9 @@ class SpectrumGenerator(AbsorptionSpectrum):
                                     gamma, f_value, field=field,
                                     identifier=identifier)
 
-    def save_spectrum(self, filename='spectrum.h5', format=None):
+    def save_spectrum(self, filename='spectrum.h5', format=None,
+                      observables=False, dtype='float32', append=False,
+                      header=None):
         """
         Save the current spectrum data to an output file.  Unless specified,
         the output data format will be determined by the suffix of the filename
@@ -927,6 +1021,37 @@ class SpectrumGenerator(AbsorptionSpectrum):
             of filename.
             Default: None
 
+        :observables: bool, optional
+
+            If True, also save the line observables stored when making the
+            spectrum with store_observables=True.  Observables are written
+            to the "line_observables" group of the HDF5 file, one group per
+            line, and can be read back with
+            :func:`~trident.load_line_observables`.  Only supported for
+            the HDF5 format.
+            Default: False
+
+        :dtype: string, optional
+
+            For the FITS format, the precision of the stored columns:
+            'float32' or 'float64'.
+            Default: 'float32'
+
+        :append: bool, optional
+
+            For the FITS format, if True and the file already exists, add
+            the spectrum to it as a new table extension instead of
+            overwriting it.  This allows many spectra to be stored in one
+            file; use the extension keyword of
+            :func:`~trident.load_spectrum` to read them back.
+            Default: False
+
+        :header: dict, optional
+
+            For the FITS format, additional header keywords to store with
+            the spectrum, e.g., {'SEED': 42, 'ZQSO': 0.5}.
+            Default: None
+
         **Example**
 
         Save a spectrum to disk, load it from disk, and plot it.
@@ -942,15 +1067,18 @@ class SpectrumGenerator(AbsorptionSpectrum):
         """
         if format is None:
             if filename.endswith('.h5') or filename.endswith('hdf5'):
-                self._write_spectrum_hdf5(filename)
+                format = 'HDF5'
             elif filename.endswith('.fits') or filename.endswith('FITS'):
-                self._write_spectrum_fits(filename)
+                format = 'FITS'
             else:
-                self._write_spectrum_ascii(filename)
-        elif format == 'HDF5':
-            self._write_spectrum_hdf5(filename)
+                format = 'ASCII'
+        if observables and format != 'HDF5':
+            mylog.warning("Line observables can only be saved in HDF5 format.")
+        if format == 'HDF5':
+            self._write_spectrum_hdf5(filename, observables=observables)
         elif format == 'FITS':
-            self._write_spectrum_fits(filename)
+            self._write_spectrum_fits(filename, dtype=dtype, append=append,
+                                      header=header)
         elif format == 'ASCII':
             self._write_spectrum_ascii(filename)
         else:
@@ -1052,11 +1180,62 @@ class SpectrumGenerator(AbsorptionSpectrum):
         disp += "%s" % self.instrument
         return disp
 
+def _has_field(data, field):
+    """
+    Check whether a field exists on a ray or ray data container.
+    """
+    if isinstance(data, MemoryRay):
+        return data.has_field(field)
+    # if successful, means field is in ds.derived_field_list
+    try:
+        data._determine_fields(field)[0]
+    except BaseException:
+        return False
+    return True
+
+def _get_stored_ion_fields(filename):
+    """
+    Get the ionization tables used to make the ion fields stored in a
+    ray file, keyed by field name.
+    """
+    stored_fields = {}
+    if not os.path.isfile(filename):
+        return stored_fields
+    try:
+        f = _h5py.File(filename, "r")
+    except (IOError, OSError):
+        return stored_fields
+    with f:
+        if "grid" not in f:
+            return stored_fields
+        for field, dataset in f["grid"].items():
+            table = dataset.attrs.get("ionization_table")
+            if table is None:
+                continue
+            if isinstance(table, bytes):
+                table = table.decode("utf-8")
+            stored_fields[field] = table
+    return stored_fields
+
+def _check_stored_ion_field(field, table, ionization_table):
+    """
+    Warn if an ion field stored in a ray file was made with a different
+    ionization table than the one in use.
+    """
+    if table != os.path.basename(ionization_table):
+        mylog.warning("%s was stored in the ray file using the %s "
+                      "ionization table, not %s.  Using the stored field." %
+                      (field, table, os.path.basename(ionization_table)))
+
 def load_spectrum(filename, format='auto', instrument=None, lsf_kernel=None,
-                  line_database='lines.txt', ionization_table=None):
+                  line_database='lines.txt', ionization_table=None,
+                  extension=1):
     """
     Load a previously saved spectrum from disk.
 
+    If the file holds a flux_error column, it is stored as the
+    flux_error_field attribute of the returned SpectrumGenerator.
+
     **Parameters**
 
     :filename: string
@@ -1094,6 +1273,12 @@ def load_spectrum(filename, format='auto', instrument=None, lsf_kernel=None,
         based on its density, temperature, metallicity, and redshift.
         Default: None
 
+    :extension: int, optional
+
+        For FITS files containing multiple spectra, the index of the table
+        extension holding the spectrum to load.
+        Default: 1
+
     **Example**
 
     Create a simple spectrum, save it to disk, and load it back as a new
@@ -1118,19 +1303,39 @@ def load_spectrum(filename, format='auto', instrument=None, lsf_kernel=None,
         lambda_field = f['wavelength'][()]
         flux_field = f['flux'][()]
         tau_field = f['tau'][()]
+        if 'flux_error' in f:
+            flux_error_field = f['flux_error'][()]
+        else:
+            flux_error_field = None
+        f.close()
     elif format == 'fits':
         pyfits = _astropy.pyfits
-        hdulist = pyfits.open(filename)
-        data = hdulist[1].data
-        lambda_field = data['wavelength']
-        tau_field = None
-        # Switch above line to tau_field = data['tau'] when yt PR #2314 is merged.
-        flux_field = data['flux']
+        hdulist = pyfits.open(filename, memmap=True)
+        data = hdulist[extension].data
+        # columns are views of the memory-mapped file in their stored
+        # precision, so they are only read as they are used
+        lambda_field = np.asarray(data['wavelength'])
+        if 'tau' in data.names:
+            tau_field = np.asarray(data['tau'])
+        else:
+            tau_field = None
+        flux_field = np.asarray(data['flux'])
+        if 'flux_error' in data.names:
+            flux_error_field = np.asarray(data['flux_error'])
+        else:
+            flux_error_field = None
+        del data
+        # the memory map stays open while the columns are referenced
+        hdulist.close()
     elif format == 'ascii':
         data = np.genfromtxt(filename)
         lambda_field = data[:,0]
         tau_field = data[:,1]
         flux_field = data[:,2]
+        if data.shape[1] > 3:
+            flux_error_field = data[:,3]
+        else:
+            flux_error_field = None
     else:
         raise RuntimeError("load_spectrum 'format' keyword must be 'hdf5', 'ascii', 'fits', or 'auto'")
 
@@ -1142,9 +1347,6 @@ def load_spectrum(filename, format='auto', instrument=None, lsf_kernel=None,
                            lambda_max=lambda_max, n_lambda=n_lambda,
                            lsf_kernel=lsf_kernel, line_database=line_database,
                            ionization_table=ionization_table)
-    if tau_field is not None:
-        sg.load_spectrum(lambda_field=lambda_field, tau_field=tau_field,
-                         flux_field=flux_field)
-    else:
-        sg.load_spectrum(lambda_field=lambda_field, flux_field=flux_field)
+    sg.load_spectrum(lambda_field=lambda_field, tau_field=tau_field,
+                     flux_field=flux_field, flux_error_field=flux_error_field)
     return sg
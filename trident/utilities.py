@@ -12,14 +12,17 @@ Miscellaneous Utilities for Trident
 #-----------------------------------------------------------------------------
 
 import gzip
+import hashlib
 import os
 from os.path import \
     expanduser
 import requests
 import tempfile
 import shutil
+import zlib
 from yt.funcs import \
-    get_pbar
+    get_pbar, \
+    mylog
 import numpy as np
 from yt.units import \
     cm, \
@@ -29,6 +32,8 @@ from yt import \
     load_uniform_grid, \
     YTArray, \
     load
+from trident.memory_ray import \
+    MemoryRay
 
 def ensure_directory(directory):
     """
@@ -115,6 +120,171 @@ def download_file(url, progress_bar=True, local_directory=None,
         pbar.finish()
     filehandle.close()
 
+def download_and_gunzip_file(url, out_filename, checksum=None,
+                             hash_type="md5", progress_bar=True,
+                             max_retries=5, chunk_size=2**16,
+                             timeout=(10, 60)):
+    """
+    Downloads a gzipped file from the provided URL, decompressing it as it
+    arrives.
+
+    Unlike calling :func:`~trident.utilities.download_file` followed by
+    :func:`~trident.utilities.gunzip_file`, the compressed file is never
+    written to disk and the uncompressed file is never held in memory.
+    Data is written to a temporary file in the same directory as
+    ``out_filename``, which is renamed to ``out_filename`` only once the
+    download is complete and verified.  If the connection is interrupted,
+    the download is resumed from where it stopped using an HTTP range
+    request, or restarted if the server does not support them.
+
+    **Parameters**
+
+    :url: string
+
+        The web address of the gzipped file to download.
+
+    :out_filename: string
+
+        The filename where the uncompressed file will be saved.
+
+    :checksum: string, optional
+
+        The expected hex digest of the compressed file.  If given and
+        the digest of the downloaded data does not match, a RuntimeError
+        is raised and no output file is written.  The integrity of the
+        uncompressed data is always checked against the gzip CRC.
+        Default: None
+
+    :hash_type: string, optional
+
+        The hashlib algorithm used to compute the checksum.
+        Default: "md5"
+
+    :progress_bar: boolean, optional
+
+        Will generate a progress bar for the user as the file downloads.
+        Default: True
+
+    :max_retries: int, optional
+
+        The number of times in a row to try to resume an interrupted
+        download without receiving any data before giving up.
+        Default: 5
+
+    :chunk_size: int, optional
+
+        The number of bytes read from the connection at a time.
+        Default: 2**16
+
+    :timeout: float or tuple of floats, optional
+
+        The number of seconds to wait to connect to the server and
+        between bytes received, as used by requests.  A stalled
+        connection raises a Timeout, and the download is resumed.
+        Default: (10, 60)
+
+    **Returns**
+
+        The hex digest of the compressed file.
+
+    **Example**
+
+    >>> download_and_gunzip_file(
+    ...     "http://trident-project.org/data/ion_table/hm2012_lr.h5.gz",
+    ...     "hm2012_lr.h5")
+    """
+    out_dir = os.path.dirname(os.path.abspath(out_filename))
+    ensure_directory(out_dir)
+    fd, temp_filename = tempfile.mkstemp(
+        dir=out_dir, prefix=".%s." % os.path.basename(out_filename))
+    out_file = os.fdopen(fd, 'wb')
+
+    # decompress the gzip stream as it arrives
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    file_hash = hashlib.new(hash_type)
+    n_received = 0
+    n_total = None
+    pbar = None
+    retries = 0
+
+    try:
+        while True:
+            headers = {}
+            if n_received > 0:
+                headers["Range"] = "bytes=%d-" % n_received
+            try:
+                with requests.get(url, stream=True, headers=headers,
+                                  timeout=timeout) as r:
+                    r.raise_for_status()
+                    if n_received > 0 and r.status_code != 206:
+                        # the server ignored the range request, so start over
+                        mylog.warning("Server does not support resuming "
+                                      "downloads; restarting %s." % url)
+                        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                        file_hash = hashlib.new(hash_type)
+                        n_received = 0
+                        out_file.seek(0)
+                        out_file.truncate()
+                    if n_total is None and "content-length" in r.headers:
+                        n_total = n_received + int(r.headers["content-length"])
+                        if progress_bar:
+                            pbar = get_pbar("Downloading file: %s" %
+                                            os.path.basename(out_filename),
+                                            n_total / 2**10)
+
+                    for content in r.iter_content(chunk_size):
+                        file_hash.update(content)
+                        n_received += len(content)
+                        out_file.write(decompressor.decompress(content))
+                        # retries only count failures without progress between
+                        retries = 0
+                        if pbar is not None:
+                            pbar.update(n_received / 2**10)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout) as error:
+                retries += 1
+                if retries > max_retries:
+                    raise
+                mylog.warning("Download of %s interrupted (%s); resuming "
+                              "from byte %d." % (url, error, n_received))
+                continue
+
+            if n_total is not None and n_received < n_total:
+                retries += 1
+                if retries > max_retries:
+                    raise RuntimeError(
+                        "Download of %s ended after %d of %d bytes." %
+                        (url, n_received, n_total))
+                mylog.warning("Download of %s ended early; resuming from "
+                              "byte %d." % (url, n_received))
+                continue
+            break
+
+        if pbar is not None:
+            pbar.finish()
+
+        out_file.write(decompressor.flush())
+        if not getattr(decompressor, "eof", True):
+            raise RuntimeError(
+                "Downloaded file %s is not a complete gzip file." % url)
+
+        digest = file_hash.hexdigest()
+        if checksum is not None and digest != checksum.lower():
+            raise RuntimeError(
+                "Checksum mismatch for %s: expected %s, got %s." %
+                (url, checksum, digest))
+
+        out_file.close()
+        getattr(os, "replace", os.rename)(temp_filename, out_filename)
+    except BaseException:
+        out_file.close()
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+
+    return digest
+
 def gunzip_file(in_filename, out_filename=None, cleanup=True):
     """
     Uncompress a file using gunzip.
@@ -145,7 +315,8 @@ def gunzip_file(in_filename, out_filename=None, cleanup=True):
     if out_filename is None:
         out_filename = ".".join(in_filename.split('.')[:-1])
     out_file = open(out_filename, 'wb')
-    out_file.write( in_file.read() )
+    # copy in chunks to avoid holding the whole uncompressed file in memory
+    shutil.copyfileobj(in_file, out_file, 2**20)
     in_file.close()
     out_file.close()
     if cleanup:
@@ -249,15 +420,11 @@ def get_datafiles(datadir=None, url=None):
         except IndexError:
             print("%d is not a valid option.  Please pick one of the listed numbers.")
 
-    # Actually downloads the file to a temporary directory before gunzipping.
+    # Download and unzip the file in a single pass.
     fileurl = os.path.join(url, filename)
-    tempdir = tempfile.mkdtemp()
     print("")
-    download_file(fileurl, local_directory=tempdir)
-    print("  Unzipping file: %s" % filename)
-    gunzip_file(os.path.join(tempdir, filename),
-                out_filename=os.path.join(datadir, filename[:-3]))
-    shutil.rmtree(tempdir)
+    download_and_gunzip_file(fileurl,
+                             os.path.join(datadir, filename[:-3]))
     return filename[:-3]
 
 def make_onezone_dataset(density=1e-26, temperature=1000, metallicity=0.3,
@@ -370,8 +537,9 @@ def make_onezone_ray(density=1e-26, temperature=1000, metallicity=0.3,
 
     :filename: string, optional
 
-        The filename to which to save the ray to disk.  Due to the
-        mechanism for passing rays, the ray data must be saved to disk.
+        The filename to which to save the ray to disk.  If set to None,
+        the ray is not saved to disk and is returned as a
+        :class:`~trident.MemoryRay`.
         Default: 'ray.h5'
 
     :column_densities: dict, optional
@@ -387,7 +555,8 @@ def make_onezone_ray(density=1e-26, temperature=1000, metallicity=0.3,
 
     **Returns**
 
-        A YT LightRay object
+        A YT LightRay object, or a :class:`~trident.MemoryRay` if
+        :filename: is None
 
     **Example**
 
@@ -439,6 +608,10 @@ def make_onezone_ray(density=1e-26, temperature=1000, metallicity=0.3,
           "domain_right_edge": np.ones(3)*length,
           "periodicity": [True]*3}
 
+    if filename is None:
+        return MemoryRay(data, current_redshift=ds["current_redshift"],
+                         name="OneZoneRay")
+
     save_as_dataset(ds, filename, data, field_types=field_types,
                        extra_attrs=extra_attrs)
 